@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Compare the tar extractors and decompressors of UnzipUtil.
+
+Builds an archive of many small files and a few large ones, or uses the
+archive given, and extracts it a few times with each `TAR_EXTRACTOR`
+and with each of the `DECOMPRESSORS` found on the `PATH`.
+
+    PYTHONPATH=src python bench/extract.py [options] [ARCHIVE]
+"""
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+from optparse import OptionParser
+from build_pack_utils import UnzipUtil
+
+
+def make_archive(path, files, size, large, mode='w:gz'):
+    srcDir = tempfile.mkdtemp(prefix='bench-src-')
+    try:
+        for i in xrange(files):
+            subDir = os.path.join(srcDir, 'pkg', 'dir%03d' % (i % 50))
+            if not os.path.exists(subDir):
+                os.makedirs(subDir)
+            with open(os.path.join(subDir, 'file%05d' % i), 'wb') as f:
+                f.write(os.urandom(size / 2) + '\0' * (size / 2))
+        for i in xrange(large):
+            with open(os.path.join(srcDir, 'pkg', 'large%d' % i), 'wb') as f:
+                for j in xrange(64):
+                    f.write(os.urandom(512 * 1024) + '\0' * 512 * 1024)
+        tar = tarfile.open(path, mode)
+        try:
+            tar.add(os.path.join(srcDir, 'pkg'), 'pkg')
+        finally:
+            tar.close()
+    finally:
+        shutil.rmtree(srcDir)
+
+
+def configs(archive):
+    """Each way to extract `archive`, as `(name, ctx)`"""
+    yield ('python', {'TAR_DECOMPRESSOR': 'python'})
+    yield ('external', {'TAR_EXTRACTOR': 'external'})
+    compression = archive.endswith('.bz2') and 'bz2' or 'gz'
+    for name, cmd, parallel in UnzipUtil.DECOMPRESSORS[compression]:
+        if UnzipUtil._available(cmd[0]):
+            yield ('python+%s' % name, {'TAR_DECOMPRESSOR': name})
+            yield ('external+%s' % name, {'TAR_EXTRACTOR': 'external',
+                                          'TAR_DECOMPRESSOR': name})
+
+
+def run(archive, ctx, rounds, strip):
+    times = []
+    for i in xrange(rounds):
+        intoDir = tempfile.mkdtemp(prefix='bench-into-')
+        try:
+            uzUtil = UnzipUtil(ctx)
+            start = time.time()
+            uzUtil.extract(archive, intoDir, strip=strip)
+            times.append(time.time() - start)
+        finally:
+            shutil.rmtree(intoDir)
+    times.sort()
+    return times[0], times[len(times) / 2]
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [ARCHIVE]')
+    parser.add_option('-f', '--files', type='int', default=2000,
+                      help='small files in the generated archive')
+    parser.add_option('-s', '--size', type='int', default=4096,
+                      help='bytes in each small file')
+    parser.add_option('-l', '--large', type='int', default=2,
+                      help='64 MiB files in the generated archive')
+    parser.add_option('-r', '--rounds', type='int', default=5,
+                      help='extractions with each configuration')
+    parser.add_option('--strip', action='store_true', default=False,
+                      help='strip the first element of each path')
+    parser.add_option('--bz2', action='store_true', default=False,
+                      help='compress the generated archive with bzip2')
+    (opts, args) = parser.parse_args(argv)
+    tmpDir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        if args:
+            archive = os.path.abspath(args[0])
+        else:
+            archive = os.path.join(tmpDir, opts.bz2 and 'bench.tar.bz2' or
+                                   'bench.tar.gz')
+            make_archive(archive, opts.files, opts.size, opts.large,
+                         opts.bz2 and 'w:bz2' or 'w:gz')
+        print 'Archive [%s], [%d] bytes' % (archive, os.path.getsize(archive))
+        for name, ctx in configs(archive):
+            best, median = run(archive, ctx, opts.rounds, opts.strip)
+            print '%-16s best %7.3fs  median %7.3fs' % (name, best, median)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,7 @@ from builder import *
 from zips import *
 from process import Process
 from process import ProcessManager
+from prefetch import Prefetcher
 from runner import BuildPack
 from runner import check_output
 from runner import stream_output
@@ -5,6 +5,7 @@ import re
 import logging
 from collections import defaultdict
 from StringIO import StringIO
+from urlparse import urlparse
 from subprocess import Popen
 from subprocess import PIPE
 from cloudfoundry import CloudFoundryUtil
@@ -18,6 +19,8 @@ from runner import BuildPack
 from utils import rewrite_cfgs
 from utils import process_extension
 from utils import process_extensions
+from utils import run_parallel
+from utils import FormattedDict
 
 
 _log = logging.getLogger('builder')
@@ -158,18 +161,47 @@ class Installer(object):
         self._log = _log
         self._installer = CloudFoundryInstaller(self.builder._ctx)
 
-    def package(self, key):
+    def _resolve_key(self, key):
         if key in self.builder._ctx.keys():
             key = self.builder._ctx[key]
-        self.builder._ctx['%s_INSTALL_PATH' % key] = \
-            self._installer.install_binary(key)
+        return key
+
+    def _installed(self, key, path):
+        self.builder._ctx['%s_INSTALL_PATH' % key] = path
         self._log.info("Installed [%s] to [%s]", key,
                        self.builder._ctx['%s_INSTALL_PATH' % key])
+
+    def package(self, key):
+        key = self._resolve_key(key)
+        self._installed(key, self._installer.install_binary(key))
         return self
 
     def packages(self, *keys):
-        for key in keys:
-            self.package(key)
+        """Install several packages.
+
+        By default packages are installed one after the other.  Set
+        `INSTALL_WORKERS` to install up to that many packages at the
+        same time and `INSTALL_WORKERS_PER_HOST` to limit how many of
+        those may download from the same host at once.  The
+        `<KEY>_INSTALL_PATH` entries are always set in the order the keys
+        were given and the first failure, in that order, is raised once
+        all of the installs have finished.
+        """
+        ctx = self.builder._ctx
+        workers = int(ctx.get('INSTALL_WORKERS', 1))
+        if workers <= 1 or len(keys) <= 1:
+            for key in keys:
+                self.package(key)
+            return self
+        keys = [self._resolve_key(key) for key in keys]
+        self._installer.limit_hosts(
+            int(ctx.get('INSTALL_WORKERS_PER_HOST', workers)))
+        self._log.debug("Installing %s with [%d] workers", keys, workers)
+        results = run_parallel(self._installer.install_binary, keys, workers)
+        for key, (path, excInfo) in zip(keys, results):
+            if excInfo:
+                raise excInfo[0], excInfo[1], excInfo[2]
+            self._installed(key, path)
         return self
 
     def modules(self, key):
@@ -202,6 +234,7 @@ class Installer(object):
         return BuildPackManager(self)
 
     def done(self):
+        self._installer.save_stats()
         return self.builder
 
 
@@ -286,26 +319,73 @@ class ModuleInstaller(object):
         self._modules = list(set(self._modules))
         return self
 
+    def _module_ctx(self, module):
+        ctx = FormattedDict(self._ctx)
+        ctx['MODULE_NAME'] = module
+        return ctx
+
     def done(self):
+        """Install the modules.
+
+        Each module's URL is resolved against its own copy of the context,
+        with `MODULE_NAME` set, so the shared context is never changed.
+        Set `<KEY>_MODULES_WORKERS`, or `INSTALL_WORKERS`, to install up to
+        that many modules at the same time.  A module that fails to install
+        is logged and skipped.
+
+        When the downloader can fetch a batch of files at once, like
+        `AsyncDownloader` or `CurlDownloader`, the digests of all of the
+        modules and then the modules themselves are downloaded together,
+        into the cache, before any of them are installed, see
+        `CloudFoundryInstaller.cache_binaries`.
+        """
         toPath = os.path.join(self._ctx['BUILD_DIR'],
                               self._moduleKey.lower())
         strip = self._ctx.get('%s_MODULES_STRIP' % self._moduleKey, False)
-        for module in set(self._modules):
-            try:
-                self._ctx['MODULE_NAME'] = module
-                url = self._ctx['%s_MODULES_PATTERN' % self._moduleKey]
-                hashUrl = "%s.%s" % (url, self._ctx['CACHE_HASH_ALGORITHM'])
-                self._cf.install_binary_direct(url, hashUrl, toPath,
-                                               strip=strip)
-            except Exception:
+        workers = int(self._ctx.get(
+            '%s_MODULES_WORKERS' % self._moduleKey,
+            self._ctx.get('INSTALL_WORKERS', 1)))
+
+        def urls(module):
+            ctx = self._module_ctx(module)
+            url = ctx['%s_MODULES_PATTERN' % self._moduleKey]
+            return url, "%s.%s" % (url, ctx['CACHE_HASH_ALGORITHM'])
+
+        modules = list(set(self._modules))
+        digests = self._download_digests(modules, urls)
+
+        def binary(module):
+            url, hashUrl = urls(module)
+            return url, digests.get(module, hashUrl)
+        self._cf.cache_binaries([binary(module) for module in modules])
+
+        def install(module):
+            url, hsh = binary(module)
+            return self._cf.install_binary_direct(url, hsh, toPath,
+                                                  strip=strip)
+        for module, (path, excInfo) in zip(
+                modules, run_parallel(install, modules, workers)):
+            if excInfo:
                 self._log.warning('Module %s failed to install', module)
                 self._log.debug('Module %s failed to install because',
-                                module, exc_info=True)
-            finally:
-                if 'MODULE_NAME' in self._ctx.keys():
-                    del self._ctx['MODULE_NAME']
+                                module, exc_info=excInfo)
+        self._cf.save_stats()
         return self._installer
 
+    def _download_digests(self, modules, urls):
+        manifest = self._cf._manifest()
+        wanted = {}
+        for module in modules:
+            url, hashUrl = urls(module)
+            if not manifest.get(urlparse(url).path.split('/')[-1]):
+                wanted[module] = hashUrl
+        if not wanted:
+            return {}
+        digests = self._cf.download_digests(wanted.values())
+        return dict((module, digests[hashUrl])
+                    for module, hashUrl in wanted.iteritems()
+                    if hashUrl in digests)
+
 
 class ExtensionRegister(object):
     def __init__(self, builder, reg):
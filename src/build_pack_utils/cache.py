@@ -1,14 +1,159 @@
 import os
+import json
+import errno
 import shutil
+import time
+import tempfile
 import logging
+import threading
+from contextlib import contextmanager
 from hashes import HashUtil
 from hashes import ShaHashUtil
+from utils import safe_makedirs
+from utils import link_or_copy
+from utils import file_lock
+
+
+@contextmanager
+def _no_lock():
+    yield
+
+
+def _tmp_path(path):
+    """Unique temporary name next to `path`, to write it atomically"""
+    return '%s.%d.%d.tmp' % (path, os.getpid(),
+                             threading.current_thread().ident)
+
+
+class CacheStats(object):
+    """Counters that show how effective the cache is.
+
+    `verifyTime` is the number of seconds spent hashing cached files, the
+    rest are counts of files or bytes.
+    """
+
+    FIELDS = ('hits', 'misses', 'verifyTime', 'bytesFromCache',
+              'bytesDownloaded', 'evictions', 'evictedBytes')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, field, value=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + value)
+
+    def as_dict(self):
+        with self._lock:
+            return dict([(field, getattr(self, field))
+                         for field in self.FIELDS])
+
+    def flush(self, path):
+        """Add the counters to the totals saved in `path` and reset them
+
+        Nothing is written when all of the counters are zero.
+        """
+        with self._lock:
+            counts = dict([(field, getattr(self, field))
+                           for field in self.FIELDS])
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+        if not any(counts.values()):
+            return
+        safe_makedirs(os.path.dirname(path))
+        with file_lock('%s.lock' % path):
+            try:
+                with open(path, 'rt') as f:
+                    totals = json.load(f)
+            except (IOError, ValueError):
+                totals = {}
+            for field, value in counts.iteritems():
+                totals[field] = totals.get(field, 0) + value
+            tmpPath = _tmp_path(path)
+            with open(tmpPath, 'wt') as f:
+                json.dump(totals, f, indent=2, sort_keys=True)
+            os.rename(tmpPath, path)
+
+
+class FailureCache(object):
+    """Remember the URLs that could not be downloaded.
+
+    Set `FILE_CACHE_NEGATIVE_TTL` to remember, for that many seconds, the
+    URLs that failed because they don't exist, so later stagings skip
+    them instead of asking for them again.  Set
+    `FILE_CACHE_NEGATIVE_FORCE` to try them anyway.  The failures are
+    kept in the cache directory, with the URL, the HTTP status and the
+    time of each.  Without a TTL, nothing is remembered.
+    """
+
+    FAILURES_FILE = '.failures.json'
+
+    def __init__(self, ctx):
+        self._log = logging.getLogger('cache')
+        self._ttl = float(ctx.get('FILE_CACHE_NEGATIVE_TTL', 0))
+        self._force = ctx.get('FILE_CACHE_NEGATIVE_FORCE', False)
+        self._failures = {}
+        if self._ttl:
+            baseDir = ctx.get('FILE_CACHE_BASE_DIRECTORY', ctx['CACHE_DIR'])
+            self._path = os.path.join(baseDir, self.FAILURES_FILE)
+            self._lockPath = os.path.join(baseDir, '.locks', 'failures.lock')
+            self._failures = self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _update(self, change):
+        """Change the failures, as they are saved, under a lock"""
+        with file_lock(self._lockPath):
+            self._failures = self._load()
+            change(self._failures)
+            tmpPath = _tmp_path(self._path)
+            with open(tmpPath, 'wt') as f:
+                json.dump(self._failures, f)
+            os.rename(tmpPath, self._path)
+
+    def get(self, url):
+        """How `url` failed, if it did within the TTL.
+
+        Returns a dict with the HTTP `status` and the `time` it failed,
+        or None when the URL should be downloaded.
+        """
+        failure = self._failures.get(url)
+        if (not failure or self._force or
+                time.time() - failure['time'] > self._ttl):
+            return None
+        return failure
+
+    def add(self, url, status):
+        """Note that `url` does not exist, it failed with `status`"""
+        if not self._ttl:
+            return
+
+        def change(failures):
+            now = time.time()
+            for old in [old for old, failure in failures.items()
+                        if now - failure['time'] > self._ttl]:
+                del failures[old]
+            failures[url] = {'status': status, 'time': now}
+        self._update(change)
+        self._log.debug("Remembered that [%s] failed with [%s]",
+                        url, status)
+
+    def remove(self, url):
+        if url in self._failures:
+            self._update(lambda failures: failures.pop(url, None))
 
 
 class BaseCacheManager(object):
 
     def __init__(self, ctx):
         self._log = logging.getLogger('cache')
+        self.stats = CacheStats()
         if ctx.get('USE_EXTERNAL_HASH', False):
             self._log.debug("Using external hash.")
             self._hashUtil = ShaHashUtil(ctx)
@@ -28,43 +173,442 @@ class BaseCacheManager(object):
     def exists(self, key, digest):
         return False
 
+    def get_tree(self, digest, strip):
+        return None
+
+    def put_tree(self, digest, strip, extract):
+        return None
+
+    def spool_path(self, key):
+        return None
+
+    def lock(self, key):
+        return _no_lock()
+
+    def flush(self):
+        pass
+
 
 class DirectoryCacheManager(BaseCacheManager):
+    """Cache files in a directory.
+
+    The digest of every cached file is kept in an index file in the cache
+    directory, along with the size, mtime and inode of the file when it
+    was hashed.  As long as those don't change, looking up a file only
+    costs a `stat`.  Set `FILE_CACHE_PARANOID_VERIFY` to hash the file on
+    every lookup instead.
+
+    By default, files are stored by name.  Set `FILE_CACHE_LAYOUT` to
+    `content` to store them by digest instead, under
+    `blobs/<digest>/<name>`, with a map of names to digests.  Different
+    files with the same name don't replace each other in this layout and
+    identical files stored under different names share the same inode.
+
+    Set `FILE_CACHE_MAX_BYTES` to limit the size of the cache.  When a new
+    file pushes the cache over that size, the least recently used files
+    are evicted.  A file larger than `FILE_CACHE_MAX_ENTRY_FRACTION` of
+    the limit (default 0.5) is not cached at all.  The times files were
+    used are only tracked with a limit, they're kept in memory and saved
+    with the next eviction or `flush`.
+
+    Extracted archives can be cached too, see `get_tree` and `put_tree`.
+    They count towards the limit and are evicted like files, by the total
+    size of the extracted files.
+
+    The cache can be shared by several stagers.  Files and the index are
+    written to temporary files and renamed into place, updates to the
+    index are made under a lock and `lock` lets callers make sure only
+    one of them downloads a file at a time.
+    """
+
+    INDEX_FILE = '.digests.json'
+    NAMES_FILE = '.names.json'
 
     def __init__(self, ctx):
         BaseCacheManager.__init__(self, ctx)
         self._baseDir = ctx.get('FILE_CACHE_BASE_DIRECTORY',
                                 ctx['CACHE_DIR'])
+        self._algorithm = ctx.get('CACHE_HASH_ALGORITHM')
+        self._paranoid = ctx.get('FILE_CACHE_PARANOID_VERIFY', False)
+        self._byContent = (ctx.get('FILE_CACHE_LAYOUT', 'name') == 'content')
+        self._maxBytes = int(ctx.get('FILE_CACHE_MAX_BYTES', 0))
+        self._maxFraction = float(ctx.get('FILE_CACHE_MAX_ENTRY_FRACTION',
+                                          0.5))
         self._log.info("Using [%s] as cache directory.", self._baseDir)
-        if not os.path.exists(self._baseDir):
-            os.makedirs(self._baseDir)
+        safe_makedirs(self._baseDir)
+        self._indexPath = os.path.join(self._baseDir, self.INDEX_FILE)
+        self._namesPath = os.path.join(self._baseDir, self.NAMES_FILE)
+        self._lockDir = os.path.join(self._baseDir, '.locks')
+        self._index = self._load(self._indexPath)
+        self._names = self._load(self._namesPath)
+        self._touched = {}
+        self._touchedLock = threading.Lock()
+
+    def _load(self, path):
+        try:
+            with open(path, 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, path, data):
+        tmpPath = _tmp_path(path)
+        with open(tmpPath, 'wt') as f:
+            json.dump(data, f)
+        os.rename(tmpPath, path)
+
+    def _update(self, change):
+        """Change the index and the names map, as they are saved on disk.
+
+        Both are locked, reloaded, passed to `change` and saved again, so
+        that changes made by other stagers sharing the cache are kept.
+        """
+        with file_lock(os.path.join(self._lockDir, 'index.lock')):
+            self._index = self._load(self._indexPath)
+            self._names = self._load(self._namesPath)
+            change(self._index, self._names)
+            self._save(self._indexPath, self._index)
+            self._save(self._namesPath, self._names)
+
+    def lock(self, key):
+        """Lock `key` for threads and processes sharing the cache.
+
+        Used as a context manager, while a file is looked up and, when
+        it's missing, downloaded and stored.  Other stagers wait for the
+        download and then find the file in the cache.
+        """
+        return file_lock(os.path.join(self._lockDir, '%s.lock' % key))
+
+    def _load_index(self):
+        return self._load(self._indexPath)
+
+    def _rel_path(self, key, digest):
+        if self._byContent:
+            return os.path.join('blobs', digest.split()[0], key)
+        return key
+
+    def _stat(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def _remember(self, rel, digest):
+        entry = {
+            'stat': self._stat(os.path.join(self._baseDir, rel)),
+            'algorithm': self._algorithm,
+            'digest': digest.split()[0],
+            'atime': time.time()
+        }
+
+        def change(index, names):
+            index[rel] = entry
+        self._update(change)
+
+    def _touch(self, rel):
+        """Note that `rel` was used, when the size of the cache is limited"""
+        if self._maxBytes:
+            with self._touchedLock:
+                self._touched[rel] = time.time()
+
+    def _apply_touched(self, index):
+        with self._touchedLock:
+            touched, self._touched = self._touched, {}
+        for rel, atime in touched.iteritems():
+            if rel in index:
+                index[rel]['atime'] = max(atime, index[rel].get('atime', 0))
+
+    def flush(self):
+        """Save the times files were used, noted since the last eviction"""
+        if self._touched:
+            self._update(lambda index, names: self._apply_touched(index))
+
+    def _forget(self, rel):
+        def change(index, names):
+            index.pop(rel, None)
+        self._update(change)
+
+    def _name(self, key, digest):
+        if self._names.get(key) != digest.split()[0]:
+            def change(index, names):
+                names[key] = digest.split()[0]
+            self._update(change)
+
+    def _digest(self, rel):
+        """Digest of a file in the cache, only hashed if it's changed"""
+        path = os.path.join(self._baseDir, rel)
+        stat = self._stat(path)
+        if not self._paranoid:
+            # reload once, another stager may have hashed it already
+            for index in (self._index, self._load(self._indexPath)):
+                entry = index.get(rel)
+                if (entry and entry['algorithm'] == self._algorithm and
+                        entry['stat'] == stat):
+                    return entry['digest']
+        self._log.debug('Hashing cached file [%s]', rel)
+        start = time.time()
+        digest = self._hashUtil.calculate_hash(path)
+        self.stats.add('verifyTime', time.time() - start)
+        self._remember(rel, digest)
+        return digest
+
+    def _link_same_content(self, key, digest):
+        """Give an existing blob with the same content this name too"""
+        blobDir = os.path.join(self._baseDir, 'blobs', digest.split()[0])
+        path = os.path.join(blobDir, key)
+        if os.path.exists(blobDir) and not os.path.exists(path):
+            for name in os.listdir(blobDir):
+                if self._exists(os.path.join('blobs', digest.split()[0],
+                                             name), digest):
+                    os.link(os.path.join(blobDir, name), path)
+                    self._remember(self._rel_path(key, digest), digest)
+                    self._name(key, digest)
+                    return
+
+    def _exists(self, rel, digest):
+        return (os.path.exists(os.path.join(self._baseDir, rel)) and
+                digest.split()[0] == self._digest(rel))
+
+    def _remove(self, rel):
+        path = os.path.join(self._baseDir, rel)
+        if os.path.isdir(path):
+            # extracted files, see `put_tree`, gone at once for readers
+            tmpPath = _tmp_path(path)
+            os.rename(path, tmpPath)
+            shutil.rmtree(tmpPath, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+            if self._byContent and not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+
+    def _evict(self, keep):
+        """Remove the least recently used files, until the cache fits"""
+        if not self._maxBytes:
+            return
+
+        def change(index, names):
+            self._apply_touched(index)
+            entries = sorted(index.items(),
+                             key=lambda item: item[1].get('atime', 0))
+            total = sum([entry['stat'][0] for rel, entry in entries])
+            for rel, entry in entries:
+                if total <= self._maxBytes:
+                    break
+                if rel == keep:
+                    continue
+                self._log.debug('Evicting [%s] from the cache', rel)
+                self._remove(rel)
+                del index[rel]
+                if self._byContent and not entry.get('tree'):
+                    name = os.path.basename(rel)
+                    if names.get(name) == entry['digest']:
+                        del names[name]
+                total -= entry['stat'][0]
+                self.stats.add('evictions')
+                self.stats.add('evictedBytes', entry['stat'][0])
+        self._update(change)
+        if self.stats.evictions:
+            self._log.info('Evicted [%d] files, [%d] bytes from the cache '
+                           'so far', self.stats.evictions,
+                           self.stats.evictedBytes)
 
     def get(self, key, digest):
-        path = os.path.join(self._baseDir, key)
         if self.exists(key, digest):
             self._log.debug('Cache hit (%s, %s)', key, digest)
+            path = os.path.join(self._baseDir, self._rel_path(key, digest))
+            self._touch(self._rel_path(key, digest))
+            self.stats.add('hits')
+            self.stats.add('bytesFromCache', os.path.getsize(path))
             return path
+        self.stats.add('misses')
+
+    def spool_path(self, key):
+        """Temporary path in the cache, to write a file that will be put.
 
-    def put(self, key, fileToCache, digest):
-        path = os.path.join(self._baseDir, key)
+        A file written there can be put with `move` set, which renames it
+        into place instead of copying it.
+        """
+        return _tmp_path(os.path.join(self._baseDir, key))
+
+    def put(self, key, fileToCache, digest, move=False):
+        """Store `fileToCache` under `key`, returns the cached file.
+
+        With `move` set, the file is renamed into the cache when possible
+        and otherwise removed once it's copied, unless it can't be cached
+        at all.  Then `fileToCache` is returned as it is.
+        """
+        size = os.path.getsize(fileToCache)
+        if self._maxBytes and size > self._maxBytes * self._maxFraction:
+            self._log.info('Not caching [%s], [%d] bytes is too large for '
+                           'a cache limited to [%d] bytes',
+                           key, size, self._maxBytes)
+            return fileToCache
+        rel = self._rel_path(key, digest)
+        path = os.path.join(self._baseDir, rel)
+        self._put(key, fileToCache, digest, rel, path, move)
+        if move and os.path.exists(fileToCache):
+            os.remove(fileToCache)
+        self._evict(rel)
+        return path
+
+    def _move(self, fileToCache, path):
+        try:
+            os.rename(fileToCache, path)
+            return True
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            return False
+
+    def _put(self, key, fileToCache, digest, rel, path, move=False):
+        if self._byContent:
+            if not self._exists(rel, digest):
+                safe_makedirs(os.path.dirname(path))
+                # never write over a blob, it may be linked elsewhere
+                if not (move and self._move(fileToCache, path)):
+                    tmpPath = _tmp_path(path)
+                    link_or_copy(fileToCache, tmpPath, hardlink=False)
+                    os.rename(tmpPath, path)
+                self._remember(rel, digest)
+            else:
+                self._touch(rel)
+            self._name(key, digest)
+            return
+        # a different size means a different digest, no need to hash it
         if (os.path.exists(path) and
-                not self._hashUtil.does_hash_match(digest, path)):
+                (os.path.getsize(path) != os.path.getsize(fileToCache) or
+                 digest.split()[0] != self._digest(rel))):
             self._log.warning(
                 "File [%s] already exists in the cache, but the digest "
                 "[%s] does not match.  Will update the cache if the "
                 "underlying file system supports it.", key, digest)
-        shutil.copy(fileToCache, path)
-        return path
+        # readers never see a partially written file
+        if not (move and self._move(fileToCache, path)):
+            tmpPath = _tmp_path(path)
+            shutil.copy(fileToCache, tmpPath)
+            os.rename(tmpPath, path)
+        self._remember(rel, digest)
 
     def delete(self, key):
-        path = os.path.join(self._baseDir, key)
-        if os.path.exists(path):
+        if self._byContent:
+            digest = self._names.get(key)
+            if digest is None:
+                return
+            rel = self._rel_path(key, digest)
+
+            def change(index, names):
+                names.pop(key, None)
+            self._update(change)
+        else:
+            rel = key
+        if os.path.exists(os.path.join(self._baseDir, rel)):
             self._log.warning(
                 "You are trying to delete a file from the cache "
                 "this is not supported for all file systems.")
-            os.remove(path)
+            self._remove(rel)
+        self._forget(rel)
 
     def exists(self, key, digest):
-        path = os.path.join(self._baseDir, key)
-        return (os.path.exists(path) and
-                self._hashUtil.does_hash_match(digest, path))
+        if self._byContent:
+            self._link_same_content(key, digest)
+        return self._exists(self._rel_path(key, digest), digest)
+
+    def _tree_rel(self, digest, strip):
+        return os.path.join('trees',
+                            '%s-%d' % (digest.split()[0], strip and 1 or 0))
+
+    def _tree_path(self, digest, strip):
+        return os.path.join(self._baseDir, self._tree_rel(digest, strip))
+
+    def get_tree(self, digest, strip):
+        """Find the extracted files of an archive in the cache.
+
+        Returns a tuple with the directory that holds the extracted files
+        and the path returned when the archive was extracted, relative to
+        that directory.  Returns None when the archive has not been
+        extracted yet, or when any of the extracted files have been
+        changed since, which can happen when they are hard linked into a
+        droplet, with `FILE_CACHE_EXTRACTED_HARDLINK`, and modified there.
+
+        :param digest: digest of the archive
+        :param strip: if the leading element of the paths was stripped
+
+        """
+        path = self._tree_path(digest, strip)
+        meta = self._load(os.path.join(path, 'tree.json'))
+        if not meta:
+            return None
+        treeDir = os.path.join(path, 'tree')
+        for rel, stat in meta['files'].iteritems():
+            try:
+                st = os.lstat(os.path.join(treeDir, rel))
+            except OSError:
+                st = None
+            if st is None or [st.st_size, st.st_mtime] != stat:
+                self._log.warning('Extracted file [%s] in [%s] has changed, '
+                                  'dropping it from the cache', rel, path)
+                shutil.rmtree(path, ignore_errors=True)
+                self._forget(self._tree_rel(digest, strip))
+                return None
+        self._log.debug('Cache hit for extracted files (%s, %s)',
+                        digest, strip)
+        rel = self._tree_rel(digest, strip)
+        if self._maxBytes and rel not in self._index:
+            # extracted before they were kept in the index
+            self._remember_tree(rel, digest, sum(
+                [stat[0] for stat in meta['files'].values()]))
+        self._touch(rel)
+        return (treeDir, meta['result'])
+
+    def put_tree(self, digest, strip, extract):
+        """Extract an archive into the cache.
+
+        Returns the same tuple as `get_tree`.
+
+        :param digest: digest of the archive
+        :param strip: if the leading element of the paths is stripped
+        :param extract: callable that's given a directory, extracts the
+                        archive into it and returns the extracted path
+
+        """
+        path = self._tree_path(digest, strip)
+        safe_makedirs(os.path.dirname(path))
+        tmpPath = tempfile.mkdtemp(prefix='%s.' % os.path.basename(path),
+                                   dir=os.path.dirname(path))
+        try:
+            treeDir = os.path.join(tmpPath, 'tree')
+            os.makedirs(treeDir)
+            result = os.path.relpath(extract(treeDir), treeDir)
+            files = {}
+            for root, dirs, names in os.walk(treeDir):
+                for name in names + [d for d in dirs
+                                     if os.path.islink(os.path.join(root, d))]:
+                    full = os.path.join(root, name)
+                    st = os.lstat(full)
+                    files[os.path.relpath(full, treeDir)] = [st.st_size,
+                                                             st.st_mtime]
+            self._save(os.path.join(tmpPath, 'tree.json'),
+                       {'result': result, 'files': files})
+            try:
+                os.rename(tmpPath, path)
+                self._remember_tree(self._tree_rel(digest, strip), digest,
+                                    sum([stat[0] for stat in files.values()]))
+            except OSError:
+                self._log.debug('Extracted files for [%s] were already '
+                                'added to the cache', digest)
+        finally:
+            if os.path.exists(tmpPath):
+                shutil.rmtree(tmpPath)
+        self._evict(self._tree_rel(digest, strip))
+        return (os.path.join(path, 'tree'), result)
+
+    def _remember_tree(self, rel, digest, size):
+        """Add extracted files to the index, so they can be evicted"""
+        entry = {
+            'stat': [size],
+            'tree': True,
+            'digest': digest.split()[0],
+            'atime': time.time()
+        }
+
+        def change(index, names):
+            index[rel] = entry
+        self._update(change)
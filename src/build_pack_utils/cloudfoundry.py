@@ -1,23 +1,50 @@
 import os
 import sys
 import json
+import time
 import tempfile
 import shutil
+import hashlib
+import threading
 import utils
 import logging
+from contextlib import contextmanager
 from urlparse import urlparse
+from urllib import url2pathname
 from zips import UnzipUtil
 from hashes import HashUtil
+from hashes import ChecksumManifest
 from cache import DirectoryCacheManager
+from cache import FailureCache
 from downloads import Downloader
+from downloads import DownloadResult
+from downloads import DownloadReport
+from downloads import DownloadError
+from downloads import HashingWriter
+from downloads import TeeReader
 from downloads import CurlDownloader
+from downloads import PooledDownloader
+from downloads import UrlRewriter
+from downloads import AsyncDownloader
 from utils import safe_makedirs
+from utils import link_or_copy
+from utils import link_tree
+from utils import move_tree
 from utils import find_git_url
 from utils import wrap
 
 
 _log = logging.getLogger('cloudfoundry')
 
+# checksum manifests are loaded once per staging, by location
+_manifests = {}
+_manifestsLock = threading.Lock()
+
+
+@contextmanager
+def _unlimited():
+    yield
+
 
 class CloudFoundryUtil(object):
     @staticmethod
@@ -101,7 +128,33 @@ class CloudFoundryInstaller(object):
         self._unzipUtil = UnzipUtil(ctx)
         self._hashUtil = HashUtil(ctx)
         self._dcm = DirectoryCacheManager(ctx)
+        self._failures = FailureCache(ctx)
         self._dwn = self._get_downloader(ctx)(ctx)
+        self.stats = self._dcm.stats
+        self.downloads = DownloadReport()
+        self._rewriter = self._load_rewrites()
+        self._perHost = 0
+        self._hostSlots = {}
+        self._hostSlotsLock = threading.Lock()
+
+    def limit_hosts(self, perHost):
+        """Download from at most `perHost` URLs of the same host at once
+
+        Only the downloads are limited, hashing and extracting the files
+        that were downloaded is not.  Zero means there's no limit.
+        """
+        self._perHost = perHost
+
+    def _host_slot(self, url):
+        """Context manager that holds a download slot of the URL's host"""
+        host = urlparse(url).netloc
+        if not self._perHost or not host:
+            return _unlimited()
+        with self._hostSlotsLock:
+            if host not in self._hostSlots:
+                self._hostSlots[host] = threading.BoundedSemaphore(
+                    self._perHost)
+            return self._hostSlots[host]
 
     def _get_downloader(self, ctx):
         method = ctx.get('DOWNLOAD_METHOD', 'python')
@@ -111,6 +164,12 @@ class CloudFoundryInstaller(object):
         elif method == 'curl':
             self._log.debug('Using cURL downloader.')
             return CurlDownloader
+        elif method == 'pooled':
+            self._log.debug('Using pooled downloader.')
+            return PooledDownloader
+        elif method == 'async':
+            self._log.debug('Using async downloader.')
+            return AsyncDownloader
         elif method == 'custom':
             fullClsName = ctx['DOWNLOAD_CLASS']
             self._log.debug('Using custom downloader [%s].', fullClsName)
@@ -133,48 +192,437 @@ class CloudFoundryInstaller(object):
     def _is_url(self, val):
         return urlparse(val).scheme != ''
 
+    def _load_rewrites(self):
+        """URL rewrite rules set with `DOWNLOAD_URL_REWRITES`.
+
+        The rules are a list of `[pattern, replacement]` pairs, see
+        `UrlRewriter`.  They can be given as a list, as JSON text, from an
+        environment variable for example, or as the path of a file with
+        the rules, relative to the build pack.
+        """
+        rules = self._ctx.get('DOWNLOAD_URL_REWRITES')
+        if not rules:
+            return UrlRewriter()
+        try:
+            if not hasattr(rules, 'strip'):
+                return UrlRewriter(rules)
+            if rules.strip().startswith('['):
+                return UrlRewriter.parse(rules)
+            with open(os.path.join(self._ctx['BP_DIR'], rules), 'rt') as f:
+                return UrlRewriter.parse(f.read())
+        except Exception:
+            self._log.warning("Could not load URL rewrite rules [%s]",
+                              rules, exc_info=True)
+            return UrlRewriter()
+
+    def rewrite_url(self, url):
+        """The URL to download `url` from, see `_load_rewrites`"""
+        newUrl = self._rewriter.rewrite(url)
+        if newUrl != url:
+            self._log.debug("Rewrote [%s] to [%s]", url, newUrl)
+        return newUrl
+
+    def _download_direct(self, url):
+        """Download to memory, reading `file://` URLs directly"""
+        url = self.rewrite_url(url)
+        parts = urlparse(url)
+        if parts.scheme == 'file':
+            with open(url2pathname(parts.path), 'rb') as f:
+                return f.read()
+        with self._host_slot(url):
+            return self._unless_missing(url, self._dwn.download_direct, url)
+
+    def _unless_missing(self, url, fetch, *args):
+        """Call `fetch`, unless `url` is known not to exist.
+
+        A URL that fails with a client error, like a 404, is remembered
+        in the cache, see `FailureCache`, and skipped by later stagings
+        until that expires.
+        """
+        failure = self._failures.get(url)
+        if failure:
+            raise DownloadError(
+                "Skipping [%s], it failed with [%s] %ds ago"
+                % (url, failure['status'], time.time() - failure['time']),
+                failure['status'])
+        try:
+            res = fetch(*args)
+        except Exception, e:
+            self._remember_failure(url, e)
+            raise
+        self._failures.remove(url)
+        return res
+
+    def _remember_failure(self, url, e):
+        code = getattr(e, 'code', None)
+        if code and 400 <= code < 500 and code not in (408, 429):
+            self._failures.add(url, code)
+
+    def download_digests(self, urls):
+        """Download many hash files at once, if the downloader can.
+
+        Returns a dict of each URL to its digest, for the ones that were
+        downloaded.  URLs known not to exist are skipped.
+        """
+        if not hasattr(self._dwn, 'download_direct_many'):
+            return {}
+        urls = [url for url in urls
+                if not self._failures.get(self.rewrite_url(url))]
+        results = self._dwn.download_direct_many([self.rewrite_url(url)
+                                                  for url in urls])
+        digests = {}
+        for url, (digest, excInfo) in zip(urls, results):
+            if excInfo:
+                self._log.debug("Could not download digest [%s] [%s]",
+                                url, excInfo[1])
+                self._remember_failure(self.rewrite_url(url), excInfo[1])
+            else:
+                digests[url] = digest
+        return digests
+
+    def _link_local(self, url, toFile):
+        """Link or copy the file at a `file://` URL, instead of reading it"""
+        start = time.time()
+        how = link_or_copy(url2pathname(urlparse(url).path), toFile)
+        self._log.debug("Used [%s] to get [%s]", how, url)
+        return DownloadResult(url, toFile, os.path.getsize(toFile), None,
+                              {'total': time.time() - start})
+
     def install_binary_direct(self, url, hsh, installDir,
                               fileName=None, strip=False,
-                              extract=True):
+                              extract=True, mirrors=None):
         self._log.debug("Installing direct [%s]", url)
         if not fileName:
             fileName = urlparse(url).path.split('/')[-1]
-        if self._is_url(hsh):
-            digest = self._dwn.download_direct(hsh)
-        else:
-            digest = hsh
+        digest = self._resolve_digest(url, hsh, fileName)
+        url = self.rewrite_url(url)
+        mirrors = [self.rewrite_url(mirror) for mirror in mirrors or []]
         self._log.debug(
             "Installing [%s] with digest [%s] into [%s] with "
             "name [%s] stripping [%s]",
             url, digest, installDir, fileName, strip)
-        fileToInstall = self._dcm.get(fileName, digest)
-        if fileToInstall is None:
-            self._log.debug('File [%s] not in cache.', fileName)
-            fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
-            self._dwn.download(url, fileToInstall)
-            digest = self._hashUtil.calculate_hash(fileToInstall)
-            fileToInstall = self._dcm.put(fileName, fileToInstall, digest)
+        if extract and not mirrors and \
+                self._ctx.get('INSTALL_PIPELINE', False):
+            if self._pipeline(url, digest, fileName, installDir, strip):
+                return installDir
+        fileToInstall, digest = self._get_or_download(url, digest, fileName,
+                                                      mirrors)
         if extract:
-            return self._unzipUtil.extract(fileToInstall,
-                                           installDir,
-                                           strip)
+            return self._extract(fileToInstall, digest, installDir, strip)
+        elif self._ctx.get('FILE_CACHE_LAYOUT', 'name') == 'content':
+            toFile = installDir
+            if os.path.isdir(installDir):
+                toFile = os.path.join(installDir, fileName)
+            # never share the blob's inode, the droplet may change the file
+            self._log.debug("Installed [%s] with [%s]", toFile,
+                            link_or_copy(fileToInstall, toFile,
+                                         hardlink=False))
+            return installDir
         else:
             shutil.copy(fileToInstall, installDir)
             return installDir
 
-    def install_binary(self, installKey):
-        self._log.debug('Installing [%s]', installKey)
+    def _resolve_digest(self, url, hsh, fileName):
+        """The digest `hsh` or, when it's a URL, the digest it points to.
+
+        A digest listed in the checksum manifest is used before the
+        hash file is downloaded.
+        """
+        if not self._is_url(hsh):
+            return hsh
+        manifest = self._manifest()
+        return (manifest.get(fileName) or
+                manifest.get(urlparse(url).path.split('/')[-1]) or
+                self._download_direct(hsh))
+
+    def cache_binary(self, url, hsh, fileName=None, mirrors=None):
+        """Download a file into the cache, without installing it.
+
+        The digest is found the way `install_binary_direct` finds it and
+        the file must match it, otherwise it's removed from the cache and
+        a RuntimeError is raised.  Returns the cached file and its digest.
+        """
+        if not fileName:
+            fileName = urlparse(url).path.split('/')[-1]
+        digest = self._resolve_digest(url, hsh, fileName)
+        fileToCache, actual = self._get_or_download(
+            self.rewrite_url(url), digest, fileName,
+            [self.rewrite_url(mirror) for mirror in mirrors or []])
+        expected = digest and digest.split()[0]
+        if expected and expected != actual.split()[0]:
+            self._dcm.delete(fileName)
+            raise RuntimeError("Digest of [%s] is [%s], expected [%s]"
+                               % (url, actual, expected))
+        return (fileToCache, actual)
+
+    def cache_binaries(self, binaries):
+        """Download many files into the cache at once, if the downloader can.
+
+        `binaries` are `(url, hsh)` pairs, the digest is found the way
+        `install_binary_direct` finds it.  Files that are cached already,
+        `file://` URLs and URLs known not to exist are skipped.  This is
+        only a head start, a file that can't be downloaded this way or
+        doesn't match its digest is left out and downloaded again when
+        it's installed.  The batch isn't limited by `limit_hosts`.
+        """
+        if not hasattr(self._dwn, 'download_many'):
+            return
+        wanted = []
+        for url, hsh in binaries:
+            fileName = urlparse(url).path.split('/')[-1]
+            try:
+                digest = self._resolve_digest(url, hsh, fileName)
+            except Exception, e:
+                self._log.debug("Could not find the digest of [%s] [%s]",
+                                url, e)
+                continue
+            url = self.rewrite_url(url)
+            if (not digest or urlparse(url).scheme == 'file' or
+                    self._failures.get(url) or
+                    self._dcm.exists(fileName, digest)):
+                continue
+            spool = self._dcm.spool_path(fileName)
+            if spool:
+                wanted.append((url, digest, fileName, spool))
+        if not wanted:
+            return
+        results = self._dwn.download_many([(item[0], item[3])
+                                           for item in wanted])
+        for (url, digest, fileName, spool), (res, excInfo) in zip(wanted,
+                                                                  results):
+            if excInfo:
+                self._log.debug("Could not download [%s] [%s]",
+                                url, excInfo[1])
+                self._remember_failure(url, excInfo[1])
+                continue
+            self.stats.add('bytesDownloaded', res.size)
+            self.downloads.add(res)
+            actual = res.digest or self._hashUtil.calculate_hash(spool)
+            if actual != digest.split()[0]:
+                self._log.warning("Digest of [%s] is [%s], expected [%s]",
+                                  url, actual, digest)
+                os.remove(spool)
+                continue
+            with self._dcm.lock(fileName):
+                if self._dcm.put(fileName, spool, digest, move=True) == spool:
+                    os.remove(spool)
+
+    def _load_manifest(self, location):
+        if self._is_url(location):
+            text = self._download_direct(location)
+        else:
+            with open(location, 'rt') as f:
+                text = f.read()
+        manifest = ChecksumManifest(text)
+        size = hashlib.new(self._ctx['CACHE_HASH_ALGORITHM']).digest_size
+        if any(len(d) != size * 2 for d in manifest.digests()):
+            self._log.warning(
+                "Checksum manifest [%s] does not use [%s], ignoring it",
+                location, self._ctx['CACHE_HASH_ALGORITHM'])
+            return ChecksumManifest()
+        self._log.info("Loaded [%d] digests from [%s]",
+                       len(manifest), location)
+        return manifest
+
+    def _manifest(self):
+        """Checksum manifest set with `CACHE_HASH_MANIFEST`.
+
+        The manifest lists the digests of many files, so one manifest can
+        replace a hash file download per package.  It's either a URL,
+        fetched once per staging, or a path relative to the build pack.
+        """
+        location = self._ctx.get('CACHE_HASH_MANIFEST')
+        if not location:
+            return ChecksumManifest()
+        if not self._is_url(location):
+            location = os.path.join(self._ctx['BP_DIR'], location)
+        with _manifestsLock:
+            if location not in _manifests:
+                try:
+                    _manifests[location] = self._load_manifest(location)
+                except Exception:
+                    self._log.warning(
+                        "Could not load checksum manifest [%s]", location,
+                        exc_info=True)
+                    _manifests[location] = ChecksumManifest()
+            return _manifests[location]
+
+    def _get_or_download(self, url, digest, fileName, mirrors=None):
+        """Find a file in the cache, downloading and caching it on a miss
+
+        The key is locked while this happens, so stagers sharing the cache
+        wait for each other instead of downloading the same file again.
+        Returns the path to the file and its digest.  A download that
+        doesn't match `digest` is removed, never cached, and a
+        RuntimeError is raised.
+        """
+        with self._dcm.lock(fileName):
+            fileToInstall = self._dcm.get(fileName, digest)
+            if fileToInstall is not None:
+                return (fileToInstall, digest)
+            self._log.debug('File [%s] not in cache.', fileName)
+            fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
+            expected = digest and digest.split()[0]
+            if urlparse(url).scheme == 'file':
+                res = self._link_local(url, fileToInstall)
+            else:
+                with self._host_slot(url):
+                    res = self._fetch(url, fileToInstall, expected, mirrors)
+            if isinstance(res, DownloadResult) and res.digest:
+                digest = res.digest
+            else:
+                digest = self._hashUtil.calculate_hash(fileToInstall)
+            if isinstance(res, DownloadResult):
+                self.stats.add('bytesDownloaded', res.size)
+                self.downloads.add(res)
+            elif os.path.exists(fileToInstall):
+                self.stats.add('bytesDownloaded',
+                               os.path.getsize(fileToInstall))
+            if expected and expected != digest:
+                if os.path.exists(fileToInstall):
+                    os.remove(fileToInstall)
+                raise RuntimeError("Digest of [%s] is [%s], expected [%s]"
+                                   % (url, digest, expected))
+            return (self._dcm.put(fileName, fileToInstall, digest), digest)
+
+    def _fetch(self, url, toFile, expected, mirrors):
+        """Download `url`, or one of its mirrors, into `toFile`"""
+        if mirrors and hasattr(self._dwn, 'download_mirrors'):
+            return self._unless_missing(
+                url, self._dwn.download_mirrors, [url] + list(mirrors),
+                toFile, expected)
+        if isinstance(self._dwn, (Downloader, CurlDownloader)):
+            # lets a partial download be checked before it's resumed
+            return self._unless_missing(url, self._dwn.download, url,
+                                        toFile, expected)
+        return self._unless_missing(url, self._dwn.download, url, toFile)
+
+    def _pipeline(self, url, digest, fileName, installDir, strip):
+        """Download, hash, cache and extract a tar archive all at once
+
+        With `INSTALL_PIPELINE` set, the download is extracted as it
+        arrives, into a staging directory next to `installDir`, while the
+        digest is calculated and the archive is written to the cache.
+        Only when the digest matches is the staging directory moved into
+        `installDir`, otherwise nothing is installed.
+
+        Returns False when the archive can't be installed this way, it's
+        cached already or it's not a tar archive for example, and it
+        should be installed as usual.
+        """
+        algorithm = self._ctx.get('CACHE_HASH_ALGORITHM')
+        if (not algorithm or not isinstance(self._dwn, Downloader) or
+                self._ctx.get('FILE_CACHE_EXTRACTED', False) or
+                not fileName.endswith(('.tar.gz', '.tgz', '.tar.bz2',
+                                       '.tar'))):
+            return False
+        expected = digest and digest.split()[0]
+        with self._dcm.lock(fileName):
+            if digest and self._dcm.exists(fileName, digest):
+                return False
+            parentDir = os.path.dirname(os.path.abspath(installDir))
+            safe_makedirs(parentDir)
+            stagingDir = tempfile.mkdtemp(prefix='.staging-', dir=parentDir)
+            spool = self._dcm.spool_path(fileName)
+            try:
+                # the extraction paces the download, it holds the slot too
+                with self._host_slot(url):
+                    start = time.time()
+                    res = self._dwn._open(url)
+                    timings = dict(getattr(res, 'timings', None) or {},
+                                   firstByte=time.time() - start)
+                    try:
+                        with open(spool or os.devnull, 'wb') as f:
+                            out = HashingWriter(f, algorithm)
+                            tee = TeeReader(res, out)
+                            self._unzipUtil.extract_stream(tee, stagingDir,
+                                                           strip)
+                            tee.drain()
+                    finally:
+                        res.close()
+            except Exception:
+                self._log.warning("Could not stream [%s], downloading it "
+                                  "instead", url, exc_info=True)
+                self._discard(stagingDir, spool)
+                return False
+            digest = out.hexdigest()
+            self.stats.add('bytesDownloaded', out.size)
+            timings['total'] = time.time() - start
+            self.downloads.add(DownloadResult(url, installDir, out.size,
+                                              digest, timings))
+            if expected and expected != digest:
+                self._discard(stagingDir, spool)
+                raise RuntimeError("Digest of [%s] is [%s], expected [%s]"
+                                   % (url, digest, expected))
+            move_tree(stagingDir, installDir)
+            self._log.info("Installed [%s] into [%s] as it downloaded",
+                           url, installDir)
+            if spool and self._dcm.put(fileName, spool, digest,
+                                       move=True) == spool:
+                os.remove(spool)
+        return True
+
+    def _discard(self, stagingDir, spool):
+        shutil.rmtree(stagingDir, ignore_errors=True)
+        if spool and os.path.exists(spool):
+            os.remove(spool)
+
+    def _extract(self, fileToInstall, digest, installDir, strip):
+        """Extract an archive, reusing the cached files when enabled
+
+        With `FILE_CACHE_EXTRACTED` set, archives are extracted once into
+        the cache and then reflinked or copied into `installDir`, see
+        `DirectoryCacheManager.get_tree`.  Set
+        `FILE_CACHE_EXTRACTED_HARDLINK` to hard link them instead, only
+        when nothing writes to the installed files, because every droplet
+        shares them with the cache.
+        """
+        if not self._ctx.get('FILE_CACHE_EXTRACTED', False):
+            return self._unzipUtil.extract(fileToInstall, installDir, strip)
+        tree = self._dcm.get_tree(digest, strip)
+        if tree is None:
+            tree = self._dcm.put_tree(
+                digest, strip,
+                lambda intoDir: self._unzipUtil.extract(fileToInstall,
+                                                        intoDir, strip))
+        treeDir, result = tree
+        self._log.debug("Linking extracted files from [%s] into [%s]",
+                        treeDir, installDir)
+        link_tree(treeDir, installDir,
+                  self._ctx.get('FILE_CACHE_EXTRACTED_HARDLINK', False))
+        return os.path.normpath(os.path.join(installDir, result))
+
+    def binary_urls(self, installKey):
+        """The URL, hash URL and mirrors of the package `installKey`"""
         url = self._ctx['%s_DOWNLOAD_URL' % installKey]
         hashUrl = self._ctx.get(
             '%s_HASH_DOWNLOAD_URL' % installKey,
             "%s.%s" % (url, self._ctx['CACHE_HASH_ALGORITHM']))
+        return (url, hashUrl,
+                self._ctx.get('%s_DOWNLOAD_MIRRORS' % installKey))
+
+    def install_binary(self, installKey):
+        self._log.debug('Installing [%s]', installKey)
+        url, hashUrl, mirrors = self.binary_urls(installKey)
         installDir = os.path.join(self._ctx['BUILD_DIR'],
                                   self._ctx.get(
                                       '%s_PACKAGE_INSTALL_DIR' % installKey,
                                       installKey.lower()))
         strip = self._ctx.get('%s_STRIP' % installKey, False)
         return self.install_binary_direct(url, hashUrl, installDir,
-                                          strip=strip)
+                                          strip=strip, mirrors=mirrors)
+
+    def save_stats(self):
+        """Add the cache counters to `.bp/logs/cache-stats.json`
+
+        and a record of each download, with its timings, to
+        `.bp/logs/download-report.json`.  The times cached files were
+        used are saved to the cache too.
+        """
+        self._dcm.flush()
+        logsDir = os.path.join(self._ctx['BUILD_DIR'], '.bp', 'logs')
+        self.stats.flush(os.path.join(logsDir, 'cache-stats.json'))
+        self.downloads.flush(os.path.join(logsDir, 'download-report.json'))
 
     def _install_from(self, fromPath, fromLoc, toLocation=None, ignore=None):
         """Copy file or directory from a location to the droplet
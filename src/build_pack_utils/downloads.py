@@ -1,12 +1,529 @@
+import os
+import sys
+import copy
+import Queue
+import shutil
+import tempfile
+import ssl
+import time
+import errno
+import random
+import json
+import asyncore
 import urllib2
+import httplib
+import socket
+import base64
+import hashlib
 import re
 import logging
+import threading
+from collections import defaultdict
+from functools import partial
+from StringIO import StringIO
+from io import BytesIO
+from urlparse import urlparse
+from urlparse import urljoin
+from utils import run_parallel
+from utils import safe_makedirs
+from utils import file_lock
 from subprocess import Popen
 from subprocess import PIPE
 
 
+class DownloadResult(object):
+    """Details about a file that was downloaded.
+
+    When the downloader knows the `CACHE_HASH_ALGORITHM`, `digest` is
+    the hex digest of the file, calculated while it was downloaded.
+
+    `timings` holds the seconds, since the request was started, until
+    each phase of it was done, like curl reports them: `dns`, `connect`,
+    `tls` and `firstByte`.  Phases the downloader can't see, or that
+    weren't needed because a connection was used again, are left out.
+    `total` is how long the whole download took, retries included.
+    """
+
+    PHASES = ('dns', 'connect', 'tls', 'firstByte', 'total')
+
+    def __init__(self, url, toFile, size=0, digest=None, timings=None):
+        self.url = url
+        self.toFile = toFile
+        self.size = size
+        self.digest = digest
+        self.timings = timings or {}
+
+    @property
+    def throughput(self):
+        """Bytes per second, or None when the time isn't known"""
+        if self.timings.get('total'):
+            return self.size / self.timings['total']
+
+    def as_dict(self):
+        return {'url': self.url,
+                'toFile': self.toFile,
+                'size': self.size,
+                'digest': self.digest,
+                'timings': dict(self.timings),
+                'throughput': self.throughput}
+
+
+class DownloadReport(object):
+    """Collects a record of each download, for the staging report"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    def add(self, result):
+        with self._lock:
+            self._records.append(result.as_dict())
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def flush(self, path):
+        """Add the records to the ones saved in `path` and forget them
+
+        Nothing is written when there aren't any records.
+        """
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return
+        safe_makedirs(os.path.dirname(path))
+        with file_lock('%s.lock' % path):
+            try:
+                with open(path, 'rt') as f:
+                    saved = json.load(f)
+            except (IOError, ValueError):
+                saved = []
+            tmpPath = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmpPath, 'wt') as f:
+                json.dump(saved + records, f, indent=2, sort_keys=True)
+            os.rename(tmpPath, path)
+
+
+class HashingWriter(object):
+    """Write to a file, while calculating the digest of what's written."""
+
+    def __init__(self, out, algorithm=None):
+        self._out = out
+        self._hsh = algorithm and hashlib.new(algorithm) or None
+        self.size = 0
+
+    def write(self, buf):
+        self._out.write(buf)
+        if self._hsh:
+            self._hsh.update(buf)
+        self.size += len(buf)
+
+    def resume(self, f, size):
+        """Count the first `size` bytes of `f`, without writing them.
+
+        Leaves `f` positioned after those bytes, anything after them is
+        dropped.
+        """
+        f.seek(0)
+        while self.size < size:
+            buf = f.read(min(size - self.size, 256 * 1024))
+            if not buf:
+                break
+            if self._hsh:
+                self._hsh.update(buf)
+            self.size += len(buf)
+        f.truncate(self.size)
+
+    def hexdigest(self):
+        return self._hsh and self._hsh.hexdigest() or None
+
+
+class TeeReader(object):
+    """Read from a stream, writing everything that's read to `out`."""
+
+    def __init__(self, stream, out):
+        self._stream = stream
+        self._out = out
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            buf = self._stream.read()
+        else:
+            buf = self._stream.read(size)
+        self._out.write(buf)
+        return buf
+
+    def drain(self, size=256 * 1024):
+        """Read the rest of the stream"""
+        for buf in iter(partial(self.read, size), ''):
+            pass
+
+
+class DownloadError(RuntimeError):
+    """The server answered a download with an HTTP error status."""
+
+    def __init__(self, msg, code):
+        RuntimeError.__init__(self, msg)
+        self.code = code
+
+
+class UrlRewriter(object):
+    """Rewrite URLs with an ordered table of rules.
+
+    Each rule is a `(pattern, replacement)` pair.  A pattern that starts
+    with `^` is a regular expression and the replacement can refer to
+    its groups, like `\\1`.  Any other pattern is a prefix of the URL,
+    which is replaced.  The first rule that matches is used.
+    """
+
+    def __init__(self, rules=()):
+        self._rules = []
+        for pattern, replacement in rules:
+            if pattern.startswith('^'):
+                self._rules.append((re.compile(pattern), replacement))
+            else:
+                self._rules.append((pattern, replacement))
+
+    @staticmethod
+    def parse(text):
+        """Rules from a JSON list of pairs, or lines of `pattern target`
+
+        Blank lines and lines starting with `#` are skipped.
+        """
+        if text.strip().startswith('['):
+            return UrlRewriter(json.loads(text))
+        rules = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rules.append(line.split(None, 1))
+        return UrlRewriter(rules)
+
+    def rewrite(self, url):
+        for pattern, replacement in self._rules:
+            if hasattr(pattern, 'match'):
+                if pattern.match(url):
+                    return pattern.sub(replacement, url, 1)
+            elif url.startswith(pattern):
+                return replacement + url[len(pattern):]
+        return url
+
+    def __len__(self):
+        return len(self._rules)
+
+
+class DownloadCancelled(Exception):
+    """A download was stopped, because another one made it unneeded."""
+
+
+class Request(urllib2.Request):
+    """A urllib2 request that can use any method, like HEAD."""
+
+    def __init__(self, url, headers=None, method='GET'):
+        urllib2.Request.__init__(self, url, headers=headers or {})
+        self._method = method
+
+    def get_method(self):
+        return self._method
+
+
+def _timed_create_connection(dns, timings, start):
+    """A `create_connection` that notes when DNS and connect were done"""
+    def create(address, *args):
+        dns.resolve(*address)
+        timings['dns'] = time.time() - start
+        sock = dns.create_connection(address, *args)
+        timings['connect'] = time.time() - start
+        return sock
+    return create
+
+
+def _timed_do_open(handler, http_class, req, connArgs):
+    """Open `req` like urllib2 does, timing how the connection was made.
+
+    The response gets a `timings` dict, with the phases of
+    `DownloadResult`, counted from when the connection was created.
+    """
+    timings = {}
+    start = time.time()
+
+    def connection(host, **kwargs):
+        conn = http_class(host, **kwargs)
+        conn._create_connection = _timed_create_connection(
+            DnsCache(), timings, start)
+        connect = conn.connect
+
+        def timed_connect():
+            connect()
+            if isinstance(conn, httplib.HTTPSConnection):
+                timings['tls'] = time.time() - start
+        conn.connect = timed_connect
+        return conn
+    res = urllib2.AbstractHTTPHandler.do_open(handler, connection, req,
+                                              **connArgs)
+    res.timings = timings
+    return res
+
+
+class _TimedHTTPHandler(urllib2.HTTPHandler):
+    """An `HTTPHandler` that times DNS and connect, see `_timed_do_open`"""
+
+    def do_open(self, http_class, req, **connArgs):
+        return _timed_do_open(self, http_class, req, connArgs)
+
+
+class _TimedHTTPSHandler(urllib2.HTTPSHandler):
+    """An `HTTPSHandler` that times DNS, connect and TLS too"""
+
+    def do_open(self, http_class, req, **connArgs):
+        return _timed_do_open(self, http_class, req, connArgs)
+
+
+def _chunk_size(ctx):
+    return int(ctx.get('DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+
+
+def _retryable(e):
+    code = getattr(e, 'code', None)
+    if code:
+        return code >= 500 or code in (408, 429)
+    return isinstance(e, (urllib2.URLError, httplib.HTTPException, IOError))
+
+
+def _retry_delay(ctx, log, url, attempt, e):
+    """Seconds to wait before the next attempt at a failed download.
+
+    Returns None when the download shouldn't be tried again, because
+    the error is permanent or `DOWNLOAD_RETRIES` have been used.  The
+    delay doubles after each attempt, starting at `DOWNLOAD_RETRY_DELAY`
+    seconds up to `DOWNLOAD_RETRY_MAX_DELAY`, and a random part of it is
+    used so stagers don't retry in lock step.
+    """
+    if attempt >= int(ctx.get('DOWNLOAD_RETRIES', 0)) or not _retryable(e):
+        return None
+    delay = min(float(ctx.get('DOWNLOAD_RETRY_MAX_DELAY', 30)),
+                float(ctx.get('DOWNLOAD_RETRY_DELAY', 1)) * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    log.warning('Download of [%s] failed [%s], retrying in %.1fs',
+                url, e, delay)
+    return delay
+
+
+def _wait_to_retry(ctx, log, url, attempt, e):
+    """Sleep before the next attempt at a failed download.
+
+    Returns False when the download shouldn't be tried again, see
+    `_retry_delay`.
+    """
+    delay = _retry_delay(ctx, log, url, attempt, e)
+    if delay is None:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def _proxy_headers(proxy):
+    """Headers that authenticate with a parsed proxy URL, if needed"""
+    if proxy.username:
+        creds = '%s:%s' % (proxy.username, proxy.password or '')
+        return {'Proxy-Authorization':
+                'Basic %s' % base64.b64encode(creds)}
+    return {}
+
+
+def _download(dwn, url, toFile, digest=None):
+    """Download to a partial file, then rename it to `toFile`.
+
+    When an attempt fails, the next one continues from the end of the
+    partial file.  A partial file left by an earlier call is only
+    continued when the expected `digest` is known, and the result is
+    thrown away and downloaded again if it doesn't match.  `dwn` is the
+    downloader, its `_fetch` method makes a single attempt.
+    """
+    ctx = dwn._ctx
+    partFile = toFile + '.part'
+    verify = digest and ctx.get('CACHE_HASH_ALGORITHM')
+    if not verify and os.path.exists(partFile):
+        os.remove(partFile)
+    state = {}
+    attempt = 0
+    started = time.time()
+    while True:
+        offset = os.path.exists(partFile) and os.path.getsize(partFile) or 0
+        try:
+            out, start = dwn._fetch(url, partFile, offset, state)
+        except Exception, e:
+            if offset and getattr(e, 'code', None) == 416:
+                dwn._log.debug('Can not resume [%s], starting over', url)
+                os.remove(partFile)
+                continue
+            if not _wait_to_retry(ctx, dwn._log, url, attempt, e):
+                raise
+            attempt += 1
+            continue
+        if start and verify and out.hexdigest() != digest:
+            dwn._log.warning('Resumed download of [%s] does not match [%s],'
+                             ' starting over', url, digest)
+            os.remove(partFile)
+            continue
+        break
+    os.rename(partFile, toFile)
+    if start:
+        dwn._log.debug('Resumed [%s] at [%d] bytes', url, start)
+    timings = dict(state.get('timings', {}), total=time.time() - started)
+    print 'Downloaded [%s] to [%s] (%d bytes)' % (url, toFile, out.size)
+    dwn._log.info('Downloaded [%s] to [%s] (%d bytes) in %.3fs',
+                  url, toFile, out.size, timings['total'])
+    return DownloadResult(url, toFile, out.size, out.hexdigest(), timings)
+
+
+def _probe(dwn, url):
+    """Seconds it takes the server to answer a HEAD request for `url`"""
+    start = time.time()
+    res = dwn._open(url, method='HEAD')
+    try:
+        res.read()
+    finally:
+        res.close()
+    return time.time() - start
+
+
+def _rank(dwn, urls):
+    """Order mirrors by how fast they answer a probe, see `_probe`.
+
+    The probes run at the same time, for up to
+    `DOWNLOAD_MIRROR_PROBE_TIMEOUT` seconds (default 1).  Mirrors that
+    answered come first, fastest first, then the ones that are still
+    probing, in their order, and the ones that failed last.
+    """
+    budget = float(dwn._ctx.get('DOWNLOAD_MIRROR_PROBE_TIMEOUT', 1))
+    answers = Queue.Queue()
+
+    def probe(i):
+        try:
+            answers.put((i, _probe(dwn, urls[i]), None))
+        except Exception, e:
+            answers.put((i, None, e))
+    for i in xrange(len(urls)):
+        thread = threading.Thread(target=probe, args=(i,))
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + budget
+    probes = {}
+    while len(probes) < len(urls) and time.time() < deadline:
+        try:
+            answered, latency, e = answers.get(
+                timeout=deadline - time.time())
+        except Queue.Empty:
+            break
+        probes[answered] = (e is None and 0 or 2, latency)
+    ranked = sorted((probes.get(i, (1, None)), i) for i in xrange(len(urls)))
+    dwn._log.debug('Mirrors answered in [%s]',
+                   ', '.join('%s: %s' % (urls[i], latency)
+                             for (order, latency), i in ranked))
+    return [urls[i] for order, i in ranked]
+
+
+def _has_data(toFile):
+    """True once a download to `toFile` has written anything"""
+    for path in (toFile + '.part', toFile):
+        try:
+            if os.path.getsize(path):
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def _race(dwn, urls, toFile, digest=None):
+    """Download the same file from one of several mirrors.
+
+    The mirrors are probed with a HEAD request, unless
+    `DOWNLOAD_MIRROR_PROBE` is false, and tried fastest first, see
+    `_rank`.  When a download hasn't written a byte within
+    `DOWNLOAD_HEDGE_DELAY` seconds, the next mirror is started too.  A
+    failed download, or one that doesn't match `digest`, moves on to the
+    next mirror.  The first download that finishes and matches wins,
+    the others are cancelled.
+    """
+    ctx = dwn._ctx
+    urls = list(urls)
+    if (len(urls) > 1 and hasattr(dwn, '_open') and
+            ctx.get('DOWNLOAD_MIRROR_PROBE', True)):
+        urls = _rank(dwn, urls)
+    verify = digest and ctx.get('CACHE_HASH_ALGORITHM')
+    budget = float(ctx.get('DOWNLOAD_HEDGE_DELAY', 2))
+    finished = Queue.Queue()
+    running = {}
+
+    def start(i):
+        tmpFile = '%s.mirror%d' % (toFile, i)
+        racer = copy.copy(dwn)
+        racer._cancel = threading.Event()
+
+        def run():
+            try:
+                res = racer.download(urls[i], tmpFile, digest)
+            except Exception:
+                res, excInfo = None, sys.exc_info()
+            else:
+                excInfo = None
+            if excInfo or racer._cancel.is_set():
+                for path in (tmpFile, tmpFile + '.part'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            finished.put((i, res, excInfo))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        running[i] = (racer._cancel, tmpFile, time.time())
+        thread.start()
+
+    nextUrl = 0
+    winner = excInfo = None
+    while winner is None and (running or nextUrl < len(urls)):
+        if not running:
+            start(nextUrl)
+            nextUrl += 1
+        try:
+            i, res, failure = finished.get(timeout=0.05)
+        except Queue.Empty:
+            latest = max(running)
+            cancel, tmpFile, started = running[latest]
+            if (nextUrl < len(urls) and time.time() - started > budget and
+                    not _has_data(tmpFile)):
+                dwn._log.info('No data from [%s] after %.1fs, also trying '
+                              '[%s]', urls[latest], budget, urls[nextUrl])
+                start(nextUrl)
+                nextUrl += 1
+            continue
+        del running[i]
+        if failure:
+            dwn._log.warning('Download from mirror [%s] failed [%s]',
+                             urls[i], failure[1])
+            excInfo = failure
+        elif verify and res.digest != digest:
+            dwn._log.warning('Digest of [%s] is [%s], expected [%s]',
+                             urls[i], res.digest, digest)
+            os.remove(res.toFile)
+            excInfo = (IOError, IOError('No mirror of [%s] matches [%s]'
+                                        % (toFile, digest)), None)
+        else:
+            winner = res
+    for cancel, tmpFile, started in running.values():
+        cancel.set()
+    if winner is None:
+        raise excInfo[0], excInfo[1], excInfo[2]
+    os.rename(winner.toFile, toFile)
+    winner.toFile = toFile
+    return winner
+
+
 class Downloader(object):
 
+    # set to cancel the download that's in progress
+    _cancel = None
+
     def __init__(self, config):
         self._ctx = config
         self._log = logging.getLogger('downloads')
@@ -18,63 +535,1009 @@ class Downloader(object):
             if key.lower().endswith('_proxy'):
                 handlers[key.split('_')[0]] = self._ctx[key]
         self._log.debug('Loaded proxy handlers [%s]', handlers)
-        openers = []
+        self._proxies = handlers
+        openers = [_TimedHTTPHandler(), _TimedHTTPSHandler()]
         if handlers:
             openers.append(urllib2.ProxyHandler(handlers))
             for handler in handlers.values():
                 if '@' in handler:
                     openers.append(urllib2.ProxyBasicAuthHandler())
-            opener = urllib2.build_opener(*openers)
-            urllib2.install_opener(opener)
+        self._opener = urllib2.build_opener(*openers)
+
+    def _open(self, url, headers=None, method='GET'):
+        return self._opener.open(Request(url, headers, method))
+
+    def _copy(self, res, out):
+        """Copy the response to a file, one chunk at a time.
+
+        Only `DOWNLOAD_CHUNK_SIZE` bytes are held in memory.
+        """
+        for buf in iter(partial(res.read, _chunk_size(self._ctx)), ''):
+            self._check_cancelled()
+            out.write(buf)
+
+    def _check_cancelled(self):
+        if self._cancel is not None and self._cancel.is_set():
+            raise DownloadCancelled('Download cancelled')
+
+    def _fetch(self, url, partFile, offset, state):
+        """Download `url` into `partFile`, continuing at `offset`.
+
+        Returns the writer and the offset the download really started at,
+        which is zero when the server sent the whole file.
+        """
+        if not offset and int(self._ctx.get('DOWNLOAD_SEGMENTS', 1)) > 1:
+            size = self._segmentable(url, state)
+            if size:
+                return self._fetch_segments(url, partFile, size, state), 0
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            if state.get('validator'):
+                headers['If-Range'] = state['validator']
+        start = time.time()
+        res = self._open(url, headers)
+        try:
+            timings = dict(getattr(res, 'timings', None) or {})
+            timings['firstByte'] = time.time() - start
+            info = res.info()
+            if res.getcode() != 206:
+                offset = 0
+            state['validator'] = (info.getheader('ETag') or
+                                  info.getheader('Last-Modified'))
+            length = info.getheader('Content-Length')
+            with open(partFile, offset and 'r+b' or 'wb') as f:
+                out = HashingWriter(f, self._ctx.get('CACHE_HASH_ALGORITHM'))
+                out.resume(f, offset)
+                self._copy(res, out)
+        finally:
+            res.close()
+        if length and out.size - offset < int(length):
+            raise httplib.IncompleteRead(
+                '', int(length) - out.size + offset)
+        state['timings'] = timings
+        return out, offset
+
+    def _segmentable(self, url, state):
+        """Size of the file, if it should be downloaded in segments.
+
+        That's when the server accepts byte ranges and the file is at
+        least `DOWNLOAD_SEGMENT_THRESHOLD` bytes.  Otherwise, returns 0,
+        also when the `HEAD` request fails, many servers refuse it.
+        """
+        if urlparse(url).scheme not in ('http', 'https'):
+            return 0
+        try:
+            res = self._open(url, method='HEAD')
+            try:
+                info = res.info()
+                res.read()
+            finally:
+                res.close()
+            size = int(info.getheader('Content-Length') or 0)
+        except (IOError, httplib.HTTPException, ValueError), e:
+            self._log.debug("Could not probe [%s], downloading it in one "
+                            "piece [%s]", url, e)
+            return 0
+        if (info.getheader('Accept-Ranges', '').strip() != 'bytes' or
+                size < int(self._ctx.get('DOWNLOAD_SEGMENT_THRESHOLD',
+                                         64 * 1024 * 1024))):
+            return 0
+        state['validator'] = (info.getheader('ETag') or
+                              info.getheader('Last-Modified'))
+        return size
 
-    def download(self, url, toFile):
-        res = urllib2.urlopen(url)
-        with open(toFile, 'w') as f:
-            f.write(res.read())
-        print 'Downloaded [%s] to [%s]' % (url, toFile)
-        self._log.info('Downloaded [%s] to [%s]', url, toFile)
+    def _fetch_range(self, url, partFile, start, end, state):
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if state.get('validator'):
+            headers['If-Range'] = state['validator']
+        res = self._open(url, headers)
+        try:
+            if res.getcode() != 206:
+                raise IOError('Server did not send the range [%d-%d] of [%s]'
+                              % (start, end, url))
+            with open(partFile, 'r+b') as f:
+                f.seek(start)
+                out = HashingWriter(f)
+                self._copy(res, out)
+        finally:
+            res.close()
+        if out.size != end - start + 1:
+            raise httplib.IncompleteRead('', end - start + 1 - out.size)
+
+    def _fetch_segments(self, url, partFile, size, state):
+        """Download `DOWNLOAD_SEGMENTS` byte ranges at the same time.
+
+        The ranges are written into a file of the full size, a segment
+        that fails is retried on its own.  That file has holes until all
+        segments are done, so it's kept apart from `partFile`, which must
+        only hold a prefix of the download to be resumed.  It's renamed
+        once all are done, or removed if a segment fails for good.  Then
+        the file is read once to calculate the digest.
+        """
+        count = int(self._ctx['DOWNLOAD_SEGMENTS'])
+        segment = (size + count - 1) / count
+        ranges = [(start, min(start + segment, size) - 1)
+                  for start in xrange(0, size, segment)]
+        segFile = partFile + '.segments'
+        with open(segFile, 'wb') as f:
+            f.truncate(size)
+
+        def fetch(rng):
+            attempt = 0
+            while True:
+                try:
+                    return self._fetch_range(url, segFile, rng[0], rng[1],
+                                             state)
+                except Exception, e:
+                    if not _wait_to_retry(self._ctx, self._log, url,
+                                          attempt, e):
+                        raise
+                    attempt += 1
+        self._log.debug('Downloading [%s] in [%d] segments', url, len(ranges))
+        for unused, excInfo in run_parallel(fetch, ranges, len(ranges)):
+            if excInfo:
+                os.remove(segFile)
+                raise excInfo[0], excInfo[1], excInfo[2]
+        os.rename(segFile, partFile)
+        with open(partFile, 'r+b') as f:
+            out = HashingWriter(f, self._ctx.get('CACHE_HASH_ALGORITHM'))
+            out.resume(f, size)
+        return out
+
+    def download(self, url, toFile, digest=None):
+        return _download(self, url, toFile, digest)
+
+    def download_mirrors(self, urls, toFile, digest=None):
+        """Download the file from the fastest of several mirrors"""
+        return _race(self, urls, toFile, digest)
 
     def download_direct(self, url):
-        buf = urllib2.urlopen(url).read()
-        self._log.info('Downloaded [%s] to memory', url)
-        self._log.debug("Downloaded [%s] [%s]", url, buf)
+        attempt = 0
+        while True:
+            try:
+                res = self._open(url)
+                try:
+                    buf = res.read()
+                finally:
+                    res.close()
+                break
+            except Exception, e:
+                if not _wait_to_retry(self._ctx, self._log, url, attempt, e):
+                    raise
+                attempt += 1
+        self._log.info('Downloaded [%s] to memory (%d bytes)', url, len(buf))
         return buf
 
 
+class DnsCache(object):
+    """Resolve each host once and remember the addresses.
+
+    `create_connection` can stand in for `socket.create_connection`.
+    When none of the cached addresses can be reached, they're dropped
+    so the next connection resolves the host again.
+    """
+
+    def __init__(self):
+        self._addrs = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        with self._lock:
+            addrs = self._addrs.get((host, port))
+        if addrs is None:
+            addrs = [info[4] for info in socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)]
+            with self._lock:
+                self._addrs[(host, port)] = addrs
+        return addrs
+
+    def create_connection(self, address,
+                          timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                          source_address=None):
+        err = None
+        for addr in self.resolve(*address):
+            try:
+                return socket.create_connection(addr[:2], timeout,
+                                                source_address)
+            except socket.error, e:
+                err = e
+        with self._lock:
+            self._addrs.pop(tuple(address), None)
+        raise err or socket.error('No address for [%s]' % (address,))
+
+
+class ConnectionPool(object):
+    """Idle HTTP connections, kept open so they can be used again.
+
+    Connections are grouped by a key, which identifies the server and
+    the proxy used to reach it.  All of the connections share one
+    `DnsCache`.
+    """
+
+    def __init__(self):
+        self.dns = DnsCache()
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop()
+
+    def put(self, key, conn, maxIdle):
+        with self._lock:
+            if len(self._idle[key]) < maxIdle:
+                self._idle[key].append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+_pool = ConnectionPool()
+
+
+class PooledResponse(object):
+    """A response that hands its connection back to the pool on close.
+
+    The connection can only be used again once the whole response has
+    been read, otherwise it's closed.
+    """
+
+    def __init__(self, pool, key, conn, res, maxIdle):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._res = res
+        self._maxIdle = maxIdle
+
+    def read(self, amt=None):
+        return self._res.read(amt)
+
+    def getcode(self):
+        return self._res.status
+
+    def info(self):
+        return self._res.msg
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._res.isclosed() and not self._res.will_close:
+            self._pool.put(self._key, self._conn, self._maxIdle)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+class PooledDownloader(Downloader):
+    """Download with persistent HTTP connections.
+
+    Connections are kept open and used again by later downloads from the
+    same host, for the whole staging, and host names are only resolved
+    once.  At most `DOWNLOAD_POOL_SIZE` idle connections are kept for
+    each host.  Proxies are configured the same as for `Downloader`.
+    URLs that aren't http or https are opened with urllib2.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, config, pool=None):
+        Downloader.__init__(self, config)
+        self._proxies = dict((scheme.lower(), proxy)
+                             for scheme, proxy in self._proxies.iteritems())
+        self._pool = pool or _pool
+        self._maxIdle = int(self._ctx.get('DOWNLOAD_POOL_SIZE', 4))
+        self._timeout = self._ctx.get('DOWNLOAD_TIMEOUT',
+                                      socket._GLOBAL_DEFAULT_TIMEOUT)
+        if self._timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self._timeout = float(self._timeout)
+
+    def _connect(self, scheme, host, port):
+        proxy = self._proxies.get(scheme)
+        if proxy:
+            if '://' not in proxy:
+                proxy = 'http://%s' % proxy
+            proxy = urlparse(proxy)
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(
+                    proxy.hostname, proxy.port or 80, timeout=self._timeout)
+                conn.set_tunnel(host, port, _proxy_headers(proxy))
+            else:
+                conn = httplib.HTTPConnection(
+                    proxy.hostname, proxy.port or 80, timeout=self._timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self._timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self._timeout)
+        conn._create_connection = self._pool.dns.create_connection
+        return conn
+
+    def _open_connection(self, conn, timings, start):
+        """Connect, noting when each phase of connecting was done"""
+        create = conn._create_connection
+        conn._create_connection = _timed_create_connection(
+            self._pool.dns, timings, start)
+        try:
+            conn.connect()
+        finally:
+            conn._create_connection = create
+        if isinstance(conn, httplib.HTTPSConnection):
+            timings['tls'] = time.time() - start
+
+    def _request(self, url, headers, method='GET', timings=None,
+                 start=None):
+        parts = urlparse(url)
+        port = parts.port or (parts.scheme == 'https' and 443 or 80)
+        key = (parts.scheme, parts.hostname, port,
+               self._proxies.get(parts.scheme))
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = dict(headers or {})
+        proxy = self._proxies.get(parts.scheme)
+        if proxy and parts.scheme == 'http':
+            path = url
+            if '://' not in proxy:
+                proxy = 'http://%s' % proxy
+            headers.update(_proxy_headers(urlparse(proxy)))
+        conn = self._pool.get(key)
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = self._connect(parts.scheme, parts.hostname, port)
+            try:
+                if not reused and timings is not None:
+                    self._open_connection(conn, timings, start)
+                conn.request(method, path, headers=headers)
+                return key, conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server may have closed an idle connection
+                if not reused:
+                    raise
+                self._log.debug('Reconnecting to [%s]', parts.netloc)
+                conn = None
+
+    def _open(self, url, headers=None, method='GET'):
+        if urlparse(url).scheme not in ('http', 'https'):
+            return Downloader._open(self, url, headers, method)
+        start = time.time()
+        for i in xrange(self.MAX_REDIRECTS + 1):
+            timings = {}
+            key, conn, res = self._request(url, headers, method, timings,
+                                           start)
+            pooled = PooledResponse(self._pool, key, conn, res,
+                                    self._maxIdle)
+            pooled.timings = timings
+            location = res.getheader('location')
+            if res.status in (301, 302, 303, 307, 308) and location:
+                res.read()
+                pooled.close()
+                url = urljoin(url, location)
+                self._log.debug('Redirected to [%s]', url)
+                continue
+            if res.status >= 400:
+                body = res.read()
+                pooled.close()
+                raise urllib2.HTTPError(url, res.status, res.reason,
+                                        res.msg, StringIO(body))
+            return pooled
+        pooled.close()
+        raise urllib2.HTTPError(url, res.status, 'Too many redirects',
+                                res.msg, None)
+
+
+# non-blocking TLS needs the ssl module of Python 2.7.9 or later
+_ASYNC_TLS = hasattr(ssl, 'create_default_context')
+_SSL_WANT = tuple(getattr(ssl, name)
+                  for name in ('SSLWantReadError', 'SSLWantWriteError')
+                  if hasattr(ssl, name))
+
+
+class AsyncTransfer(asyncore.dispatcher):
+    """A single HTTP GET, driven by an `asyncore` loop.
+
+    The body is written to `sink` as it arrives.  When the transfer is
+    `done`, either `excInfo` is set, `redirect` is the URL to follow or
+    the whole body has been written.
+    """
+
+    def __init__(self, dwn, url, sink, socketMap):
+        asyncore.dispatcher.__init__(self, map=socketMap)
+        self.url = url
+        self.sink = sink
+        self.done = False
+        self.excInfo = None
+        self.redirect = None
+        self.status = None
+        self.lastActivity = self.started = time.time()
+        self.timings = {}
+        self._chunkSize = _chunk_size(dwn._ctx)
+        self._in = ''
+        self._handshake = None
+        self._remaining = None
+        self._chunked = None
+        parts = urlparse(url)
+        self._https = (parts.scheme == 'https')
+        self._host = parts.hostname
+        port = parts.port or (self._https and 443 or 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = {'Host': parts.netloc,
+                   'User-Agent': 'build-pack-utils',
+                   'Accept-Encoding': 'identity',
+                   'Connection': 'close'}
+        host = self._host
+        proxy = dwn._proxies.get(parts.scheme)
+        self._tunnel = None
+        if proxy:
+            if '://' not in proxy:
+                proxy = 'http://%s' % proxy
+            proxy = urlparse(proxy)
+            proxyHeaders = _proxy_headers(proxy)
+            if self._https:
+                self._tunnel = self._format(
+                    'CONNECT %s:%d HTTP/1.1' % (self._host, port),
+                    dict(proxyHeaders, Host='%s:%d' % (self._host, port)))
+            else:
+                path = url
+                headers.update(proxyHeaders)
+            host, port = proxy.hostname, proxy.port or 80
+        self._request = self._format('GET %s HTTP/1.1' % path, headers)
+        self._out = self._tunnel or self._request
+        addr = dwn._dns.resolve(host, port)[0]
+        self.timings['dns'] = time.time() - self.started
+        self.create_socket(len(addr) == 4 and socket.AF_INET6 or
+                           socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(addr)
+        except Exception:
+            # don't leave the socket in the map, the loop would poll it
+            self.close()
+            raise
+
+    def _format(self, line, headers):
+        return '\r\n'.join([line] + ['%s: %s' % item
+                                     for item in headers.iteritems()] +
+                           ['', ''])
+
+    def _start_tls(self):
+        context = ssl.create_default_context()
+        self.socket = context.wrap_socket(self.socket,
+                                          server_hostname=self._host,
+                                          do_handshake_on_connect=False)
+        self._handshake = 'write'
+
+    def _do_handshake(self):
+        try:
+            self.socket.do_handshake()
+            self._handshake = None
+            self.timings['tls'] = time.time() - self.started
+        except _SSL_WANT, e:
+            self._handshake = (isinstance(e, ssl.SSLWantReadError) and
+                               'read' or 'write')
+
+    def handle_connect(self):
+        self.timings['connect'] = time.time() - self.started
+        if self._https and not self._tunnel:
+            self._start_tls()
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self._handshake:
+            return self._handshake == 'write'
+        return bool(self._out)
+
+    def readable(self):
+        return True
+
+    def handle_write(self):
+        self.lastActivity = time.time()
+        if self._handshake:
+            return self._do_handshake()
+        try:
+            sent = self.socket.send(self._out)
+        except _SSL_WANT:
+            return
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        self.lastActivity = time.time()
+        if self._handshake:
+            return self._do_handshake()
+        while not self.done:
+            try:
+                data = self.socket.recv(self._chunkSize)
+            except _SSL_WANT:
+                return
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return self.handle_close()
+            self._feed(data)
+            # TLS may have decrypted more than select knows about
+            if not (self._handshake is None and
+                    hasattr(self.socket, 'pending') and
+                    self.socket.pending()):
+                return
+
+    def _feed(self, data):
+        if self.status is None:
+            self._in += data
+            end = self._in.find('\r\n\r\n')
+            if end < 0:
+                return
+            head, data = self._in[:end + 2], self._in[end + 4:]
+            self._in = ''
+            statusLine, head = head.split('\r\n', 1)
+            status = int(statusLine.split(None, 2)[1])
+            reason = (statusLine.split(None, 2) + [''])[2]
+            msg = httplib.HTTPMessage(StringIO(head))
+            if self._tunnel:
+                if status != 200:
+                    raise IOError('Proxy refused to connect to [%s], [%d]'
+                                  % (self.url, status))
+                self._tunnel = None
+                self._out = self._request
+                self._start_tls()
+                return
+            self.status = status
+            self.timings['firstByte'] = time.time() - self.started
+            self.msg = msg
+            location = msg.getheader('location')
+            if status in (301, 302, 303, 307, 308) and location:
+                self.redirect = urljoin(self.url, location)
+                return self._finish()
+            if status >= 400:
+                raise urllib2.HTTPError(self.url, status, reason, msg, None)
+            if 'chunked' in msg.getheader('transfer-encoding', '').lower():
+                self._chunked = 'size'
+            elif msg.getheader('content-length') is not None:
+                self._remaining = int(msg.getheader('content-length'))
+                if self._remaining == 0:
+                    return self._finish()
+        if self._chunked:
+            self._in += data
+            self._read_chunks()
+        elif self._remaining is not None:
+            data = data[:self._remaining]
+            self.sink.write(data)
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                self._finish()
+        elif data:
+            self.sink.write(data)
+
+    def _read_chunks(self):
+        while self._in and not self.done:
+            if self._chunked == 'size':
+                end = self._in.find('\r\n')
+                if end < 0:
+                    return
+                size = int(self._in[:end].split(';')[0], 16)
+                self._in = self._in[end + 2:]
+                if size == 0:
+                    return self._finish()
+                self._remaining = size
+                self._chunked = 'data'
+            elif self._chunked == 'data':
+                data = self._in[:self._remaining]
+                self._in = self._in[len(data):]
+                self.sink.write(data)
+                self._remaining -= len(data)
+                if self._remaining == 0:
+                    self._chunked = 'end'
+            elif len(self._in) >= 2:
+                self._in = self._in[2:]
+                self._chunked = 'size'
+            else:
+                return
+
+    def _finish(self):
+        self.done = True
+        self.close()
+
+    def fail(self, excInfo):
+        self.excInfo = excInfo
+        self._finish()
+
+    def handle_close(self):
+        if self.done:
+            return
+        if self.status is None or self._chunked or self._remaining:
+            try:
+                raise httplib.IncompleteRead(
+                    '', self._remaining or 0)
+            except httplib.IncompleteRead:
+                return self.fail(sys.exc_info())
+        self._finish()
+
+    def handle_error(self):
+        self.fail(sys.exc_info())
+
+
+class AsyncDownloader(Downloader):
+    """Download many files at the same time, on a single thread.
+
+    Transfers are driven by an `asyncore` loop, up to
+    `DOWNLOAD_ASYNC_TRANSFERS` at a time.  `download_many` and
+    `download_direct_many` take a batch of downloads and return a
+    `(value, exc_info)` tuple for each of them, in order, like
+    `run_parallel` does.  The single file methods are there too, so this
+    can be used anywhere `Downloader` can.
+
+    Redirects are followed and failed transfers are retried as set with
+    `DOWNLOAD_RETRIES`.  A transfer that's idle for `DOWNLOAD_TIMEOUT`
+    seconds fails.  URLs that aren't http or https are downloaded with
+    `Downloader`, so are https URLs before Python 2.7.9, which can't do
+    TLS without blocking.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, config):
+        Downloader.__init__(self, config)
+        self._proxies = dict((scheme.lower(), proxy)
+                             for scheme, proxy in self._proxies.iteritems())
+        self._dns = _pool.dns
+        self._maxTransfers = int(self._ctx.get('DOWNLOAD_ASYNC_TRANSFERS',
+                                               16))
+        self._timeout = float(self._ctx.get('DOWNLOAD_TIMEOUT', 60))
+
+    def _transfer(self, urls, openSink, closeSink):
+        urls = list(urls)
+        results = [None] * len(urls)
+        attempts = [0] * len(urls)
+        redirects = [0] * len(urls)
+        started = [None] * len(urls)
+        waiting = dict((i, 0) for i in xrange(len(urls)))
+        active = {}
+        socketMap = {}
+
+        def finish(i, sink, excInfo=None, redirect=None, timings=None):
+            if redirect and redirects[i] < self.MAX_REDIRECTS:
+                self._log.debug('Redirected to [%s]', redirect)
+                redirects[i] += 1
+                urls[i] = redirect
+                closeSink(i, sink, None)
+                waiting[i] = time.time()
+            elif excInfo or redirect:
+                closeSink(i, sink, None)
+                if not excInfo:
+                    excInfo = (IOError, IOError('Too many redirects for [%s]'
+                                                % urls[i]), None)
+                delay = _retry_delay(self._ctx, self._log, urls[i],
+                                     attempts[i], excInfo[1])
+                if delay is None:
+                    results[i] = (None, excInfo)
+                else:
+                    attempts[i] += 1
+                    waiting[i] = time.time() + delay
+            else:
+                timings = dict(timings or {},
+                               total=time.time() - started[i])
+                try:
+                    results[i] = (closeSink(i, sink, urls[i], timings), None)
+                except Exception:
+                    results[i] = (None, sys.exc_info())
+
+        while waiting or active:
+            now = time.time()
+            for i, notBefore in sorted(waiting.items()):
+                if len(active) >= self._maxTransfers:
+                    break
+                if notBefore > now:
+                    continue
+                del waiting[i]
+                started[i] = started[i] or now
+                sink = openSink(i)
+                try:
+                    if self._async(urls[i]):
+                        transfer = AsyncTransfer(self, urls[i], sink,
+                                                 socketMap)
+                        active[transfer] = i
+                        continue
+                    res = self._open(urls[i])
+                    try:
+                        self._copy(res, sink)
+                    finally:
+                        res.close()
+                except Exception:
+                    finish(i, sink, sys.exc_info())
+                else:
+                    finish(i, sink)
+            if socketMap:
+                asyncore.loop(timeout=0.1, use_poll=True, map=socketMap,
+                              count=1)
+            elif waiting and not active:
+                time.sleep(max(0, min(waiting.values()) - now))
+            now = time.time()
+            for transfer, i in active.items():
+                if not transfer.done and \
+                        now - transfer.lastActivity > self._timeout:
+                    try:
+                        raise socket.timeout('Download of [%s] timed out'
+                                             % urls[i])
+                    except socket.timeout:
+                        transfer.fail(sys.exc_info())
+                if transfer.done:
+                    del active[transfer]
+                    finish(i, transfer.sink, transfer.excInfo,
+                           transfer.redirect, transfer.timings)
+        return results
+
+    def _async(self, url):
+        """If `url` can be downloaded by the event loop"""
+        scheme = urlparse(url).scheme
+        return scheme == 'http' or (scheme == 'https' and _ASYNC_TLS)
+
+    def download_many(self, downloads):
+        """Download each `(url, toFile)`, returns `(result, exc_info)`s"""
+        downloads = list(downloads)
+        algorithm = self._ctx.get('CACHE_HASH_ALGORITHM')
+
+        def openSink(i):
+            return HashingWriter(open(downloads[i][1] + '.part', 'wb'),
+                                 algorithm)
+
+        def closeSink(i, sink, url, timings=None):
+            sink._out.close()
+            toFile = downloads[i][1]
+            if url is None:
+                os.remove(toFile + '.part')
+                return
+            os.rename(toFile + '.part', toFile)
+            print 'Downloaded [%s] to [%s] (%d bytes)' % (url, toFile,
+                                                          sink.size)
+            self._log.info('Downloaded [%s] to [%s] (%d bytes) in %.3fs',
+                           url, toFile, sink.size, timings['total'])
+            return DownloadResult(url, toFile, sink.size, sink.hexdigest(),
+                                  timings)
+        return self._transfer([url for url, toFile in downloads],
+                              openSink, closeSink)
+
+    def download_direct_many(self, urls):
+        """Download each URL to memory, returns `(data, exc_info)`s"""
+        def closeSink(i, sink, url, timings=None):
+            if url is not None:
+                self._log.info('Downloaded [%s] to memory (%d bytes)',
+                               url, len(sink.getvalue()))
+                return sink.getvalue()
+        return self._transfer(urls, lambda i: BytesIO(), closeSink)
+
+    def download(self, url, toFile, digest=None):
+        value, excInfo = self.download_many([(url, toFile)])[0]
+        if excInfo:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return value
+
+    def download_direct(self, url):
+        value, excInfo = self.download_direct_many([url])[0]
+        if excInfo:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return value
+
+
 class CurlDownloader(object):
+    """Download files with the `curl` command.
+
+    `download_many` and `download_direct_many` fetch a batch of files
+    with a single `curl`, listing the transfers in a config file so it
+    can reuse connections.  With curl 7.67 or newer the transfers run
+    in parallel, up to `DOWNLOAD_CURL_PARALLEL` at a time.  They return
+    a `(value, exc_info)` tuple for each item, in order, like
+    `run_parallel` does.
+    """
+
+    # the phases of a transfer, as curl times them
+    _TIMINGS = ('%{time_namelookup} %{time_connect} %{time_appconnect} '
+                '%{time_starttransfer} %{time_total}')
+    # written by curl after the body of a single download
+    _STATUS_FORMAT = '<!-- Status: %%{http_code} %s -->' % _TIMINGS
+    # written by curl after each transfer in a batch
+    _BATCH_FORMAT = '%%{http_code} %%{exitcode} %s %%{filename_effective}\\n' \
+                    % _TIMINGS
+    _version = None
 
     def __init__(self, config):
         self._ctx = config
         self._status_pattern = re.compile(r'^(.*)<!-- Status: (\d+) -->$',
                                           re.DOTALL)
+        self._timed_status_pattern = re.compile(
+            r'^(.*)<!-- Status: (\d+) ([\d. ]+) -->$', re.DOTALL)
         self._log = logging.getLogger('downloads')
 
-    def download(self, url, toFile):
-        cmd = ["curl", "-s",
-               "-o", toFile,
-               "-w", '%{http_code}']
+    def _timings(self, values):
+        """Map the `_TIMINGS` curl wrote to `DownloadResult` phases"""
+        return dict((phase, float(value)) for phase, value
+                    in zip(DownloadResult.PHASES, values.split())
+                    if float(value) > 0)
+
+    def _proxy_args(self):
+        args = []
         for key in self._ctx.keys():
             if key.lower().endswith('_proxy'):
-                cmd.extend(['-x', self._ctx[key]])
+                args.extend(['-x', self._ctx[key]])
+        return args
+
+    @classmethod
+    def _curl_version(cls):
+        if cls._version is None:
+            output = Popen(['curl', '--version'], stdout=PIPE).communicate()[0]
+            m = re.match(r'curl (\d+)\.(\d+)', output)
+            cls._version = m and tuple(map(int, m.groups())) or (0, 0)
+        return cls._version
+
+    def _quote(self, val):
+        return '"%s"' % val.replace('\\', '\\\\').replace('"', '\\"')
+
+    def _batch(self, downloads):
+        """Run one curl for all of the `(url, toFile)` downloads.
+
+        Returns a `(code, exitCode, timings)` tuple for each download, in
+        order, or None when curl didn't report on the transfer.
+        """
+        fd, config = tempfile.mkstemp(prefix='curl-', suffix='.cfg')
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                for url, toFile in downloads:
+                    f.write('url = %s\n' % self._quote(url))
+                    f.write('output = %s\n' % self._quote(toFile))
+            cmd = ['curl', '-s', '-K', config, '-w', self._BATCH_FORMAT]
+            retries = int(self._ctx.get('DOWNLOAD_RETRIES', 0))
+            if retries:
+                cmd.extend(['--retry', str(retries)])
+            if self._curl_version() >= (7, 67):
+                cmd.extend(['--no-progress-meter',
+                            '--parallel', '--parallel-max',
+                            str(self._ctx.get('DOWNLOAD_CURL_PARALLEL',
+                                              16))])
+            cmd.extend(self._proxy_args())
+            self._log.debug("Running [%s] for [%d] downloads",
+                            cmd, len(downloads))
+            proc = Popen(cmd, stdout=PIPE)
+            output = proc.communicate()[0]
+        finally:
+            os.remove(config)
+        self._log.debug("Curl returned [%s]", proc.returncode)
+        status = {}
+        for line in output.splitlines():
+            fields = line.split(' ', 7)
+            if len(fields) == 8:
+                code, exitCode, toFile = fields[0], fields[1], fields[7]
+                status[toFile] = (code, exitCode.isdigit() and
+                                  int(exitCode) or 0,
+                                  self._timings(' '.join(fields[2:7])))
+        return [status.get(download[1]) for download in downloads]
+
+    def _batch_results(self, downloads, finish):
+        results = []
+        for (url, toFile), status in zip(downloads, self._batch(downloads)):
+            try:
+                if status is None:
+                    raise IOError("curl did not download [%s]" % url)
+                code, exitCode, timings = status
+                if code.startswith('4') or code.startswith('5'):
+                    raise DownloadError("curl says [%s] for [%s]"
+                                        % (code, url), int(code))
+                if exitCode != 0:
+                    raise IOError("curl failed with [%d] for [%s]"
+                                  % (exitCode, url))
+                results.append((finish(url, toFile, timings), None))
+            except Exception:
+                if os.path.exists(toFile):
+                    os.remove(toFile)
+                results.append((None, sys.exc_info()))
+        return results
+
+    def download_many(self, downloads):
+        """Download each `(url, toFile)`, returns `(result, exc_info)`s"""
+        downloads = list(downloads)
+        algorithm = self._ctx.get('CACHE_HASH_ALGORITHM')
+
+        def finish(url, partFile, timings):
+            toFile = partFile[:-len('.part')]
+            with open(partFile, 'r+b') as f:
+                out = HashingWriter(f, algorithm)
+                out.resume(f, os.path.getsize(partFile))
+            os.rename(partFile, toFile)
+            print 'Downloaded [%s] to [%s] (%d bytes)' % (url, toFile,
+                                                          out.size)
+            self._log.info('Downloaded [%s] to [%s] (%d bytes) in %.3fs',
+                           url, toFile, out.size, timings.get('total', 0))
+            return DownloadResult(url, toFile, out.size, out.hexdigest(),
+                                  timings)
+        return self._batch_results(
+            [(url, toFile + '.part') for url, toFile in downloads], finish)
+
+    def download_direct_many(self, urls):
+        """Download each URL to memory, returns `(data, exc_info)`s"""
+        def finish(url, toFile, timings):
+            with open(toFile, 'rb') as f:
+                data = f.read()
+            self._log.info('Downloaded [%s] to memory (%d bytes) in %.3fs',
+                           url, len(data), timings.get('total', 0))
+            return data
+        tmpDir = tempfile.mkdtemp(prefix='curl-')
+        try:
+            return self._batch_results(
+                [(url, os.path.join(tmpDir, str(i)))
+                 for i, url in enumerate(urls)], finish)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    def _fetch(self, url, partFile, offset, state):
+        # curl writes the body to stdout, followed by the status, which
+        #  lets us hash the file as it arrives.  The last few bytes are
+        #  held back, until we know they're not part of the status.
+        cmd = ["curl", "-s", "-w", self._STATUS_FORMAT]
+        if offset:
+            cmd.extend(['-C', str(offset)])
+        cmd.extend(self._proxy_args())
         cmd.append(url)
         self._log.debug("Running [%s]", cmd)
         proc = Popen(cmd, stdout=PIPE)
-        output, unused_err = proc.communicate()
-        proc.poll()
-        self._log.debug("Curl returned [%s]", output)
-        if output and \
-                (output.startswith('4') or
-                 output.startswith('5')):
-            raise RuntimeError("curl says [%s]" % output)
-        print 'Downloaded [%s] to [%s]' % (url, toFile)
-        self._log.info('Downloaded [%s] to [%s]', url, toFile)
+        # long enough for the status and the five timings
+        holdBack = 128
+        tail = ''
+        with open(partFile, offset and 'r+b' or 'wb') as f:
+            out = HashingWriter(f, self._ctx.get('CACHE_HASH_ALGORITHM'))
+            out.resume(f, offset)
+            for buf in iter(partial(proc.stdout.read,
+                                    _chunk_size(self._ctx)), ''):
+                buf = tail + buf
+                out.write(buf[:-holdBack])
+                tail = buf[-holdBack:]
+            proc.wait()
+            code = ''
+            m = self._timed_status_pattern.match(tail)
+            if m:
+                tail = m.group(1)
+                code = m.group(2)
+                state['timings'] = self._timings(m.group(3))
+            out.write(tail)
+            if code.startswith('4') or code.startswith('5'):
+                # don't keep the error page as part of the file
+                f.truncate(offset)
+        self._log.debug("Curl returned [%s] [%s]", proc.returncode, code)
+        if offset and proc.returncode == 33:
+            # the server does not support ranges
+            return self._fetch(url, partFile, 0, state)
+        if code.startswith('4') or code.startswith('5'):
+            raise DownloadError("curl says [%s]" % code, int(code))
+        if proc.returncode != 0:
+            raise IOError("curl failed with [%d]" % proc.returncode)
+        return out, offset
+
+    def download(self, url, toFile, digest=None):
+        return _download(self, url, toFile, digest)
+
+    def download_mirrors(self, urls, toFile, digest=None):
+        """Download the file from one of several mirrors
+
+        Mirrors are tried in order, curl can't probe them first.
+        """
+        return _race(self, urls, toFile, digest)
 
     def download_direct(self, url):
         cmd = ["curl", "-s",
                "-w", '<!-- Status: %{http_code} -->']
-        for key in self._ctx.keys():
-            if key.lower().endswith('_proxy'):
-                cmd.extend(['-x', self._ctx[key]])
+        cmd.extend(self._proxy_args())
         cmd.append(url)
         self._log.debug("Running [%s]", cmd)
         proc = Popen(cmd, stdout=PIPE)
@@ -86,7 +1549,9 @@ class CurlDownloader(object):
             code = m.group(2)
             self._log.debug("Curl returned [%s]", code)
             if (code.startswith('4') or code.startswith('5')):
-                raise RuntimeError("curl says [%s]" % output)
-            self._log.info('Downloaded [%s] to memory', url)
-            self._log.debug('Downloaded [%s] [%s]', url, resp)
-            return resp
+                raise DownloadError("curl says [%s]" % output, int(code))
+        if not m or proc.returncode != 0:
+            raise IOError("curl failed with [%d]" % proc.returncode)
+        self._log.info('Downloaded [%s] to memory (%d bytes)',
+                       url, len(resp))
+        return resp
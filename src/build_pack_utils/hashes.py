@@ -1,3 +1,4 @@
+import os
 import hashlib
 import logging
 from functools import partial
@@ -45,3 +46,39 @@ class ShaHashUtil(HashUtil):
             return digest
         elif retcode == 1:
             raise ValueError(err.split('\n')[0])
+
+
+class ChecksumManifest(object):
+    """Digests of many files, like the ones listed in a `SHA256SUMS` file.
+
+    Each line of the manifest holds a digest and a file name, separated
+    by white space.  The name may be prefixed with `*` (binary mode) and
+    may include a path.  Files can be looked up by the name as listed or
+    by the base name.  Blank lines and lines starting with `#` are
+    ignored.
+    """
+
+    def __init__(self, text=''):
+        self._digests = {}
+        self._byBaseName = {}
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            name = parts[1].strip().lstrip('*')
+            self._digests[name] = parts[0].lower()
+            self._byBaseName.setdefault(os.path.basename(name),
+                                        parts[0].lower())
+
+    def get(self, fileName):
+        return (self._digests.get(fileName) or
+                self._byBaseName.get(os.path.basename(fileName)))
+
+    def digests(self):
+        return self._digests.values()
+
+    def __len__(self):
+        return len(self._digests)
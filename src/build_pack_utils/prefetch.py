@@ -0,0 +1,192 @@
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import logging
+from optparse import OptionParser
+from urlparse import urlparse
+from cloudfoundry import CloudFoundryUtil
+from cloudfoundry import CloudFoundryInstaller
+from utils import FormattedDict
+from utils import run_parallel
+
+
+_log = logging.getLogger('prefetch')
+
+
+def load_config(bpDir, stack=None):
+    """Load a build pack's `defaults/options.json`.
+
+    The options for `stack`, in `defaults/<stack>/options.json`, are
+    merged over the defaults like `Configurer.stack_config` does.
+    """
+    ctx = FormattedDict(CloudFoundryUtil.load_json_config_file_from(
+        bpDir, 'defaults/options.json'))
+    if stack:
+        ctx.update(CloudFoundryUtil.load_json_config_file_from(
+            bpDir, 'defaults/%s/options.json' % stack))
+    return ctx
+
+
+class Prefetcher(object):
+    """Download everything a build pack may install into a cache.
+
+    Every `<KEY>_DOWNLOAD_URL` in the context is a package, downloaded
+    and checked like `CloudFoundryInstaller.install_binary` does.  Every
+    `<KEY>_MODULES_PATTERN` is expanded for each module listed in the
+    context key, or keys, that `PREFETCH_MODULES` maps `<KEY>` to,
+    `<KEY>_MODULES` when it's not mapped.  The files are stored in the
+    `DirectoryCacheManager` directory of the context, which can be
+    bundled into a tarball to seed the caches of other stagers.
+    """
+
+    EXCLUDE = ('.locks', '.failures.json')
+
+    def __init__(self, ctx):
+        self._log = _log
+        self._ctx = ctx
+        self._cf = CloudFoundryInstaller(ctx)
+
+    def _module_names(self, moduleKey):
+        keys = self._ctx.get('PREFETCH_MODULES', {}).get(
+            moduleKey, '%s_MODULES' % moduleKey)
+        if not isinstance(keys, list):
+            keys = [keys]
+        names = []
+        for key in keys:
+            names.extend(self._ctx.get(key, []))
+        return sorted(set(names))
+
+    def downloads(self):
+        """Everything to download, as `(name, url, hashUrl, mirrors)`"""
+        downloads = []
+        for key in sorted(self._ctx.keys()):
+            if (key.endswith('_DOWNLOAD_URL') and
+                    not key.endswith('_HASH_DOWNLOAD_URL')):
+                installKey = key[:-len('_DOWNLOAD_URL')]
+                downloads.append((installKey,) +
+                                 self._cf.binary_urls(installKey))
+            elif key.endswith('_MODULES_PATTERN'):
+                moduleKey = key[:-len('_MODULES_PATTERN')]
+                for module in self._module_names(moduleKey):
+                    ctx = FormattedDict(self._ctx)
+                    ctx['MODULE_NAME'] = module
+                    url = ctx[key]
+                    downloads.append((
+                        '%s/%s' % (moduleKey, module), url,
+                        "%s.%s" % (url, ctx['CACHE_HASH_ALGORITHM']), None))
+        return downloads
+
+    def fetch(self, workers=1):
+        """Download and check everything, up to `workers` at a time.
+
+        The hash files are downloaded first, all at once when the
+        downloader can.  Returns a list of `(name, url, path, exc_info)`,
+        where `path` is the cached file, or None with the `exc_info` of
+        the failure.
+        """
+        downloads = self.downloads()
+        manifest = self._cf._manifest()
+        digests = self._cf.download_digests(
+            [hashUrl for name, url, hashUrl, mirrors in downloads
+             if self._cf._is_url(hashUrl) and
+             not manifest.get(urlparse(url).path.split('/')[-1])])
+
+        def fetch(download):
+            name, url, hashUrl, mirrors = download
+            return self._cf.cache_binary(url, digests.get(hashUrl, hashUrl),
+                                         mirrors=mirrors)[0]
+        results = []
+        for (name, url, hashUrl, mirrors), (path, excInfo) in zip(
+                downloads, run_parallel(fetch, downloads, workers)):
+            if excInfo:
+                self._log.warning("Could not prefetch [%s] from [%s]",
+                                  name, url, exc_info=excInfo)
+            results.append((name, url, path, excInfo))
+        self._cf._dcm.flush()
+        return results
+
+    def bundle(self, path):
+        """Write the cache directory to the tarball `path`.
+
+        Locks, temporary files and remembered failures are left out.
+        Extract the tarball into a stager's cache directory to seed it.
+        """
+        baseDir = self._ctx.get('FILE_CACHE_BASE_DIRECTORY',
+                                self._ctx['CACHE_DIR'])
+
+        def exclude(name):
+            name = os.path.basename(name)
+            return name in self.EXCLUDE or name.endswith('.tmp')
+        mode = (path.endswith(('.gz', '.tgz')) and 'w:gz' or
+                path.endswith('.bz2') and 'w:bz2' or 'w')
+        tar = tarfile.open(path, mode)
+        try:
+            for name in sorted(os.listdir(baseDir)):
+                tar.add(os.path.join(baseDir, name), name, exclude=exclude)
+        finally:
+            tar.close()
+        self._log.info("Bundled [%s] into [%s]", baseDir, path)
+        return path
+
+
+def main(argv=None):
+    """Prefetch the downloads of a build pack into a cache directory.
+
+        python -m build_pack_utils.prefetch [options] BP_DIR CACHE_DIR
+
+    Returns 0 when everything was downloaded and checked, otherwise 1.
+    """
+    parser = OptionParser(usage='%prog [options] BP_DIR CACHE_DIR')
+    parser.add_option('-s', '--stack', default=os.environ.get('CF_STACK'),
+                      help='merge the options of this stack, $CF_STACK '
+                           'by default')
+    parser.add_option('-m', '--modules', action='append', default=[],
+                      metavar='KEY=LIST_KEY',
+                      help='prefetch the <KEY>_MODULES_PATTERN modules '
+                           'listed in LIST_KEY, may be repeated')
+    parser.add_option('-j', '--workers', type='int',
+                      help='downloads at the same time, PREFETCH_WORKERS '
+                           'or INSTALL_WORKERS by default')
+    parser.add_option('-o', '--bundle', metavar='TARBALL',
+                      help='also write the cache to TARBALL')
+    (opts, args) = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('expected BP_DIR and CACHE_DIR')
+    bpDir, cacheDir = args
+    ctx = load_config(bpDir, opts.stack)
+    modules = ctx.setdefault('PREFETCH_MODULES', {})
+    for opt in opts.modules:
+        moduleKey, listKey = opt.split('=', 1)
+        modules.setdefault(moduleKey, [])
+        if not isinstance(modules[moduleKey], list):
+            modules[moduleKey] = [modules[moduleKey]]
+        modules[moduleKey].append(listKey)
+    tmpDir = tempfile.mkdtemp(prefix='prefetch-')
+    try:
+        ctx.update({
+            'BP_DIR': bpDir,
+            'CACHE_DIR': cacheDir,
+            'BUILD_DIR': os.path.join(tmpDir, 'build'),
+            'TMPDIR': tmpDir
+        })
+        workers = opts.workers or int(ctx.get(
+            'PREFETCH_WORKERS', ctx.get('INSTALL_WORKERS', 4)))
+        prefetcher = Prefetcher(ctx)
+        results = prefetcher.fetch(workers)
+        for name, url, path, excInfo in results:
+            if excInfo:
+                print 'FAILED  %s  %s  (%s)' % (name, url, excInfo[1])
+            else:
+                print 'OK      %s  %s' % (name, path)
+        if opts.bundle:
+            prefetcher.bundle(opts.bundle)
+        return any(excInfo for name, url, path, excInfo in results) and 1 or 0
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -5,6 +5,11 @@ import logging
 import codecs
 import inspect
 import re
+import errno
+import fcntl
+import threading
+import Queue
+from contextlib import contextmanager
 from string import Template
 from runner import check_output
 
@@ -19,6 +24,125 @@ def safe_makedirs(path):
         # Ignore if it exists
         if e.errno != 17:
             raise e
+        # another thread may have created a parent, but not `path`
+        if not os.path.exists(path):
+            safe_makedirs(path)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on `path` while in the block.
+
+    The lock is taken with `flock` on a newly opened file, so it excludes
+    other processes and other threads of this process alike.
+    """
+    safe_makedirs(os.path.dirname(path))
+    with open(path, 'a') as lockFile:
+        try:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            _log.info("Waiting for lock [%s]", path)
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+
+# ioctl that clones a file's blocks into another file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Copy a file by sharing its blocks, when the file system supports it
+
+    The permission bits are copied too, like `shutil.copy` does.
+    """
+    with open(src, 'rb') as fileIn:
+        try:
+            with open(dst, 'wb') as fileOut:
+                fcntl.ioctl(fileOut.fileno(), FICLONE, fileIn.fileno())
+            shutil.copymode(src, dst)
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """Put a file at `dst` with the contents of `src`, as cheaply as possible
+
+    Tries a hard link first (unless `hardlink` is False), then a reflink
+    and when neither is supported, falls back to copying the file.  An
+    existing file at `dst` is replaced.  Returns the method that worked,
+    one of `link`, `reflink` or `copy`.
+    """
+    if os.path.isfile(dst):
+        os.remove(dst)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+def link_tree(src, dst, hardlink=False):
+    """Recreate the directory tree at `src` under `dst`.
+
+    Files are reflinked when possible, otherwise they are copied, see
+    `link_or_copy`.  With `hardlink` set, they're hard linked first, so
+    writing to a file under `dst` changes it under `src` too.  Symbolic
+    links are recreated.  Files that already exist under `dst` are
+    replaced.
+    """
+    for root, dirs, files in os.walk(src):
+        toRoot = os.path.join(dst, os.path.relpath(root, src))
+        safe_makedirs(toRoot)
+        for name in files + [d for d in dirs
+                             if os.path.islink(os.path.join(root, d))]:
+            fromPath = os.path.join(root, name)
+            toPath = os.path.join(toRoot, name)
+            if os.path.islink(fromPath):
+                if os.path.lexists(toPath):
+                    os.remove(toPath)
+                os.symlink(os.readlink(fromPath), toPath)
+            else:
+                hardlink = (link_or_copy(fromPath, toPath, hardlink) == 'link')
+
+
+def move_tree(src, dst):
+    """Move the contents of the directory `src` into `dst`.
+
+    When `dst` doesn't exist, `src` is simply renamed.  Otherwise each
+    entry is renamed into `dst`, merging directories that exist in both,
+    so every file shows up complete or not at all.  `src` is removed.
+    """
+    if not os.path.exists(dst):
+        safe_makedirs(os.path.dirname(os.path.abspath(dst)))
+        os.rename(src, dst)
+        return
+    for name in os.listdir(src):
+        fromPath = os.path.join(src, name)
+        toPath = os.path.join(dst, name)
+        isDir = os.path.isdir(toPath) and not os.path.islink(toPath)
+        if isDir and os.path.isdir(fromPath) and \
+                not os.path.islink(fromPath):
+            move_tree(fromPath, toPath)
+            continue
+        if isDir:
+            shutil.rmtree(toPath)
+        os.rename(fromPath, toPath)
+    os.rmdir(src)
 
 
 def load_env(path):
@@ -213,6 +337,50 @@ def unique(seq):
     return [x for x in seq if not (x in seen or seen_add(x))]
 
 
+def run_parallel(func, items, workers=1):
+    """Call `func` once for each item, using up to `workers` threads.
+
+    Results are returned in the same order as `items`.  Each result is a
+    tuple of `(value, exc_info)`.  When the call succeeds, `exc_info` is
+    None, otherwise it's the `sys.exc_info()` captured in the worker, so
+    the caller can decide to log it or re-raise it.
+
+    With one worker, the calls are made serially on the calling thread.
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    def call(i):
+        try:
+            results[i] = (func(items[i]), None)
+        except Exception:
+            results[i] = (None, sys.exc_info())
+
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        for i in xrange(len(items)):
+            call(i)
+        return results
+    todo = Queue.Queue()
+    for i in xrange(len(items)):
+        todo.put(i)
+
+    def work():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            call(i)
+    threads = [threading.Thread(target=work) for i in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 # This is copytree from PyPy 2.7 source code.
 #   https://bitbucket.org/pypy/pypy/src/9d88b4875d6e/lib-python/2.7/shutil.py
 # Modifying this so that it doesn't care about an initial directory existing
@@ -1,22 +1,200 @@
 import os
+import sys
 import gzip
 import bz2
+import copy
+import zlib
+import Queue
 import zipfile
+import tarfile
 import shutil
 import logging
+import time
 import tempfile
+import threading
 from functools import partial
 from subprocess import Popen
 from subprocess import PIPE
+from utils import safe_makedirs
+from utils import run_parallel
+
+
+def _within(realDir, path):
+    """If `path`, with its symbolic links resolved, is under `realDir`"""
+    path = os.path.realpath(path)
+    return path == realDir or path.startswith(realDir + os.sep)
+
+
+class _InflateReader(object):
+    """Decompress a gzip or bzip2 file in a thread, as it's read.
+
+    zlib and bz2 release the GIL, so the archive is decompressed while
+    the files read from it are being written, like `gunzip -c | tar x`
+    does with two processes.  Concatenated members are decompressed one
+    after the other and trailing garbage is ignored, like `gunzip`.
+    """
+
+    MAGIC = {'gz': '\037\213', 'bz2': 'BZh'}
+
+    def __init__(self, fileobj, compression, bufSize):
+        self._compression = compression
+        self._queue = Queue.Queue(8)
+        self._closed = False
+        self._done = False
+        self._chunk = ''
+        self._pos = 0
+        self._thread = threading.Thread(target=self._inflate,
+                                        args=(fileobj, bufSize))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _decompressor(self):
+        if self._compression == 'gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def _put(self, item):
+        if not self._closed:
+            self._queue.put(item)
+        return not self._closed
+
+    def _inflate(self, fileobj, bufSize):
+        try:
+            dec = self._decompressor()
+            for buf in iter(partial(fileobj.read, bufSize), ''):
+                while buf:
+                    try:
+                        data, rest = dec.decompress(buf), None
+                    except EOFError:
+                        # bz2, the member ended with the last block
+                        data, rest = '', buf
+                    if data and not self._put(data):
+                        return
+                    buf = rest if rest is not None else dec.unused_data
+                    if buf:
+                        magic = self.MAGIC[self._compression]
+                        if not (buf.startswith(magic) or
+                                magic.startswith(buf)):
+                            self._put('')
+                            return
+                        dec = self._decompressor()
+        except Exception:
+            self._put(sys.exc_info())
+            return
+        self._put('')
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                if self._done:
+                    break
+                item = self._queue.get()
+                if isinstance(item, tuple):
+                    self._done = True
+                    raise item[0], item[1], item[2]
+                self._done = not item
+                self._chunk, self._pos = item, 0
+                continue
+            end = (size < 0) and len(self._chunk) or self._pos + size
+            part = self._chunk[self._pos:end]
+            self._pos += len(part)
+            size -= (size > 0) and len(part) or 0
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        """Stop the thread, when the archive wasn't read to the end"""
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def _which(cmd):
+    """Full path to the command `cmd` on the `PATH`, or None"""
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(path, cmd)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
 
 
 class UnzipUtil(object):
-    """Extract files from compressed archives."""
+    """Extract files from compressed archives.
+
+    Compressed tar archives may be decompressed by a command, the
+    backends in `DECOMPRESSORS`.  By default, archives of at least
+    `PARALLEL_DECOMPRESS_MIN_BYTES` (default 8 MiB) are decompressed by
+    the first parallel backend found on the `PATH`, like `pigz` or
+    `lbzip2`, and smaller ones in this process.  Set `TAR_DECOMPRESSOR`
+    to the name of a backend, or to `python`, to always use that one.
+    Which commands exist is looked up once and remembered.
+    """
+
+    # for each compression, the name, command and if it uses many cores
+    DECOMPRESSORS = {
+        'gz': [('pigz', ['pigz', '-dc'], True),
+               ('gzip', ['gzip', '-dc'], False)],
+        'bz2': [('lbzip2', ['lbzip2', '-dc'], True),
+                ('pbzip2', ['pbzip2', '-dc'], True),
+                ('bzip2', ['bzip2', '-dc'], False)]
+    }
+
+    _found = {}
+    _foundLock = threading.Lock()
 
     def __init__(self, config):
         self._ctx = config
         self._log = logging.getLogger('zips')
 
+    @classmethod
+    def register_decompressor(cls, compression, name, cmd, parallel=True):
+        """Add a backend that decompresses to stdout with `cmd`.
+
+        Parallel backends are tried before the ones registered already,
+        the others after them.
+        """
+        backends = cls.DECOMPRESSORS.setdefault(compression, [])
+        if parallel:
+            backends.insert(0, (name, list(cmd), parallel))
+        else:
+            backends.append((name, list(cmd), parallel))
+
+    @classmethod
+    def _available(cls, cmd):
+        key = (cmd, os.environ.get('PATH'))
+        with cls._foundLock:
+            if key not in cls._found:
+                cls._found[key] = _which(cmd)
+            return cls._found[key]
+
+    def _decompressor(self, zipFile, compression, inProcess=True):
+        """The backend to decompress `zipFile` with, as `(name, cmd)`.
+
+        Returns None when the archive should be decompressed in this
+        process.  Unless `inProcess` is set, a serial backend is picked
+        rather than none.
+        """
+        backends = [backend for backend
+                    in self.DECOMPRESSORS.get(compression, [])
+                    if self._available(backend[1][0])]
+        forced = self._ctx.get('TAR_DECOMPRESSOR')
+        if forced and forced != 'python':
+            for name, cmd, parallel in backends:
+                if name == forced:
+                    return (name, cmd)
+            self._log.warning("Decompressor [%s] not found for [%s]",
+                              forced, zipFile)
+        elif not forced and os.path.getsize(zipFile) >= int(self._ctx.get(
+                'PARALLEL_DECOMPRESS_MIN_BYTES', 8 * 1024 * 1024)):
+            for name, cmd, parallel in backends:
+                if parallel:
+                    return (name, cmd)
+        if not inProcess and backends:
+            return backends[-1][:2]
+
     def _unzip(self, zipFile, intoDir, strip):
         """Extract files from a zip archive.
 
@@ -38,7 +216,16 @@ class UnzipUtil(object):
         zipIn = None
         try:
             zipIn = zipfile.ZipFile(zipFile, 'r')
-            zipIn.extractall(tmpDir)
+            for member in zipIn.infolist():
+                # like extractall, but other extractions may be creating
+                #  the same directories
+                parts = [part for part in member.filename.split('/')[:-1]
+                         if part not in ('', '.', '..')]
+                path = os.path.join(tmpDir, *parts)
+                if not os.path.isdir(path):
+                    safe_makedirs(path)
+                if not member.filename.endswith('/'):
+                    zipIn.extract(member, tmpDir)
             if strip:
                 members = zipIn.namelist()
                 if len(members) > 0:
@@ -157,44 +344,183 @@ class UnzipUtil(object):
         the given folder, optionally stripping off the first element
         of the path.
 
+        By default, the archive is read in this process, see
+        `_tar_python`.  Set `TAR_EXTRACTOR` to `external` to run the
+        `tar` command instead, see `_tar_external`.
+
         :param zipFile: full path to possibly compressed tar archive
         :param intoDir: full path to root of extracted files
         :param compression: type of compression (None, 'gz' or 'bz2')
         :param strip: set `--strip-components 1` argument to tar
 
         """
-        # build command
-        cmd = []
-        if compression == 'gz':
-            cmd.append('gunzip -c %s' % zipFile)
-        elif compression == 'bz2':
-            cmd.append('bunzip2 -c %s' % zipFile)
+        safe_makedirs(intoDir)
+        if not os.path.exists(os.path.join(intoDir, zipFile)):
+            return intoDir
+        if self._ctx.get('TAR_EXTRACTOR', 'python') == 'external':
+            return self._tar_external(zipFile, intoDir, compression, strip)
+        return self._tar_python(zipFile, intoDir, compression, strip)
+
+    def _tar_python(self, zipFile, intoDir, compression, strip):
+        """Extract a tar archive in this process, with `tarfile`.
+
+        The archive is read sequentially, in `EXTRACT_BUFFER_SIZE`
+        blocks (default 64 KiB), and extracted with `extract_stream`.
+        A compressed archive is decompressed by another thread, see
+        `_InflateReader`.  No process is started and the working
+        directory isn't changed.
+        """
+        bufSize = int(self._ctx.get('EXTRACT_BUFFER_SIZE', 64 * 1024))
+        zipFile = os.path.join(intoDir, zipFile)
+        backend = compression and self._decompressor(zipFile, compression)
+        if backend:
+            return self._tar_python_from(backend, zipFile, intoDir, strip,
+                                         bufSize)
+        with open(zipFile, 'rb', bufSize) as f:
+            if not compression:
+                return self.extract_stream(f, intoDir, strip)
+            reader = _InflateReader(f, compression, bufSize)
+            try:
+                return self.extract_stream(reader, intoDir, strip)
+            finally:
+                reader.close()
+
+    def _tar_python_from(self, backend, zipFile, intoDir, strip, bufSize):
+        """Extract a tar archive as it's decompressed by `backend`"""
+        name, cmd = backend
+        self._log.debug("Decompressing [%s] with [%s]", zipFile, name)
+        proc = Popen(cmd + [zipFile], stdout=PIPE, bufsize=bufSize)
+        excInfo = None
+        try:
+            self.extract_stream(proc.stdout, intoDir, strip)
+            # the padding after the end of the archive
+            for buf in iter(partial(proc.stdout.read, bufSize), ''):
+                pass
+        except Exception:
+            excInfo = sys.exc_info()
+            if proc.poll() is None:
+                proc.kill()
+        proc.stdout.close()
+        retcode = proc.wait()
+        # when the backend failed, that's why the archive was unreadable
+        if retcode > 0 or (retcode and not excInfo):
+            raise RuntimeError("Decompressing [%s] with [%s] failed with "
+                               "code [%d]" % (zipFile, name, retcode))
+        if excInfo:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return intoDir
+
+    def _tar_external(self, zipFile, intoDir, compression, strip):
+        """Extract a tar archive with the `tar` command.
+
+        The archive is piped from a decompressor, see `DECOMPRESSORS`,
+        when it's compressed.  No shell is used, so paths may contain
+        spaces, and `tar` is run from `intoDir`.
+        """
+        tarCmd = ['tar', 'xf', '-']
         if strip:
-            if compression is None:
-                cmd.append('tar xf %s --strip-components 1' % zipFile)
-            else:
-                cmd.append('tar xf - --strip-components 1')
+            tarCmd.extend(['--strip-components', str(int(strip))])
+        backend = compression and self._decompressor(
+            os.path.join(intoDir, zipFile), compression, inProcess=False)
+        if backend:
+            self._log.debug("Decompressing [%s] with [%s]", zipFile,
+                            backend[0])
+            unzipCmd = backend[1] + [zipFile]
+        elif compression:
+            raise RuntimeError("No decompressor found for [%s]" % zipFile)
         else:
-            if compression is None:
-                cmd.append('tar xf %s' % zipFile)
-            else:
-                cmd.append('tar xf -')
-        command = (len(cmd) > 1) and ' | '.join(cmd) or ''.join(cmd)
-        # run it
-        cwd = os.getcwd()
+            unzipCmd = None
+            tarCmd[2] = zipFile
+        unzip = None
+        if unzipCmd:
+            unzip = Popen(unzipCmd, stdout=PIPE, cwd=intoDir)
+        retcode = None
         try:
-            if not os.path.exists(intoDir):
-                os.makedirs(intoDir)
-            os.chdir(intoDir)
-            if os.path.exists(zipFile):
-                proc = Popen(command, stdout=PIPE, shell=True)
-                output, unused_err = proc.communicate()
-                retcode = proc.poll()
-                if retcode:
-                    raise RuntimeError("Extracting [%s] failed with code [%d]"
-                                       % (zipFile, retcode))
+            proc = Popen(tarCmd, stdin=unzip and unzip.stdout, stdout=PIPE,
+                         cwd=intoDir)
+            if unzip:
+                # tar owns the pipe now, so unzip sees it close
+                unzip.stdout.close()
+            proc.communicate()
+            retcode = proc.returncode
         finally:
-            os.chdir(cwd)
+            if unzip:
+                # never leave the decompressor running when tar is done
+                unzip.stdout.close()
+                if retcode != 0 and unzip.poll() is None:
+                    unzip.kill()
+                unzip.wait()
+        retcode = retcode or (unzip and unzip.returncode)
+        if retcode:
+            raise RuntimeError("Extracting [%s] failed with code [%d]"
+                               % (zipFile, retcode))
+        return intoDir
+
+    def extract_stream(self, stream, intoDir, strip=False):
+        """Extract files from a tar archive as it's read from a stream.
+
+        The archive may be compressed with gzip or bzip2.  Members are
+        extracted one at a time, as soon as they have been read, so the
+        archive never needs to be written to disk.  Members with absolute
+        paths or paths outside of `intoDir` are skipped, as are members
+        that would be written through a symbolic link that points outside
+        of it and hard links to files outside of it.  Like `tar`, an
+        existing symbolic link is replaced, never written through.
+
+        :param stream: file like object to read the archive from
+        :param intoDir: full path to root of extracted files
+        :param strip: trim leading element from path in archive, or
+                      that many elements
+
+        """
+        self._log.info("Extracting stream into [%s]", intoDir)
+        safe_makedirs(intoDir)
+        realDir = os.path.realpath(intoDir)
+        strip = int(strip)
+        directories = []
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+        try:
+            for member in tar:
+                if strip:
+                    member.name = '/'.join(member.name.split('/')[strip:])
+                    if member.islnk():
+                        member.linkname = '/'.join(
+                            member.linkname.split('/')[strip:])
+                    if not member.name:
+                        continue
+                path = os.path.normpath(member.name)
+                target = os.path.join(intoDir, path)
+                if (os.path.isabs(path) or path.split(os.sep)[0] == '..' or
+                        not _within(realDir, os.path.dirname(target)) or
+                        (member.islnk() and not _within(
+                            realDir, os.path.join(intoDir,
+                                                  member.linkname)))):
+                    self._log.warning("Skipping [%s], it's outside of [%s]",
+                                      member.name, intoDir)
+                    continue
+                if os.path.islink(target):
+                    os.remove(target)
+                if member.isdir():
+                    # like extractall, allow writing to the directory until
+                    #  everything has been extracted
+                    directories.append(member)
+                    member = copy.copy(member)
+                    member.mode = 0700
+                # other extractions may be creating the same directories
+                parentDir = os.path.dirname(os.path.join(intoDir, path))
+                if not os.path.isdir(parentDir):
+                    safe_makedirs(parentDir)
+                tar.extract(member, intoDir)
+            directories.sort(key=lambda member: member.name, reverse=True)
+            for member in directories:
+                path = os.path.join(intoDir, member.name)
+                if os.path.islink(path) or not _within(realDir, path):
+                    continue
+                tar.chown(member, path)
+                tar.utime(member, path)
+                tar.chmod(member, path)
+        finally:
+            tar.close()
         return intoDir
 
     def _pick_based_on_file_extension(self, zipFile):
@@ -246,6 +572,9 @@ class UnzipUtil(object):
         convenient if you need to extract files from an unsupported
         archive type.
 
+        The working directory is never changed, so archives can be
+        extracted by several threads at once, see `extract_many`.
+
         :param zipFile: full path to archive file
         :param intoDir: full path to root of extracted files
         :param strip:  strip leading element of archive path
@@ -258,3 +587,41 @@ class UnzipUtil(object):
         if not method:
             method = self._pick_based_on_file_extension(zipFile)
         return method(zipFile, intoDir, strip)
+
+    def extract_many(self, jobs, workers=None):
+        """Extract several archives at the same time.
+
+        Each job is a tuple of `(zipFile, intoDir, strip)`, where `strip`
+        may be left out, passed to `extract`.  Up to `workers` archives,
+        `EXTRACT_WORKERS` by default (4), are extracted at once.  A job
+        that fails doesn't stop the others, even when they extract into
+        the same directory.
+
+        Returns a list, in the same order as `jobs`, of tuples of
+        `(path, exc_info, seconds)`.  `path` is what `extract` returned,
+        or None with the `exc_info` of the failure, and `seconds` is how
+        long the job took.
+
+        :param jobs: list of archives to extract
+        :param workers: how many archives to extract at once
+
+        """
+        jobs = list(jobs)
+        if workers is None:
+            workers = int(self._ctx.get('EXTRACT_WORKERS', 4))
+        timings = [0.0] * len(jobs)
+
+        def extract(job):
+            i, job = job
+            start = time.time()
+            try:
+                return self.extract(*job)
+            finally:
+                timings[i] = time.time() - start
+        results = run_parallel(extract, enumerate(jobs), workers)
+        for job, (path, excInfo) in zip(jobs, results):
+            if excInfo:
+                self._log.warning("Could not extract [%s] into [%s]",
+                                  job[0], job[1], exc_info=excInfo)
+        return [(path, excInfo, seconds)
+                for (path, excInfo), seconds in zip(results, timings)]
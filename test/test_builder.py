@@ -1,8 +1,10 @@
 import os
 import sys
 import stat
+import time
 import tempfile
 import shutil
+import threading
 from StringIO import StringIO
 from nose.tools import eq_
 from nose.tools import raises
@@ -26,6 +28,7 @@ from build_pack_utils import ExtensionRegister
 from build_pack_utils import ModuleInstaller
 from build_pack_utils import SaveBuilder
 from build_pack_utils import Shell
+from build_pack_utils import ChecksumManifest
 from build_pack_utils import utils
 
 
@@ -280,6 +283,56 @@ class TestInstaller(object):
         eq_('/tmp/installed/TEST2', self.ctx['TEST2_INSTALL_PATH'])
         assert self.inst == res
 
+    def test_packages_concurrent(self):
+        self.ctx['INSTALL_WORKERS'] = 4
+        self.ctx['INSTALL_WORKERS_PER_HOST'] = 2
+        self.ctx['TEST1_DOWNLOAD_URL'] = 'http://host1/test1.tar.gz'
+        self.ctx['TEST2_DOWNLOAD_URL'] = 'http://host1/test2.tar.gz'
+        self.ctx['TEST3_DOWNLOAD_URL'] = 'http://host1/test3.tar.gz'
+        self.ctx['TMP_DOWNLOAD_URL'] = 'http://host2/tmp.tar.gz'
+        lock = threading.Lock()
+        active = {'now': 0, 'max': 0}
+
+        def install_binary(key):
+            with lock:
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.05)
+            with lock:
+                active['now'] -= 1
+            return '/tmp/installed/%s' % key
+        self.inst._installer = Dingus()
+        self.inst._installer.install_binary = install_binary
+        res = self.inst.packages('TEST1', 'TEST2', 'PACKAGE', 'TEST3')
+        eq_('/tmp/installed/TEST1', self.ctx['TEST1_INSTALL_PATH'])
+        eq_('/tmp/installed/TEST2', self.ctx['TEST2_INSTALL_PATH'])
+        eq_('/tmp/installed/TMP', self.ctx['TMP_INSTALL_PATH'])
+        eq_('/tmp/installed/TEST3', self.ctx['TEST3_INSTALL_PATH'])
+        # the per host limit only applies to the downloads
+        eq_(4, active['max'])
+        assert self.inst._installer.calls('limit_hosts', 2).once()
+        assert self.inst == res
+
+    def test_packages_concurrent_fails(self):
+        self.ctx['INSTALL_WORKERS'] = 2
+        installed = []
+
+        def install_binary(key):
+            installed.append(key)
+            if key == 'TEST2':
+                raise ValueError('Intentional')
+            return '/tmp/installed/%s' % key
+        self.inst._installer = Dingus()
+        self.inst._installer.install_binary = install_binary
+        try:
+            self.inst.packages('TEST1', 'TEST2', 'TEST3')
+            assert False, "should not reach this code"
+        except ValueError, e:
+            eq_('Intentional', str(e))
+        eq_(3, len(installed))
+        eq_('/tmp/installed/TEST1', self.ctx['TEST1_INSTALL_PATH'])
+        assert 'TEST3_INSTALL_PATH' not in self.ctx
+
     def test_extensions_works(self):
         self.reg.extension().from_path('test/data/plugins/test1')
         eq_(0, len(self.ctx['EXTENSIONS']))
@@ -1595,6 +1648,64 @@ class TestModuleInstaller(object):
         eq_(True, 'pattern/Module1' in failedModules)
         eq_(True, 'pattern/Module2' in failedModules)
         eq_(True, 'pattern/Module3' in failedModules)
+        eq_(False, 'MODULE_NAME' in self.ctx)
+
+    def test_done_concurrent(self):
+        self.ctx['INSTALL_WORKERS'] = 3
+        mi = ModuleInstaller(self.inst, 'LOCAL')
+        installing = []
+        active = []
+        lock = threading.Lock()
+
+        def test_install_direct(url, hashUrl, toPath, strip):
+            with lock:
+                active.append(url)
+                installing.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(url)
+            eq_('%s.sha1' % url, hashUrl)
+            if url == 'pattern/Module2':
+                raise HTTPError(url, 404, "FAIL [%s] :(" % url, None, None)
+            return toPath
+        mi._cf = Dingus()
+        mi._cf.install_binary_direct = test_install_direct
+        mi.filter_files_by_extension('.mods')
+        mi.from_application('')
+        mi.include_module('Module4')
+        eq_(self.inst, mi.done())
+        eq_(4, len(installing))
+        assert max(installing) > 1
+        assert max(installing) <= 3
+        eq_(False, 'MODULE_NAME' in self.ctx)
+        assert mi._cf.save_stats.calls().once()
+
+    def test_done_batches_digests(self):
+        mi = ModuleInstaller(self.inst, 'LOCAL')
+        batches = []
+
+        def download_digests(urls):
+            batches.append(list(urls))
+            return dict((url, 'digest-%s' % url) for url in urls
+                        if url != 'pattern/Module2.sha1')
+        mi._cf = Dingus()
+        mi._cf.download_digests = download_digests
+        mi._cf._manifest = lambda: ChecksumManifest('1234  Module3\n')
+        mi.filter_files_by_extension('.mods')
+        mi.from_application('')
+        mi.done()
+        eq_(1, len(batches))
+        eq_(['pattern/Module1.sha1', 'pattern/Module2.sha1'],
+            sorted(batches[0]))
+        hashes = dict((call.args[0], call.args[1])
+                      for call in mi._cf.install_binary_direct.calls)
+        eq_('digest-pattern/Module1.sha1', hashes['pattern/Module1'])
+        eq_('pattern/Module2.sha1', hashes['pattern/Module2'])
+        eq_('pattern/Module3.sha1', hashes['pattern/Module3'])
+        # the modules are downloaded together too, before installing
+        assert mi._cf.cache_binaries.calls().once()
+        eq_(sorted(hashes.items()),
+            sorted(mi._cf.calls('cache_binaries')[0].args[0]))
 
 
 class TestSaveBuilder(object):
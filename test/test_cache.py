@@ -1,9 +1,15 @@
 import os
+import json
+import time
 import shutil
 import tempfile
+import threading
 from nose.tools import with_setup
+from nose.tools import eq_
+from dingus import Dingus
 from build_pack_utils import HashUtil
 from build_pack_utils import DirectoryCacheManager
+from build_pack_utils import FailureCache
 
 
 class TestDirectoryCacheManager(object):
@@ -43,3 +49,374 @@ class TestDirectoryCacheManager(object):
         assert dcm.get(key, junk_file[1]).endswith('DCM/junk.txt')
         dcm.delete(key)
         assert not dcm.exists(key, junk_file[1])
+
+    @with_setup(teardown=tearDown)
+    def test_digest_index(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        ctx = {
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'USE_EXTERNAL_HASH': False,
+            'CACHE_HASH_ALGORITHM': 'sha256'}
+        dcm = DirectoryCacheManager(ctx)
+        junk_file = self.create_junk_file('junk.txt')
+        dcm.put('junk.txt', junk_file[0], junk_file[1])
+        assert os.path.exists(os.path.join(path, '.digests.json'))
+        # index is used by a new manager, file is not hashed again
+        dcm = DirectoryCacheManager(ctx)
+        dcm._hashUtil = Dingus('hash')
+        assert dcm.exists('junk.txt', junk_file[1])
+        assert dcm.get('junk.txt', junk_file[1]).endswith('DCM/junk.txt')
+        eq_(0, len(dcm._hashUtil.calls('calculate_hash')))
+        # changing the file forces it to be hashed again
+        with open(os.path.join(path, 'junk.txt'), 'a') as f:
+            f.write('More!')
+        dcm = DirectoryCacheManager(ctx)
+        assert not dcm.exists('junk.txt', junk_file[1])
+        dcm.delete('junk.txt')
+        assert 'junk.txt' not in dcm._load_index()
+
+    @with_setup(teardown=tearDown)
+    def test_digest_index_paranoid(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_PARANOID_VERIFY': True,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        junk_file = self.create_junk_file('junk.txt')
+        dcm.put('junk.txt', junk_file[0], junk_file[1])
+        dcm._hashUtil = Dingus('hash', calculate_hash__returns=junk_file[1])
+        assert dcm.exists('junk.txt', junk_file[1])
+        assert dcm.exists('junk.txt', junk_file[1])
+        eq_(2, len(dcm._hashUtil.calls('calculate_hash')))
+
+    @with_setup(teardown=tearDown)
+    def test_content_layout(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_LAYOUT': 'content',
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        junk_file = self.create_junk_file('junk.txt')
+        cachePath = dcm.put('junk.txt', junk_file[0], junk_file[1])
+        eq_(os.path.join(path, 'blobs', junk_file[1], 'junk.txt'), cachePath)
+        # a different file with the same name doesn't replace it
+        with open(junk_file[0], 'w') as tmp:
+            tmp.write("Goodbye World!")
+        other = self._hshUtil.calculate_hash(junk_file[0])
+        dcm.put('junk.txt', junk_file[0], other)
+        eq_(cachePath, dcm.get('junk.txt', junk_file[1]))
+        assert dcm.get('junk.txt', other).endswith(
+            os.path.join(other, 'junk.txt'))
+        # same content with a different name is linked, not copied
+        linkPath = dcm.get('renamed.txt', junk_file[1])
+        eq_(os.path.join(path, 'blobs', junk_file[1], 'renamed.txt'),
+            linkPath)
+        eq_(os.stat(cachePath).st_ino, os.stat(linkPath).st_ino)
+        assert dcm.get('missing.txt', 'abcd') is None
+        # delete removes the blob the name maps to
+        dcm.delete('junk.txt')
+        assert not dcm.exists('junk.txt', other)
+        assert dcm.exists('junk.txt', junk_file[1])
+
+    def fill_cache(self, dcm, count, size, start=0):
+        paths = []
+        for i in range(start, start + count):
+            path = os.path.join(tempfile.gettempdir(), 'junk.txt')
+            with open(path, 'w') as tmp:
+                tmp.write(str(i) * size)
+            digest = self._hshUtil.calculate_hash(path)
+            paths.append(('junk%d.txt' % i, digest))
+            dcm.put('junk%d.txt' % i, path, digest)
+        return paths
+
+    @with_setup(teardown=tearDown)
+    def test_lru_eviction(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_MAX_BYTES': 350,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        entries = self.fill_cache(dcm, 3, 100)
+        # use the oldest file, so the second one is evicted next
+        assert dcm.get(*entries[0]) is not None
+        entries.extend(self.fill_cache(dcm, 1, 100, start=3))
+        eq_(1, dcm.stats.evictions)
+        eq_(100, dcm.stats.evictedBytes)
+        assert dcm.exists(*entries[0])
+        assert not dcm.exists(*entries[1])
+        assert not os.path.exists(os.path.join(path, 'junk1.txt'))
+        assert dcm.exists(*entries[2])
+        assert dcm.exists(*entries[3])
+
+    @with_setup(teardown=tearDown)
+    def test_hits_do_not_save_index(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        ctx = {
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'CACHE_HASH_ALGORITHM': 'sha256'}
+        dcm = DirectoryCacheManager(ctx)
+        entries = self.fill_cache(dcm, 2, 100)
+        dcm._update = Dingus('update')
+        assert dcm.get(*entries[0]) is not None
+        dcm.flush()
+        eq_(0, len(dcm._update.calls()))
+        # with a limit, the time is only saved when flushed
+        ctx['FILE_CACHE_MAX_BYTES'] = 1000
+        dcm = DirectoryCacheManager(ctx)
+        before = dcm._load_index()['junk0.txt']['atime']
+        time.sleep(0.01)
+        assert dcm.get(*entries[0]) is not None
+        eq_(before, dcm._load_index()['junk0.txt']['atime'])
+        dcm.flush()
+        assert dcm._load_index()['junk0.txt']['atime'] > before
+
+    @with_setup(teardown=tearDown)
+    def test_lru_eviction_content_layout(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_LAYOUT': 'content',
+            'FILE_CACHE_MAX_BYTES': 250,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        entries = self.fill_cache(dcm, 3, 100)
+        eq_(1, dcm.stats.evictions)
+        assert not dcm.exists(*entries[0])
+        assert not os.path.exists(os.path.join(path, 'blobs', entries[0][1]))
+        assert 'junk0.txt' not in dcm._names
+        assert dcm.exists(*entries[1])
+        assert dcm.exists(*entries[2])
+
+    @with_setup(teardown=tearDown)
+    def test_too_large_to_cache(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_MAX_BYTES': 1000,
+            'FILE_CACHE_MAX_ENTRY_FRACTION': 0.1,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        junk_file = self.create_junk_file('junk.txt')
+        eq_(os.path.join(path, 'junk.txt'),
+            dcm.put('junk.txt', junk_file[0], junk_file[1]))
+        with open(junk_file[0], 'w') as tmp:
+            tmp.write('X' * 101)
+        eq_(junk_file[0], dcm.put('big.txt', junk_file[0], 'digest'))
+        assert not os.path.exists(os.path.join(path, 'big.txt'))
+        eq_(0, dcm.stats.evictions)
+
+    @with_setup(teardown=tearDown)
+    def test_tree_cache(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        eq_(None, dcm.get_tree('1234', True))
+
+        def extract(intoDir):
+            os.makedirs(os.path.join(intoDir, 'bin'))
+            with open(os.path.join(intoDir, 'bin', 'run'), 'w') as f:
+                f.write('Hello World!')
+            os.symlink('bin/run', os.path.join(intoDir, 'run'))
+            return intoDir
+        treeDir, result = dcm.put_tree('1234', True, extract)
+        eq_(os.path.join(path, 'trees', '1234-1', 'tree'), treeDir)
+        eq_('.', result)
+        eq_((treeDir, result), dcm.get_tree('1234 file.tar.gz', 1))
+        eq_(None, dcm.get_tree('1234', False))
+        # changing an extracted file drops it from the cache
+        with open(os.path.join(treeDir, 'bin', 'run'), 'a') as f:
+            f.write('More!')
+        eq_(None, dcm.get_tree('1234', True))
+        assert not os.path.exists(os.path.join(path, 'trees', '1234-1'))
+
+    @with_setup(teardown=tearDown)
+    def test_tree_eviction(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_MAX_BYTES': 350,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+
+        def extract(intoDir):
+            with open(os.path.join(intoDir, 'big.txt'), 'w') as f:
+                f.write('X' * 150)
+            return intoDir
+        entries = self.fill_cache(dcm, 2, 100)
+        treeDir = dcm.put_tree('1234', False, extract)[0]
+        eq_([150], dcm._load_index()[os.path.join('trees', '1234-0')]['stat'])
+        # extracted files count towards the limit
+        self.fill_cache(dcm, 1, 100, start=2)
+        eq_(1, dcm.stats.evictions)
+        assert not dcm.exists(*entries[0])
+        assert os.path.exists(treeDir)
+        # and are evicted like files, when they're used least recently
+        assert dcm.get(*entries[1]) is not None
+        self.fill_cache(dcm, 1, 100, start=3)
+        eq_(2, dcm.stats.evictions)
+        eq_(None, dcm.get_tree('1234', False))
+        assert not os.path.exists(os.path.join(path, 'trees', '1234-0'))
+        assert os.path.join('trees', '1234-0') not in dcm._load_index()
+        assert dcm.exists(*entries[1])
+
+    @with_setup(teardown=tearDown)
+    def test_shared_by_many_stagers(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        ctx = {
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'CACHE_HASH_ALGORITHM': 'sha256'}
+        junk_file = self.create_junk_file('junk.txt')
+
+        def stage(i):
+            # every stager has its own manager, like separate processes
+            dcm = DirectoryCacheManager(ctx)
+            for j in range(5):
+                dcm.put('junk%d-%d.txt' % (i, j), junk_file[0], junk_file[1])
+        threads = [threading.Thread(target=stage, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        dcm = DirectoryCacheManager(ctx)
+        eq_(20, len(dcm._load_index()))
+        dcm._hashUtil = Dingus('hash')
+        for i in range(4):
+            for j in range(5):
+                assert dcm.exists('junk%d-%d.txt' % (i, j), junk_file[1])
+        eq_(0, len(dcm._hashUtil.calls('calculate_hash')))
+        eq_([], [f for f in os.listdir(path) if f.endswith('.tmp')])
+
+    @with_setup(teardown=tearDown)
+    def test_put_move(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        for layout in ('name', 'content'):
+            dcm = DirectoryCacheManager({
+                'CACHE_DIR': '/tmp/cache',
+                'FILE_CACHE_BASE_DIRECTORY': path,
+                'FILE_CACHE_LAYOUT': layout,
+                'CACHE_HASH_ALGORITHM': 'sha256'})
+            for i in range(2):
+                spool = dcm.spool_path('junk.txt')
+                assert spool.startswith(path)
+                with open(spool, 'wt') as f:
+                    f.write('Hello World!')
+                digest = dcm._hashUtil.calculate_hash(spool)
+                inode = os.stat(spool).st_ino
+                cached = dcm.put('junk.txt', spool, digest, move=True)
+                eq_(False, os.path.exists(spool))
+                assert dcm.exists('junk.txt', digest)
+                if i == 0:
+                    # renamed, not copied
+                    eq_(inode, os.stat(cached).st_ino)
+            shutil.rmtree(path)
+
+    @with_setup(teardown=tearDown)
+    def test_lock(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        ctx = {
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'CACHE_HASH_ALGORITHM': 'sha256'}
+        events = []
+
+        def stage(i):
+            with DirectoryCacheManager(ctx).lock('junk.txt'):
+                events.append('start')
+                time.sleep(0.05)
+                events.append('end')
+        threads = [threading.Thread(target=stage, args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(['start', 'end'] * 3, events)
+
+    @with_setup(teardown=tearDown)
+    def test_stats(self):
+        path = os.path.join(tempfile.gettempdir(), "DCM")
+        dcm = DirectoryCacheManager({
+            'CACHE_DIR': '/tmp/cache',
+            'FILE_CACHE_BASE_DIRECTORY': path,
+            'FILE_CACHE_PARANOID_VERIFY': True,
+            'CACHE_HASH_ALGORITHM': 'sha256'})
+        junk_file = self.create_junk_file('junk.txt')
+        assert dcm.get('junk.txt', junk_file[1]) is None
+        dcm.put('junk.txt', junk_file[0], junk_file[1])
+        assert dcm.get('junk.txt', junk_file[1]) is not None
+        eq_(1, dcm.stats.hits)
+        eq_(1, dcm.stats.misses)
+        eq_(12, dcm.stats.bytesFromCache)
+        assert dcm.stats.verifyTime > 0
+        statsFile = os.path.join(path, 'logs', 'stats.json')
+        dcm.stats.flush(statsFile)
+        eq_(0, dcm.stats.hits)
+        assert dcm.get('junk.txt', junk_file[1]) is not None
+        dcm.stats.flush(statsFile)
+        with open(statsFile, 'rt') as f:
+            stats = json.load(f)
+        eq_(2, stats['hits'])
+        eq_(1, stats['misses'])
+        eq_(24, stats['bytesFromCache'])
+        eq_(0, stats['evictions'])
+        # nothing to add, nothing written
+        os.remove(statsFile)
+        dcm.stats.flush(statsFile)
+        assert not os.path.exists(statsFile)
+
+
+class TestFailureCache(object):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def ctx(self, **extra):
+        ctx = {'CACHE_DIR': self._dir, 'FILE_CACHE_NEGATIVE_TTL': 60}
+        ctx.update(extra)
+        return ctx
+
+    def test_disabled(self):
+        failures = FailureCache(self.ctx(FILE_CACHE_NEGATIVE_TTL=0))
+        failures.add('http://localhost/missing', 404)
+        assert failures.get('http://localhost/missing') is None
+        assert not os.path.exists(
+            os.path.join(self._dir, FailureCache.FAILURES_FILE))
+
+    def test_add_get_remove(self):
+        failures = FailureCache(self.ctx())
+        assert failures.get('http://localhost/missing') is None
+        failures.add('http://localhost/missing', 404)
+        eq_(404, failures.get('http://localhost/missing')['status'])
+        # remembered by the next staging
+        failures = FailureCache(self.ctx())
+        eq_(404, failures.get('http://localhost/missing')['status'])
+        failures.remove('http://localhost/missing')
+        assert failures.get('http://localhost/missing') is None
+        assert FailureCache(self.ctx()).get(
+            'http://localhost/missing') is None
+
+    def test_force(self):
+        FailureCache(self.ctx()).add('http://localhost/missing', 404)
+        failures = FailureCache(self.ctx(FILE_CACHE_NEGATIVE_FORCE=True))
+        assert failures.get('http://localhost/missing') is None
+
+    def test_expired(self):
+        failures = FailureCache(self.ctx(FILE_CACHE_NEGATIVE_TTL=0.01))
+        failures.add('http://localhost/old', 404)
+        time.sleep(0.02)
+        assert failures.get('http://localhost/old') is None
+        failures.add('http://localhost/new', 410)
+        with open(os.path.join(self._dir, FailureCache.FAILURES_FILE)) as f:
+            eq_(['http://localhost/new'], json.load(f).keys())
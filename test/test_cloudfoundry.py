@@ -1,15 +1,25 @@
 import os
 import sys
+import time
 import tempfile
 import shutil
 import json
+import hashlib
+import tarfile
+import threading
+from StringIO import StringIO
 from dingus import Dingus
 from dingus import patch
+from urllib2 import HTTPError
 from nose.tools import eq_
 from build_pack_utils import CloudFoundryUtil
 from build_pack_utils import CloudFoundryInstaller
 from build_pack_utils import Downloader
 from build_pack_utils import CurlDownloader
+from build_pack_utils import PooledDownloader
+from build_pack_utils import AsyncDownloader
+from build_pack_utils import DownloadError
+from build_pack_utils import DownloadResult
 from build_pack_utils import utils
 
 
@@ -113,6 +123,26 @@ class TestCloudFoundryInstallerBinaries(object):
         })
         eq_(CurlDownloader, type(installer._dwn))
 
+    def test_get_downloader_pooled(self):
+        installer = CloudFoundryInstaller({
+            'BP_DIR': '/tmp/build_pack_dir',
+            'BUILD_DIR': '/tmp/build_dir',
+            'CACHE_DIR': '/tmp/cache_dir',
+            'TMPDIR': '/tmp/temp_dir',
+            'DOWNLOAD_METHOD': 'pooled'
+        })
+        eq_(PooledDownloader, type(installer._dwn))
+
+    def test_get_downloader_async(self):
+        installer = CloudFoundryInstaller({
+            'BP_DIR': '/tmp/build_pack_dir',
+            'BUILD_DIR': '/tmp/build_dir',
+            'CACHE_DIR': '/tmp/cache_dir',
+            'TMPDIR': '/tmp/temp_dir',
+            'DOWNLOAD_METHOD': 'async'
+        })
+        eq_(AsyncDownloader, type(installer._dwn))
+
     def test_get_downloader_custom(self):
         installer = CloudFoundryInstaller({
             'BP_DIR': '/tmp/build_pack_dir',
@@ -171,7 +201,8 @@ class TestCloudFoundryInstallerBinaries(object):
         installer._hashUtil = Dingus('hash',
                                      calculate_hash__returns='1234WXYZ')
         installer._dcm = Dingus('dcm', get__returns=None)
-        installer._dwn = Dingus('download')
+        installer._dwn = Dingus('download',
+                                download_direct__returns='1234WXYZ')
         # Run test
         instDir = installer.install_binary('LOCAL')
         # Verify execution path, file is not cached
@@ -207,7 +238,8 @@ class TestCloudFoundryInstallerBinaries(object):
         installer._unzipUtil = Dingus('unzip',
                                       extract__returns='/tmp/packages/tomcat')
         installer._hashUtil = Dingus('hash',
-                                     calculate_hash__returns='1234WXYZ')
+                                     calculate_hash__returns=(
+                                         '51de8d32c2809fd3d8b9ccf8eb08b77a'))
         installer._dcm = Dingus('dcm', get__returns=None)
         installer._dwn = Dingus('download')
         # Run test
@@ -234,12 +266,79 @@ class TestCloudFoundryInstallerBinaries(object):
         # cache manager is called with key and digest
         assert installer._dcm.put.calls().once()
         assert 'tomcat.tar.gz' == installer._dcm.calls('put')[0].args[0]
-        assert '1234WXYZ' == installer._dcm.calls('put')[0].args[2]
+        assert '51de8d32c2809fd3d8b9ccf8eb08b77a' == \
+            installer._dcm.calls('put')[0].args[2]
         # file is extracted
         assert installer._unzipUtil.extract.calls().once()
         # verify installation directory
         eq_('/tmp/packages/tomcat', instDir)
 
+    def test_install_binary_direct_digest_from_download(self):
+        # Setup mocks
+        installer = CloudFoundryInstaller({
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'BP_DIR': '/tmp/build_pack_dir',
+            'BUILD_DIR': '/tmp/build_dir',
+            'CACHE_DIR': '/tmp/cache_dir',
+            'TMPDIR': '/tmp/temp_dir'
+        })
+        installer._unzipUtil = Dingus('unzip',
+                                      extract__returns='/tmp/packages/tomcat')
+        installer._hashUtil = Dingus('hash')
+        installer._dcm = Dingus('dcm', get__returns=None)
+        installer._dwn = Dingus(
+            'download',
+            download__returns=DownloadResult(
+                'scheme://PREFIX/tomcat.tar.gz', '/tmp/temp_dir/tomcat.tar.gz',
+                1234, '51de8d32c2809fd3d8b9ccf8eb08b77a'))
+        # Run test
+        instDir = installer.install_binary_direct(
+            'scheme://PREFIX/tomcat.tar.gz',
+            '51de8d32c2809fd3d8b9ccf8eb08b77a',
+            '/tmp/build_dir/tomcat')
+        # downloaded file is not hashed again
+        assert installer._dwn.download.calls().once()
+        eq_(0, len(installer._hashUtil.calls('calculate_hash')))
+        # cache manager is called with the digest from the download
+        assert installer._dcm.put.calls().once()
+        eq_('51de8d32c2809fd3d8b9ccf8eb08b77a',
+            installer._dcm.calls('put')[0].args[2])
+        eq_('/tmp/packages/tomcat', instDir)
+
+    def test_install_binary_direct_digest_mismatch(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            downloaded = os.path.join(tmpDir, 'tomcat.tar.gz')
+            with open(downloaded, 'wb') as f:
+                f.write('corrupt')
+            installer = CloudFoundryInstaller({
+                'CACHE_HASH_ALGORITHM': 'sha1',
+                'BUILD_DIR': '/tmp/build_dir',
+                'CACHE_DIR': '/tmp/cache_dir',
+                'TMPDIR': tmpDir
+            })
+            installer._unzipUtil = Dingus('unzip')
+            installer._dcm = Dingus('dcm', get__returns=None)
+            installer._dwn = Dingus(
+                'download',
+                download__returns=DownloadResult(
+                    'scheme://PREFIX/tomcat.tar.gz', downloaded, 7,
+                    'bad0bad0bad0bad0bad0bad0bad0bad0bad0bad0'))
+            try:
+                installer.install_binary_direct(
+                    'scheme://PREFIX/tomcat.tar.gz',
+                    '51de8d32c2809fd3d8b9ccf8eb08b77a',
+                    '/tmp/build_dir/tomcat')
+                assert False, 'digest mismatch should raise'
+            except RuntimeError, e:
+                assert 'expected [51de8d32c2809fd3d8b9ccf8eb08b77a]' in str(e)
+            # the corrupt file is neither cached, extracted nor kept
+            eq_(0, len(installer._dcm.calls('put')))
+            eq_(0, len(installer._unzipUtil.extract.calls()))
+            assert not os.path.exists(downloaded)
+        finally:
+            shutil.rmtree(tmpDir)
+
     def test_install_binary_direct_custom_name(self):
         # Setup mocks
         installer = CloudFoundryInstaller({
@@ -254,7 +353,8 @@ class TestCloudFoundryInstallerBinaries(object):
         installer._hashUtil = Dingus('hash',
                                      calculate_hash__returns='1234WXYZ')
         installer._dcm = Dingus('dcm', get__returns=None)
-        installer._dwn = Dingus('download')
+        installer._dwn = Dingus('download',
+                                download_direct__returns='1234WXYZ')
         # Run test
         instDir = installer.install_binary_direct(
             'scheme://PREFIX/tomcat.tar.gz',
@@ -298,7 +398,8 @@ class TestCloudFoundryInstallerBinaries(object):
         installer._hashUtil = Dingus('hash',
                                      calculate_hash__returns='1234WXYZ')
         installer._dcm = Dingus('dcm', get__returns=None)
-        installer._dwn = Dingus('download')
+        installer._dwn = Dingus('download',
+                                download_direct__returns='1234WXYZ')
         # Run test
         instDir = installer.install_binary_direct(
             'http://PREFIX/tomcat.tar.gz?some=junk&more=params',
@@ -428,6 +529,575 @@ class TestCloudFoundryInstallerBinaries(object):
         assert shutil_copy.calls().once()
         eq_('/tmp/build_dir/composer', instDir)
 
+    def test_install_binary_direct_not_zipped_content_layout(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            cached = os.path.join(tmpDir, 'composer.phar')
+            with open(cached, 'wt') as f:
+                f.write('<?php ?>')
+            installDir = os.path.join(tmpDir, 'composer')
+            os.makedirs(installDir)
+            installer = CloudFoundryInstaller({
+                'BUILD_DIR': '/tmp/build_dir',
+                'CACHE_DIR': '/tmp/cache_dir',
+                'TMPDIR': '/tmp/temp_dir',
+                'FILE_CACHE_LAYOUT': 'content'
+            })
+            installer._unzipUtil = Dingus('unzip')
+            installer._dcm = Dingus('dcm', get__returns=cached)
+            installer._dwn = Dingus('download')
+            instDir = installer.install_binary_direct(
+                'scheme://PREFIX/composer.phar',
+                '1234WXYZ',
+                installDir,
+                extract=False)
+            eq_(installDir, instDir)
+            eq_(0, len(installer._unzipUtil.extract.calls()))
+            # file is copied from the cache, under its own name, and
+            #  changing it leaves the cached file alone
+            installed = os.path.join(installDir, 'composer.phar')
+            assert os.stat(cached).st_ino != os.stat(installed).st_ino
+            with open(installed, 'at') as f:
+                f.write('changed')
+            with open(cached, 'rt') as f:
+                eq_('<?php ?>', f.read())
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_extracted_cache(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            installer = CloudFoundryInstaller({
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir,
+                'FILE_CACHE_EXTRACTED': True
+            })
+            archive = os.path.abspath('test/data/HASH.tar.gz')
+            digest = installer._hashUtil.calculate_hash(archive)
+            installer._dcm.put('HASH.tar.gz', archive, digest)
+            extracted = []
+            extract = installer._unzipUtil.extract
+
+            def count_extract(*args):
+                extracted.append(args)
+                return extract(*args)
+            installer._unzipUtil.extract = count_extract
+            for name in ('first', 'second'):
+                installDir = os.path.join(tmpDir, 'build', name)
+                instDir = installer.install_binary_direct(
+                    'http://localhost/HASH.tar.gz', digest, installDir)
+                eq_(installDir, instDir)
+                assert os.path.exists(os.path.join(installDir, 'HASH'))
+            # extracted once, then copied from the cache
+            eq_(1, len(extracted))
+            first = os.path.join(tmpDir, 'build', 'first', 'HASH')
+            second = os.path.join(tmpDir, 'build', 'second', 'HASH')
+            assert os.stat(first).st_ino != os.stat(second).st_ino
+            eq_(1, os.stat(first).st_nlink)
+            # writing to one droplet leaves the others and the cache alone
+            with open(second, 'rb') as f:
+                data = f.read()
+            with open(first, 'ab') as f:
+                f.write('changed')
+            with open(second, 'rb') as f:
+                eq_(data, f.read())
+            eq_((os.path.join(tmpDir, 'cache', 'trees', '%s-0' % digest,
+                              'tree'), '.'),
+                installer._dcm.get_tree(digest, False))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_single_flight(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+            downloads = []
+
+            def download(url, toFile):
+                downloads.append(url)
+                time.sleep(0.05)
+                shutil.copy('test/data/HASH.tar.gz', toFile)
+
+            def stage(i):
+                # separate installers, like stagers sharing a cache
+                installer = CloudFoundryInstaller(ctx)
+                installer._dwn = Dingus('download')
+                installer._dwn.download = download
+                installer.install_binary_direct(
+                    'http://localhost/HASH.tar.gz', digest,
+                    os.path.join(tmpDir, 'build', str(i)))
+            digest = CloudFoundryInstaller(ctx)._hashUtil.calculate_hash(
+                'test/data/HASH.tar.gz')
+            threads = [threading.Thread(target=stage, args=(i,))
+                       for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            eq_(1, len(downloads))
+            for i in range(3):
+                assert os.path.exists(
+                    os.path.join(tmpDir, 'build', str(i), 'HASH'))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_limit_hosts(self):
+        installer = CloudFoundryInstaller({
+            'BUILD_DIR': '/tmp/build_dir',
+            'CACHE_DIR': '/tmp/cache_dir',
+            'TMPDIR': '/tmp/temp_dir'
+        })
+        installer.limit_hosts(2)
+        lock = threading.Lock()
+        active = {'host1': [0, 0], 'host2': [0, 0]}
+
+        def download(url):
+            host = url.split('/')[2]
+            with installer._host_slot(url):
+                with lock:
+                    active[host][0] += 1
+                    active[host][1] = max(active[host])
+                time.sleep(0.05)
+                with lock:
+                    active[host][0] -= 1
+        threads = [threading.Thread(target=download,
+                                    args=('http://%s/%d.tgz' % (host, i),))
+                   for host in ('host1', 'host2') for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(2, active['host1'][1])
+        eq_(2, active['host2'][1])
+        # local files are never limited
+        with installer._host_slot('file:///tmp/a.tgz'):
+            with installer._host_slot('file:///tmp/b.tgz'):
+                with installer._host_slot('file:///tmp/c.tgz'):
+                    pass
+
+    def test_install_binary_direct_manifest(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'CACHE_HASH_MANIFEST': 'SHA256SUMS',
+                'BP_DIR': tmpDir,
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+            installer = CloudFoundryInstaller(ctx)
+            digest = installer._hashUtil.calculate_hash(
+                'test/data/HASH.tar.gz')
+            with open(os.path.join(tmpDir, 'SHA256SUMS'), 'wt') as f:
+                f.write('%s  HASH.tar.gz\n' % digest)
+            installer._dwn = Dingus('download')
+            installer._dwn.download = \
+                lambda url, toFile: shutil.copy('test/data/HASH.tar.gz',
+                                                toFile)
+            installer.install_binary_direct(
+                'http://localhost/HASH.tar.gz',
+                'http://localhost/HASH.tar.gz.sha256',
+                os.path.join(tmpDir, 'build', 'hash'))
+            # cached install makes no requests at all
+            installer = CloudFoundryInstaller(ctx)
+            installer._dwn = Dingus('download')
+            installer.install_binary_direct(
+                'http://localhost/HASH.tar.gz',
+                'http://localhost/HASH.tar.gz.sha256',
+                os.path.join(tmpDir, 'build', 'hash2'))
+            eq_(0, len(installer._dwn.calls('download_direct')))
+            eq_(0, len(installer._dwn.calls('download')))
+            assert os.path.exists(
+                os.path.join(tmpDir, 'build', 'hash2', 'HASH'))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_rewrites_to_file(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with open('test/data/HASH.tar.gz', 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with open(os.path.join(tmpDir, 'HASH.tar.gz.sha256'), 'wt') as f:
+                f.write(digest)
+            with open(os.path.join(tmpDir, 'rewrites.txt'), 'wt') as f:
+                f.write('http://public/data/  file://%s/\n'
+                        '^http://public/hashes/(.*)  file://%s/\\1\n'
+                        % (os.path.abspath('test/data'), tmpDir))
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'DOWNLOAD_URL_REWRITES': 'rewrites.txt',
+                'BP_DIR': tmpDir,
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+            installer = CloudFoundryInstaller(ctx)
+            installer._dwn = Dingus('download')
+            installer.install_binary_direct(
+                'http://public/data/HASH.tar.gz',
+                'http://public/hashes/HASH.tar.gz.sha256',
+                os.path.join(tmpDir, 'build', 'hash'))
+            eq_(0, len(installer._dwn.calls()))
+            assert os.path.exists(
+                os.path.join(tmpDir, 'build', 'hash', 'HASH'))
+            eq_(digest, installer._dcm._digest('HASH.tar.gz'))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_rewrite_url_rules(self):
+        ctx = {'CACHE_DIR': '/tmp/cache_dir',
+               'DOWNLOAD_URL_REWRITES':
+                   '[["http://public/", "http://mirror/"]]'}
+        eq_('http://mirror/a.tgz',
+            CloudFoundryInstaller(ctx).rewrite_url('http://public/a.tgz'))
+        ctx['DOWNLOAD_URL_REWRITES'] = [['^http://[^/]+/', 'http://m/']]
+        eq_('http://m/a.tgz',
+            CloudFoundryInstaller(ctx).rewrite_url('http://public/a.tgz'))
+        ctx['DOWNLOAD_URL_REWRITES'] = 'does-not-exist.txt'
+        ctx['BP_DIR'] = '/tmp/build_pack_dir'
+        eq_('http://public/a.tgz',
+            CloudFoundryInstaller(ctx).rewrite_url('http://public/a.tgz'))
+
+    def test_download_digests(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            installer = CloudFoundryInstaller({
+                'CACHE_DIR': tmpDir,
+                'FILE_CACHE_NEGATIVE_TTL': 60,
+                'DOWNLOAD_URL_REWRITES': [['http://public/',
+                                           'http://mirror/']]
+            })
+            batches = []
+
+            def download_direct_many(urls):
+                batches.append(urls)
+                return [(url.endswith('b.sha1') and
+                         (None, (DownloadError, DownloadError('404', 404),
+                                 None)) or (url, None)) for url in urls]
+            installer._dwn = Dingus(
+                download_direct_many=download_direct_many)
+            urls = ['http://public/a.sha1', 'http://public/b.sha1']
+            eq_({'http://public/a.sha1': 'http://mirror/a.sha1'},
+                installer.download_digests(urls))
+            eq_({'http://public/a.sha1': 'http://mirror/a.sha1'},
+                installer.download_digests(urls))
+            eq_([['http://mirror/a.sha1', 'http://mirror/b.sha1'],
+                 ['http://mirror/a.sha1']], batches)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_cache_binaries(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            installer = CloudFoundryInstaller({
+                'CACHE_HASH_ALGORITHM': 'sha1',
+                'CACHE_DIR': tmpDir,
+                'FILE_CACHE_NEGATIVE_TTL': 60
+            })
+            sha1 = lambda data: hashlib.sha1(data).hexdigest()
+            cached = os.path.join(tmpDir, 'c.tgz.tmp')
+            with open(cached, 'wb') as f:
+                f.write('c')
+            installer._dcm.put('c.tgz', cached, sha1('c'), move=True)
+            batches = []
+
+            def download_many(downloads):
+                batches.append([url for url, toFile in downloads])
+                results = []
+                for url, toFile in downloads:
+                    if url.endswith('d.tgz'):
+                        results.append((None, (DownloadError,
+                                               DownloadError('404', 404),
+                                               None)))
+                        continue
+                    with open(toFile, 'wb') as f:
+                        f.write('a')
+                    results.append((DownloadResult(url, toFile, 1,
+                                                   sha1('a')), None))
+                return results
+            installer._dwn = Dingus(download_many=download_many)
+            binaries = [('http://host/a.tgz', sha1('a')),
+                        ('http://host/b.tgz', sha1('b')),
+                        ('http://host/c.tgz', sha1('c')),
+                        ('http://host/d.tgz', sha1('d'))]
+            installer.cache_binaries(binaries)
+            installer.cache_binaries(binaries)
+            # c is cached already, b doesn't match and d doesn't exist
+            eq_([['http://host/a.tgz', 'http://host/b.tgz',
+                  'http://host/d.tgz'],
+                 ['http://host/b.tgz']], batches)
+            assert installer._dcm.exists('a.tgz', sha1('a'))
+            assert not installer._dcm.exists('b.tgz', sha1('b'))
+            eq_(['a.tgz', 'c.tgz'],
+                sorted(name for name in os.listdir(tmpDir)
+                       if not name.startswith('.')))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_negative_cache(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'FILE_CACHE_NEGATIVE_TTL': 60,
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+
+            def install(**extra):
+                installer = CloudFoundryInstaller(dict(ctx, **extra))
+                installer._dwn = Dingus('download')
+
+                def missing(url):
+                    raise HTTPError(url, 404, 'Not Found', None, None)
+                installer._dwn.download_direct = missing
+                try:
+                    installer.install_binary_direct(
+                        'http://localhost/HASH.tar.gz',
+                        'http://localhost/HASH.tar.gz.sha256',
+                        os.path.join(tmpDir, 'build', 'hash'))
+                    assert False  # Should not happen
+                except HTTPError, e:
+                    eq_(404, e.code)
+            install()
+            try:
+                install()
+                assert False  # Should not happen
+            except DownloadError, e:
+                eq_(404, e.code)
+            install(FILE_CACHE_NEGATIVE_FORCE=True)
+            time.sleep(0.02)
+            install(FILE_CACHE_NEGATIVE_TTL=0.01)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_mirrors(self):
+        installer = CloudFoundryInstaller(
+            utils.FormattedDict({
+                'CACHE_HASH_ALGORITHM': 'sha1',
+                'BP_DIR': '/tmp/build_pack_dir',
+                'BUILD_DIR': '/tmp/build_dir',
+                'CACHE_DIR': '/tmp/cache_dir',
+                'TMPDIR': '/tmp/temp_dir',
+                'LOCAL_DOWNLOAD_URL': 'http://server/tomcat.tar.gz',
+                'LOCAL_DOWNLOAD_MIRRORS': ['http://mirror1/tomcat.tar.gz',
+                                           'http://mirror2/tomcat.tar.gz'],
+                'LOCAL_HASH_DOWNLOAD_URL': '1234WXYZ'
+            }))
+        installer._unzipUtil = Dingus('unzip')
+        installer._hashUtil = Dingus('hash',
+                                     calculate_hash__returns='1234WXYZ')
+        installer._dcm = Dingus('dcm', get__returns=None)
+        installer._dwn = Dingus('download')
+        installer.install_binary('LOCAL')
+        eq_(0, len(installer._dwn.calls('download')))
+        call = installer._dwn.calls('download_mirrors').one()
+        eq_(['http://server/tomcat.tar.gz',
+             'http://mirror1/tomcat.tar.gz',
+             'http://mirror2/tomcat.tar.gz'], call.args[0])
+        eq_('/tmp/temp_dir/tomcat.tar.gz', call.args[1])
+        eq_('1234WXYZ', call.args[2])
+
+    def test_install_binary_direct_manifest_missing_file(self):
+        installer = CloudFoundryInstaller(utils.FormattedDict({
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'CACHE_HASH_MANIFEST': 'http://localhost/SHA1SUMS',
+            'BP_DIR': '/tmp/build_pack_dir',
+            'BUILD_DIR': '/tmp/build_dir',
+            'CACHE_DIR': '/tmp/cache_dir',
+            'TMPDIR': '/tmp/temp_dir'
+        }))
+        installer._unzipUtil = Dingus('unzip')
+        installer._hashUtil = Dingus('hash',
+                                     calculate_hash__returns='a' * 40)
+        installer._dcm = Dingus('dcm', get__returns=None)
+        installer._dwn = Dingus('download')
+        installer._dwn.download_direct = Dingus(
+            return_value='%s  other.tar.gz' % ('a' * 40))
+        installer.install_binary_direct(
+            'http://localhost/HASH.tar.gz',
+            'http://localhost/HASH.tar.gz.sha1',
+            '/tmp/build_dir/hash')
+        calls = installer._dwn.download_direct.calls()
+        eq_(2, len(calls))
+        eq_('http://localhost/SHA1SUMS', calls[0].args[0])
+        eq_('http://localhost/HASH.tar.gz.sha1', calls[1].args[0])
+
+    def run_pipeline(self, tmpDir, url, digest, fileName='HASH.tar.gz'):
+        ctx = {
+            'CACHE_HASH_ALGORITHM': 'sha256',
+            'INSTALL_PIPELINE': True,
+            'BUILD_DIR': os.path.join(tmpDir, 'build'),
+            'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+            'TMPDIR': os.path.join(tmpDir, 'tmp')
+        }
+        os.makedirs(ctx['TMPDIR'])
+        installer = CloudFoundryInstaller(ctx)
+        installer._get_or_download = Dingus(return_value=(None, None))
+        installer._unzipUtil.extract = Dingus('extract')
+        installer.install_binary_direct(
+            url, digest, os.path.join(tmpDir, 'build', 'hash'),
+            fileName=fileName)
+        return installer
+
+    def test_install_binary_direct_pipeline(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            path = os.path.abspath('test/data/HASH.tar.gz')
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            installer = self.run_pipeline(tmpDir, 'file://%s' % path, digest)
+            eq_(0, len(installer._get_or_download.calls()))
+            eq_(['HASH'], os.listdir(os.path.join(tmpDir, 'build', 'hash')))
+            eq_(['hash'], os.listdir(os.path.join(tmpDir, 'build')))
+            eq_([], os.listdir(os.path.join(tmpDir, 'tmp')))
+            assert installer._dcm.exists('HASH.tar.gz', digest)
+            eq_(os.path.getsize(path), installer.stats.bytesDownloaded)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_pipeline_digest_mismatch(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            path = os.path.abspath('test/data/HASH.tar.gz')
+            try:
+                self.run_pipeline(tmpDir, 'file://%s' % path, 'a' * 64)
+                assert False  # Should not happen
+            except RuntimeError:
+                pass
+            eq_([], os.listdir(os.path.join(tmpDir, 'build')))
+            eq_([], [f for f in os.listdir(os.path.join(tmpDir, 'cache'))
+                     if not f.startswith('.')])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_pipeline_malicious_tar(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            outside = os.path.join(tmpDir, 'outside')
+            os.makedirs(outside)
+            path = os.path.join(tmpDir, 'evil.tar.gz')
+            tar = tarfile.open(path, 'w:gz')
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = outside
+            tar.addfile(link)
+            escaped = tarfile.TarInfo('link/escaped')
+            escaped.size = len('Escaped!')
+            tar.addfile(escaped, StringIO('Escaped!'))
+            tar.close()
+            # nothing escapes while the archive streams, before the digest
+            #  is checked at the end
+            try:
+                self.run_pipeline(tmpDir, 'file://%s' % path, 'a' * 64)
+                assert False  # Should not happen
+            except RuntimeError:
+                pass
+            eq_([], os.listdir(outside))
+            eq_([], os.listdir(os.path.join(tmpDir, 'build')))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_pipeline_not_tar(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            path = os.path.abspath('test/data/HASH.zip')
+            installer = self.run_pipeline(tmpDir, 'file://%s' % path,
+                                          'a' * 64, 'HASH.zip')
+            assert installer._get_or_download.calls().once()
+            eq_(False, os.path.exists(os.path.join(tmpDir, 'build')))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_install_binary_direct_pipeline_falls_back(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            path = os.path.abspath('test/data/HASH.gz')
+            installer = self.run_pipeline(tmpDir, 'file://%s' % path,
+                                          'a' * 64, 'HASH.tar.gz')
+            assert installer._get_or_download.calls().once()
+            eq_([], os.listdir(os.path.join(tmpDir, 'build')))
+            eq_([], [f for f in os.listdir(os.path.join(tmpDir, 'cache'))
+                     if not f.startswith('.')])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_save_stats(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+            digest = CloudFoundryInstaller(ctx)._hashUtil.calculate_hash(
+                'test/data/HASH.tar.gz')
+            for i in range(2):
+                installer = CloudFoundryInstaller(ctx)
+                installer._dwn = Dingus('download')
+                installer._dwn.download = \
+                    lambda url, toFile: shutil.copy('test/data/HASH.tar.gz',
+                                                    toFile)
+                installer.install_binary_direct(
+                    'http://localhost/HASH.tar.gz', digest,
+                    os.path.join(tmpDir, 'build', 'hash'))
+                installer.save_stats()
+            statsFile = os.path.join(tmpDir, 'build', '.bp', 'logs',
+                                     'cache-stats.json')
+            with open(statsFile, 'rt') as f:
+                stats = json.load(f)
+            size = os.path.getsize('test/data/HASH.tar.gz')
+            eq_(1, stats['hits'])
+            eq_(1, stats['misses'])
+            eq_(size, stats['bytesDownloaded'])
+            eq_(size, stats['bytesFromCache'])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_save_stats_download_report(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ctx = {
+                'CACHE_HASH_ALGORITHM': 'sha256',
+                'BUILD_DIR': os.path.join(tmpDir, 'build'),
+                'CACHE_DIR': os.path.join(tmpDir, 'cache'),
+                'TMPDIR': tmpDir
+            }
+            url = 'file://%s' % os.path.abspath('test/data/HASH.tar.gz')
+            with open('test/data/HASH.tar.gz', 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            for name in ('HASH.tar.gz', 'HASH-2.tar.gz'):
+                installer = CloudFoundryInstaller(ctx)
+                installer.install_binary_direct(
+                    url, digest, os.path.join(tmpDir, 'build', 'hash'),
+                    fileName=name)
+                installer.save_stats()
+            reportFile = os.path.join(tmpDir, 'build', '.bp', 'logs',
+                                      'download-report.json')
+            with open(reportFile, 'rt') as f:
+                report = json.load(f)
+            eq_(2, len(report))
+            size = os.path.getsize('test/data/HASH.tar.gz')
+            for record in report:
+                eq_(url, record['url'])
+                eq_(size, record['size'])
+                assert record['timings']['total'] > 0
+                assert record['timings'].get('firstByte', 0) <= \
+                    record['timings']['total']
+                assert record['throughput'] > 0
+        finally:
+            shutil.rmtree(tmpDir)
+
 
 class TestCloudFoundryInstallerConfig(object):
     def setUp(self):
@@ -1,5 +1,7 @@
+from nose.tools import eq_
 from build_pack_utils import HashUtil
 from build_pack_utils import ShaHashUtil
+from build_pack_utils import ChecksumManifest
 
 
 class TestHashUtils(object):
@@ -121,3 +123,24 @@ class TestHashUtils(object):
         hsh = ShaHashUtil({'CACHE_HASH_ALGORITHM': 'sha2'})
         self.hash_file_bad_algorithm(
             hsh, '2', 'shasum: Unrecognized algorithm')
+
+
+class TestChecksumManifest(object):
+    def test_parse(self):
+        manifest = ChecksumManifest(
+            '# digests\n'
+            '\n'
+            'AB12  php-5.5.12.tar.gz\n'
+            'cd34 *modules/php-mysql.tar.gz\n'
+            'bad line\n')
+        eq_(3, len(manifest))
+        eq_('ab12', manifest.get('php-5.5.12.tar.gz'))
+        eq_('cd34', manifest.get('modules/php-mysql.tar.gz'))
+        eq_('cd34', manifest.get('php-mysql.tar.gz'))
+        eq_(None, manifest.get('bad'))
+        eq_(None, manifest.get('httpd.tar.gz'))
+
+    def test_empty(self):
+        manifest = ChecksumManifest()
+        eq_(0, len(manifest))
+        eq_(None, manifest.get('php-5.5.12.tar.gz'))
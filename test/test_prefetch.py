@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+from nose.tools import eq_
+from build_pack_utils import Prefetcher
+from build_pack_utils import HashUtil
+from build_pack_utils import DirectoryCacheManager
+from build_pack_utils.prefetch import load_config
+from build_pack_utils.prefetch import main
+
+
+class TestPrefetcher(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.bpDir = os.path.join(self.tmpDir, 'bp')
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        self.dataDir = os.path.abspath(os.path.join('test', 'data'))
+        hashUtil = HashUtil({'CACHE_HASH_ALGORITHM': 'sha256'})
+        for name in ('HASH.tar.gz', 'HASH.zip', 'HASH.tar.bz2'):
+            with open(os.path.join(self.tmpDir, '%s.sha256' % name),
+                      'wt') as f:
+                f.write(hashUtil.calculate_hash(
+                    os.path.join(self.dataDir, name)))
+        os.makedirs(os.path.join(self.bpDir, 'defaults', 'stack'))
+        self.write_options('defaults/options.json', {
+            'CACHE_HASH_ALGORITHM': 'sha256',
+            'DATA': 'file://%s' % self.dataDir,
+            'TAR_DOWNLOAD_URL': '{DATA}/HASH.tar.gz',
+            'TAR_HASH_DOWNLOAD_URL': 'file://%s/HASH.tar.gz.sha256'
+                                     % self.tmpDir,
+            'ZIP_DOWNLOAD_URL': '{DATA}/HASH.zip',
+            'MOD_MODULES_PATTERN': '{DATA}/{MODULE_NAME}',
+            'MOD_MODULES': ['HASH.tar.bz2']
+        })
+        self.write_options('defaults/stack/options.json', {
+            'ZIP_HASH_DOWNLOAD_URL': 'file://%s/HASH.zip.sha256'
+                                     % self.tmpDir
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def write_options(self, path, options):
+        with open(os.path.join(self.bpDir, path), 'wt') as f:
+            json.dump(options, f)
+
+    def ctx(self, stack='stack'):
+        ctx = load_config(self.bpDir, stack)
+        ctx.update({
+            'BP_DIR': self.bpDir,
+            'CACHE_DIR': self.cacheDir,
+            'BUILD_DIR': os.path.join(self.tmpDir, 'build'),
+            'TMPDIR': self.tmpDir
+        })
+        return ctx
+
+    def test_load_config(self):
+        eq_(False, 'ZIP_HASH_DOWNLOAD_URL' in load_config(self.bpDir))
+        eq_(True, 'ZIP_HASH_DOWNLOAD_URL' in self.ctx())
+
+    def test_downloads(self):
+        data = 'file://%s' % self.dataDir
+        eq_([('MOD/HASH.tar.bz2', '%s/HASH.tar.bz2' % data,
+              '%s/HASH.tar.bz2.sha256' % data, None),
+             ('TAR', '%s/HASH.tar.gz' % data,
+              'file://%s/HASH.tar.gz.sha256' % self.tmpDir, None),
+             ('ZIP', '%s/HASH.zip' % data,
+              'file://%s/HASH.zip.sha256' % self.tmpDir, None)],
+            Prefetcher(self.ctx()).downloads())
+
+    def test_downloads_modules_from(self):
+        ctx = self.ctx()
+        ctx['EXTRA_MODULES'] = ['HASH.zip', 'HASH.tar.bz2']
+        ctx['PREFETCH_MODULES'] = {'MOD': ['MOD_MODULES', 'EXTRA_MODULES']}
+        eq_(['MOD/HASH.tar.bz2', 'MOD/HASH.zip', 'TAR', 'ZIP'],
+            [name for name, url, hashUrl, mirrors
+             in Prefetcher(ctx).downloads()])
+
+    def test_fetch(self):
+        ctx = self.ctx()
+        results = Prefetcher(ctx).fetch(workers=3)
+        eq_(['MOD/HASH.tar.bz2', 'TAR', 'ZIP'],
+            [name for name, url, path, excInfo in results])
+        # there's no hash file for the module
+        assert results[0][3] is not None
+        eq_([None, None], [excInfo for name, url, path, excInfo
+                           in results[1:]])
+        dcm = DirectoryCacheManager(ctx)
+        for name in ('HASH.tar.gz', 'HASH.zip'):
+            with open(os.path.join(self.tmpDir, '%s.sha256' % name)) as f:
+                eq_(os.path.join(self.cacheDir, name),
+                    dcm.get(name, f.read()))
+
+    def test_fetch_digest_mismatch(self):
+        ctx = self.ctx(stack=None)
+        ctx['ZIP_HASH_DOWNLOAD_URL'] = ctx['TAR_HASH_DOWNLOAD_URL']
+        results = dict((name, excInfo) for name, url, path, excInfo
+                       in Prefetcher(ctx).fetch())
+        eq_(None, results['TAR'])
+        eq_(RuntimeError, results['ZIP'][0])
+        eq_(False, os.path.exists(os.path.join(self.cacheDir, 'HASH.zip')))
+
+    def test_bundle(self):
+        ctx = self.ctx()
+        prefetcher = Prefetcher(ctx)
+        prefetcher.fetch()
+        bundle = prefetcher.bundle(os.path.join(self.tmpDir, 'cache.tgz'))
+        tar = tarfile.open(bundle)
+        try:
+            names = tar.getnames()
+        finally:
+            tar.close()
+        assert 'HASH.tar.gz' in names
+        assert 'HASH.zip' in names
+        assert '.digests.json' in names
+        eq_([], [name for name in names
+                 if name.startswith('.locks') or name.endswith('.tmp')])
+
+    def test_main(self):
+        bundle = os.path.join(self.tmpDir, 'cache.tar')
+        eq_(1, main(['-s', 'stack', '-o', bundle,
+                     self.bpDir, self.cacheDir]))
+        assert os.path.exists(bundle)
+        self.write_options('defaults/options.json', dict(
+            load_config(self.bpDir), MOD_MODULES=[],
+            EXTRA_MODULES=['HASH.tar.bz2']))
+        eq_(0, main(['-s', 'stack', '-j', '2', self.bpDir, self.cacheDir]))
+        eq_(1, main(['-s', 'stack', '-m', 'MOD=EXTRA_MODULES',
+                     self.bpDir, self.cacheDir]))
@@ -2,7 +2,10 @@ import os
 import shutil
 import tempfile
 import json
+import time
+import threading
 from dingus import Dingus
+from dingus import patch
 from nose.tools import eq_
 from nose.tools import raises
 from build_pack_utils import utils
@@ -451,3 +454,192 @@ class TestUnique(object):
         assert y[5] == 2
         assert y[6] == 1
         assert y[7] == 0
+
+
+class TestRunParallel(object):
+    def test_serial(self):
+        res = utils.run_parallel(lambda x: x * 2, [1, 2, 3])
+        eq_([(2, None), (4, None), (6, None)], res)
+
+    def test_empty(self):
+        eq_([], utils.run_parallel(lambda x: x, [], workers=4))
+
+    def test_parallel_keeps_order(self):
+        threads = set()
+
+        def work(x):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.01 * (5 - x))
+            return x
+        res = utils.run_parallel(work, range(5), workers=5)
+        eq_([(x, None) for x in range(5)], res)
+        eq_(5, len(threads))
+
+    def test_parallel_errors(self):
+        def work(x):
+            if x == 1:
+                raise ValueError('Intentional')
+            return x
+        res = utils.run_parallel(work, range(3), workers=3)
+        eq_((0, None), res[0])
+        eq_(None, res[1][0])
+        eq_(ValueError, res[1][1][0])
+        eq_('Intentional', str(res[1][1][1]))
+        eq_((2, None), res[2])
+
+
+class TestSafeMakedirs(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_existing_dir(self):
+        path = os.path.join(self._dir, 'a', 'b')
+        utils.safe_makedirs(path)
+        utils.safe_makedirs(path)
+        assert os.path.isdir(path)
+
+    def test_existing_file(self):
+        path = os.path.join(self._dir, 'a-file')
+        with open(path, 'wt') as f:
+            f.write('Hello World!')
+        utils.safe_makedirs(path)
+        assert os.path.isfile(path)
+
+
+class TestLinkOrCopy(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._src = os.path.join(self._dir, 'src.txt')
+        with open(self._src, 'wt') as f:
+            f.write('Hello World!')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_link(self):
+        dst = os.path.join(self._dir, 'dst.txt')
+        eq_('link', utils.link_or_copy(self._src, dst))
+        eq_(os.stat(self._src).st_ino, os.stat(dst).st_ino)
+
+    def test_replaces_existing(self):
+        dst = os.path.join(self._dir, 'dst.txt')
+        with open(dst, 'wt') as f:
+            f.write('Old')
+        eq_('link', utils.link_or_copy(self._src, dst))
+        with open(dst, 'rt') as f:
+            eq_('Hello World!', f.read())
+
+    def test_no_hardlink(self):
+        dst = os.path.join(self._dir, 'dst.txt')
+        assert utils.link_or_copy(self._src, dst, hardlink=False) in \
+            ('reflink', 'copy')
+        assert os.stat(self._src).st_ino != os.stat(dst).st_ino
+        with open(dst, 'rt') as f:
+            eq_('Hello World!', f.read())
+
+    def fake_clone(self, fd, request, srcFd):
+        os.write(fd, os.read(srcFd, 1024))
+
+    def test_reflink_keeps_mode(self):
+        os.chmod(self._src, 0755)
+        dst = os.path.join(self._dir, 'dst.txt')
+        with patch('fcntl.ioctl', self.fake_clone):
+            eq_('reflink', utils.link_or_copy(self._src, dst,
+                                              hardlink=False))
+        eq_(0755, os.stat(dst).st_mode & 0777)
+        with open(dst, 'rt') as f:
+            eq_('Hello World!', f.read())
+
+    def test_copy_keeps_mode(self):
+        os.chmod(self._src, 0755)
+        dst = os.path.join(self._dir, 'dst.txt')
+        utils.link_or_copy(self._src, dst, hardlink=False)
+        eq_(0755, os.stat(dst).st_mode & 0777)
+
+
+class TestLinkTree(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._src = os.path.join(self._dir, 'src')
+        os.makedirs(os.path.join(self._src, 'a', 'b'))
+        with open(os.path.join(self._src, 'a', 'b', 'c.txt'), 'wt') as f:
+            f.write('Hello World!')
+        os.symlink('a/b', os.path.join(self._src, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_link_tree(self):
+        dst = os.path.join(self._dir, 'dst')
+        os.makedirs(os.path.join(dst, 'a'))
+        with open(os.path.join(dst, 'a', 'other.txt'), 'wt') as f:
+            f.write('Other')
+        utils.link_tree(self._src, dst)
+        # files are not hard linked by default
+        assert os.stat(os.path.join(self._src, 'a', 'b', 'c.txt')).st_ino != \
+            os.stat(os.path.join(dst, 'a', 'b', 'c.txt')).st_ino
+        with open(os.path.join(dst, 'a', 'b', 'c.txt'), 'rt') as f:
+            eq_('Hello World!', f.read())
+        eq_('a/b', os.readlink(os.path.join(dst, 'link')))
+        assert os.path.exists(os.path.join(dst, 'a', 'other.txt'))
+        # running it again replaces existing files & links
+        utils.link_tree(self._src, dst)
+        eq_('a/b', os.readlink(os.path.join(dst, 'link')))
+
+    def test_link_tree_keeps_mode(self):
+        run = os.path.join(self._src, 'a', 'b', 'c.txt')
+        os.chmod(run, 0755)
+
+        def fake_clone(fd, request, srcFd):
+            os.write(fd, os.read(srcFd, 1024))
+        for clone in (None, fake_clone):
+            dst = os.path.join(self._dir, 'dst')
+            if clone:
+                with patch('fcntl.ioctl', clone):
+                    utils.link_tree(self._src, dst)
+            else:
+                utils.link_tree(self._src, dst)
+            eq_(0755, os.stat(os.path.join(dst, 'a', 'b',
+                                           'c.txt')).st_mode & 0777)
+            shutil.rmtree(dst)
+
+    def test_link_tree_hardlink(self):
+        dst = os.path.join(self._dir, 'dst')
+        utils.link_tree(self._src, dst, hardlink=True)
+        eq_(os.stat(os.path.join(self._src, 'a', 'b', 'c.txt')).st_ino,
+            os.stat(os.path.join(dst, 'a', 'b', 'c.txt')).st_ino)
+        eq_('a/b', os.readlink(os.path.join(dst, 'link')))
+
+
+class TestMoveTree(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._src = os.path.join(self._dir, 'src')
+        os.makedirs(os.path.join(self._src, 'a', 'b'))
+        with open(os.path.join(self._src, 'a', 'b', 'c.txt'), 'wt') as f:
+            f.write('Hello World!')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_move_tree_new(self):
+        dst = os.path.join(self._dir, 'x', 'dst')
+        utils.move_tree(self._src, dst)
+        assert os.path.exists(os.path.join(dst, 'a', 'b', 'c.txt'))
+        eq_(False, os.path.exists(self._src))
+
+    def test_move_tree_merge(self):
+        dst = os.path.join(self._dir, 'dst')
+        os.makedirs(os.path.join(dst, 'a', 'b'))
+        with open(os.path.join(dst, 'a', 'other.txt'), 'wt') as f:
+            f.write('Other')
+        with open(os.path.join(dst, 'a', 'b', 'c.txt'), 'wt') as f:
+            f.write('Old')
+        utils.move_tree(self._src, dst)
+        with open(os.path.join(dst, 'a', 'b', 'c.txt'), 'rt') as f:
+            eq_('Hello World!', f.read())
+        assert os.path.exists(os.path.join(dst, 'a', 'other.txt'))
+        eq_(False, os.path.exists(self._src))
@@ -1,10 +1,19 @@
 import os
+import errno
 import tempfile
 import shutil
+import tarfile
+import gzip
+import bz2
+import threading
+import copy
+import zipfile
+from StringIO import StringIO
 from nose.tools import with_setup
 from nose.tools import eq_
 from build_pack_utils import UnzipUtil
 from build_pack_utils import HashUtil
+from build_pack_utils.zips import _InflateReader
 
 
 class TestUnzipUtil(object):
@@ -110,6 +119,198 @@ class TestUnzipUtil(object):
         tmpDir = tempfile.gettempdir()
         eq_(0, len([f for f in os.listdir(tmpDir) if f.startswith('zips-')]))
 
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_extract_stream(self):
+        uzUtil = UnzipUtil({})
+        for path in (self.HASH_FILE_TAR, self.HASH_FILE_TARGZ,
+                     self.HASH_FILE_TARBZ2):
+            with open(path, 'rb') as f:
+                eq_(self._dir, uzUtil.extract_stream(f, self._dir))
+            eq_(['HASH'], os.listdir(self._dir))
+            assert self._hash == self._hshUtil.calculate_hash(self._path)
+            os.remove(self._path)
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_extract_stream_strip(self):
+        uzUtil = UnzipUtil({})
+        for path in ('./test/data/HASH-STRIP.tar.gz',
+                     './test/data/HASH-STRIP.tar.bz2'):
+            with open(path, 'rb') as f:
+                uzUtil.extract_stream(f, self._dir, strip=True)
+            eq_(['HASH'], os.listdir(self._dir))
+            assert self._hash == self._hshUtil.calculate_hash(self._path)
+            os.remove(self._path)
+
+    def malicious_tar(self, outside):
+        """A tar archive whose members try to write to `outside`"""
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+
+        def add(name, data=None, **attrs):
+            info = tarfile.TarInfo(name)
+            for key, val in attrs.iteritems():
+                setattr(info, key, val)
+            if data is not None:
+                info.size = len(data)
+            tar.addfile(info, data is not None and StringIO(data) or None)
+        # write through a link to a directory outside
+        add('link', type=tarfile.SYMTYPE, linkname=outside)
+        add('link/escaped', 'Escaped!')
+        # replace a link to a file outside, don't write through it
+        add('file-link', type=tarfile.SYMTYPE,
+            linkname=os.path.join(outside, 'target'))
+        add('file-link', 'Inside!')
+        # hard link a file outside
+        add('hard', type=tarfile.LNKTYPE,
+            linkname=os.path.join(outside, 'target'))
+        add('hard2', type=tarfile.LNKTYPE, linkname='../outside/target')
+        add('HASH', 'Hello World!')
+        tar.close()
+        buf.seek(0)
+        return buf
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_extract_stream_stays_inside(self):
+        outside = os.path.join(self._dir, 'outside')
+        os.makedirs(outside)
+        target = os.path.join(outside, 'target')
+        with open(target, 'wt') as f:
+            f.write('Original')
+        intoDir = os.path.join(self._dir, 'into')
+        UnzipUtil({}).extract_stream(self.malicious_tar(outside), intoDir)
+        eq_(['target'], os.listdir(outside))
+        with open(target, 'rt') as f:
+            eq_('Original', f.read())
+        eq_(1, os.stat(target).st_nlink)
+        eq_(['HASH', 'file-link', 'link'], sorted(os.listdir(intoDir)))
+        assert not os.path.islink(os.path.join(intoDir, 'file-link'))
+        with open(os.path.join(intoDir, 'file-link'), 'rt') as f:
+            eq_('Inside!', f.read())
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_tar_external(self):
+        uzUtil = UnzipUtil({'TAR_EXTRACTOR': 'external'})
+        for method, path in (('_untar', self.HASH_FILE_TAR),
+                             ('_tar_gunzip', self.HASH_FILE_TARGZ),
+                             ('_tar_bunzip2', self.HASH_FILE_TARBZ2),
+                             ('_tar_gunzip', './test/data/HASH-STRIP.tar.gz')):
+            getattr(uzUtil, method)(os.path.abspath(path), self._dir,
+                                    'STRIP' in path)
+            eq_(['HASH'], os.listdir(self._dir))
+            assert self._hash == self._hshUtil.calculate_hash(self._path)
+            os.remove(self._path)
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_tar_paths_with_spaces(self):
+        archive = os.path.join(self._dir, 'an archive.tar.gz')
+        shutil.copy('./test/data/HASH-STRIP.tar.gz', archive)
+        for extractor in ('python', 'external'):
+            intoDir = os.path.join(self._dir, 'into %s' % extractor)
+            UnzipUtil({'TAR_EXTRACTOR': extractor}).extract(
+                archive, intoDir, strip=True)
+            eq_(['HASH'], os.listdir(intoDir))
+            assert self._hash == self._hshUtil.calculate_hash(
+                os.path.join(intoDir, 'HASH'))
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_tar_strip_components(self):
+        archive = os.path.join(self._dir, 'deep.tar')
+        tar = tarfile.open(archive, 'w')
+        try:
+            tar.add(self.HASH_FILE, 'one/two/HASH')
+        finally:
+            tar.close()
+        intoDir = os.path.join(self._dir, 'into')
+        UnzipUtil({'EXTRACT_BUFFER_SIZE': 4096}).extract(archive, intoDir,
+                                                         strip=2)
+        eq_(['HASH'], os.listdir(intoDir))
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_extract_many(self):
+        bad = os.path.join(self._dir, 'bad.tar.gz')
+        with open(bad, 'wb') as f:
+            f.write('not an archive')
+        cwd = os.getcwd()
+        jobs = [(self.HASH_FILE_TARGZ, os.path.join(self._dir, 'a')),
+                (bad, os.path.join(self._dir, 'bad')),
+                (self.HASH_FILE_TARBZ2, os.path.join(self._dir, 'b'), False),
+                ('./test/data/HASH-STRIP.tar.gz',
+                 os.path.join(self._dir, 'c'), True),
+                (self.HASH_FILE_ZIP, os.path.join(self._dir, 'd'))]
+        results = UnzipUtil({}).extract_many(
+            [(os.path.abspath(job[0]),) + job[1:] for job in jobs])
+        eq_(cwd, os.getcwd())
+        eq_(len(jobs), len(results))
+        for job, (path, excInfo, seconds) in zip(jobs, results):
+            assert seconds >= 0
+            if job[0] == bad:
+                eq_(None, path)
+                assert excInfo is not None
+                continue
+            eq_(None, excInfo)
+            eq_(['HASH'], os.listdir(job[1]))
+            eq_(self._hash, self._hshUtil.calculate_hash(
+                os.path.join(job[1], 'HASH')))
+
+    @with_setup(setup=setUp, teardown=tearDown)
+    def test_extract_many_same_dir(self):
+        jobs = []
+        for i in xrange(8):
+            archive = os.path.join(self._dir, 'pkg%d.tar' % i)
+            tar = tarfile.open(archive, 'w')
+            try:
+                tar.add(self.HASH_FILE, 'pkg/one/two/HASH%d' % i)
+            finally:
+                tar.close()
+            jobs.append((archive, os.path.join(self._dir, 'into'), True))
+            archive = os.path.join(self._dir, 'pkg%d.zip' % i)
+            zipOut = zipfile.ZipFile(archive, 'w')
+            try:
+                zipOut.write(self.HASH_FILE, 'three/four/HASH%d' % i)
+            finally:
+                zipOut.close()
+            jobs.append((archive, os.path.join(self._dir, 'into')))
+        results = UnzipUtil({'EXTRACT_WORKERS': 8}).extract_many(jobs)
+        eq_([None] * 16, [excInfo for path, excInfo, seconds in results])
+        eq_(['HASH%d' % i for i in xrange(8)], sorted(os.listdir(
+            os.path.join(self._dir, 'into', 'one', 'two'))))
+        eq_(['HASH%d' % i for i in xrange(8)], sorted(os.listdir(
+            os.path.join(self._dir, 'into', 'three', 'four'))))
+
+    def test_inflate_reader(self):
+        gz = StringIO()
+        for text in ('Hello ', 'World!'):
+            f = gzip.GzipFile(fileobj=gz, mode='wb')
+            f.write(text)
+            f.close()
+        gz.write('\0' * 10)
+        bz = StringIO(bz2.compress('Hello ') + bz2.compress('World!'))
+        for compression, f in (('gz', gz), ('bz2', bz)):
+            for bufSize in (1, 7, 4096):
+                f.seek(0)
+                reader = _InflateReader(f, compression, bufSize)
+                eq_('Hel', reader.read(3))
+                eq_('lo World!', reader.read())
+                eq_('', reader.read(1))
+                reader.close()
+
+    def test_inflate_reader_close(self):
+        threads = threading.active_count()
+        with open(self.HASH_FILE_TARGZ, 'rb') as f:
+            reader = _InflateReader(f, 'gz', 16)
+            eq_(512, len(reader.read(512)))
+            reader.close()
+        eq_(threads, threading.active_count())
+
+    def test_inflate_reader_error(self):
+        reader = _InflateReader(StringIO('not gzip'), 'gz', 4096)
+        try:
+            reader.read(10)
+            assert False  # Should not happen
+        except Exception, e:
+            eq_('zlib', type(e).__module__)
+        reader.close()
+
     def test_pick_based_on_file_extension(self):
         uzUtil = UnzipUtil({})
         assert uzUtil._unzip == \
@@ -128,3 +329,126 @@ class TestUnzipUtil(object):
             uzUtil._pick_based_on_file_extension(self.HASH_FILE_WAR)
         assert uzUtil._unzip == \
             uzUtil._pick_based_on_file_extension(self.HASH_FILE_JAR)
+
+
+class TestDecompressors(object):
+
+    HASH_FILE = './test/data/HASH'
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._binDir = os.path.join(self._dir, 'bin')
+        os.makedirs(self._binDir)
+        self._mark = os.path.join(self._dir, 'used')
+        self._path = os.environ.get('PATH')
+        os.environ['PATH'] = os.pathsep.join([self._binDir, self._path])
+        self._decompressors = copy.deepcopy(UnzipUtil.DECOMPRESSORS)
+        self._hash = HashUtil({'CACHE_HASH_ALGORITHM': 'sha256'}) \
+            .calculate_hash(self.HASH_FILE)
+
+    def tearDown(self):
+        os.environ['PATH'] = self._path
+        UnzipUtil.DECOMPRESSORS = self._decompressors
+        shutil.rmtree(self._dir)
+
+    def fake_tool(self, name, real='gzip', status=None):
+        path = os.path.join(self._binDir, name)
+        with open(path, 'wt') as f:
+            f.write('#!/bin/sh\necho %s >> "%s"\n' % (name, self._mark))
+            if status is None:
+                f.write('exec %s "$@"\n' % real)
+            else:
+                f.write('exit %d\n' % status)
+        os.chmod(path, 0755)
+
+    def used(self):
+        if not os.path.exists(self._mark):
+            return []
+        with open(self._mark) as f:
+            return f.read().split()
+
+    def test_pick_decompressor(self):
+        self.fake_tool('pigz')
+        archive = os.path.abspath('./test/data/HASH.tar.gz')
+        eq_(None, UnzipUtil({})._decompressor(archive, 'gz'))
+        eq_(('pigz', ['pigz', '-dc']), UnzipUtil({
+            'PARALLEL_DECOMPRESS_MIN_BYTES': 1024
+        })._decompressor(archive, 'gz'))
+        eq_(('gzip', ['gzip', '-dc']), UnzipUtil({
+            'TAR_DECOMPRESSOR': 'gzip'
+        })._decompressor(archive, 'gz'))
+        eq_(None, UnzipUtil({
+            'TAR_DECOMPRESSOR': 'python',
+            'PARALLEL_DECOMPRESS_MIN_BYTES': 0
+        })._decompressor(archive, 'gz'))
+        eq_(None, UnzipUtil({
+            'TAR_DECOMPRESSOR': 'lbzip2'
+        })._decompressor(archive, 'gz'))
+        eq_(('gzip', ['gzip', '-dc']), UnzipUtil({})._decompressor(
+            archive, 'gz', inProcess=False))
+
+    def test_register_decompressor(self):
+        UnzipUtil.register_decompressor('gz', 'fastgz', ['fastgz', '-d'])
+        UnzipUtil.register_decompressor('gz', 'slowgz', ['slowgz', '-d'],
+                                        parallel=False)
+        eq_(['fastgz', 'pigz', 'gzip', 'slowgz'],
+            [name for name, cmd, parallel in UnzipUtil.DECOMPRESSORS['gz']])
+        self.fake_tool('fastgz')
+        eq_('fastgz', UnzipUtil({
+            'PARALLEL_DECOMPRESS_MIN_BYTES': 0
+        })._decompressor(self.HASH_FILE, 'gz')[0])
+
+    def test_extract_with_decompressor(self):
+        self.fake_tool('pigz')
+        self.fake_tool('lbzip2', real='bzip2')
+        for extractor in ('python', 'external'):
+            for archive in ('HASH-STRIP.tar.gz', 'HASH-STRIP.tar.bz2'):
+                intoDir = os.path.join(self._dir, extractor, archive)
+                UnzipUtil({
+                    'TAR_EXTRACTOR': extractor,
+                    'PARALLEL_DECOMPRESS_MIN_BYTES': 0
+                }).extract(os.path.abspath('./test/data/%s' % archive),
+                           intoDir, strip=True)
+                eq_(['HASH'], os.listdir(intoDir))
+                eq_(self._hash, HashUtil({
+                    'CACHE_HASH_ALGORITHM': 'sha256'
+                }).calculate_hash(os.path.join(intoDir, 'HASH')))
+        eq_(['pigz', 'lbzip2'] * 2, self.used())
+
+    def test_decompressor_fails(self):
+        self.fake_tool('pigz', status=3)
+        try:
+            UnzipUtil({'TAR_DECOMPRESSOR': 'pigz'}).extract(
+                os.path.abspath('./test/data/HASH.tar.gz'),
+                os.path.join(self._dir, 'into'))
+            assert False  # Should not happen
+        except RuntimeError, e:
+            eq_(['pigz'], self.used())
+            assert 'code [3]' in str(e)
+
+    def test_tar_fails_stops_decompressor(self):
+        # a decompressor that writes something that isn't a tar, closes
+        #  the pipe and then hangs
+        pidFile = os.path.join(self._dir, 'pid')
+        path = os.path.join(self._binDir, 'pigz')
+        with open(path, 'wt') as f:
+            f.write('#!/bin/sh\necho $$ > "%s"\n'
+                    'head -c 20480 /dev/zero | tr "\\0" x\n'
+                    'exec >&-\n'
+                    'exec sleep 30\n' % pidFile)
+        os.chmod(path, 0755)
+        try:
+            UnzipUtil({'TAR_DECOMPRESSOR': 'pigz',
+                       'TAR_EXTRACTOR': 'external'}).extract(
+                os.path.abspath('./test/data/HASH.tar.gz'),
+                os.path.join(self._dir, 'into'))
+            assert False  # Should not happen
+        except RuntimeError, e:
+            assert 'failed with code' in str(e)
+        with open(pidFile) as f:
+            pid = int(f.read())
+        try:
+            os.kill(pid, 0)
+            assert False, 'decompressor [%d] was left behind' % pid
+        except OSError, e:
+            eq_(errno.ESRCH, e.errno)